@@ -133,37 +133,37 @@ def main():
 		first_data_list.append(data)
 	print(first_data_list)
 
-	#second_data_list = []
-	#for filtered_ci in filtered_cis:
-	#	# Get a series of information about the CI
-	#	fields = []
-	#	# Name
-	#	fields.append('name')		
-	#	# Class
-	#	fields.append('sys_class_name')
-	#	# Location
-	#	fields.append('location')
-	#	# IP Address
-	#	fields.append('ip_address')
-	#	# CI ID
-	#	fields.append('sys_id')
-	#	# CI Status
-	#	fields.append('operational_status')
-	#	# Manufacturer
-	#	fields.append('vendor')
-	#	# Model 
-	#	fields.append('model_id')
-	#	# Monitor
-	#	fields.append('monitor')
-	#	# Monitored Type
-	#	fields.append('type')
+	## Get a series of information about the filtered CIs in bulk, rather than one request per CI
+	#fields = []
+	## Name
+	#fields.append('name')		
+	## Class
+	#fields.append('sys_class_name')
+	## Location
+	#fields.append('location')
+	## IP Address
+	#fields.append('ip_address')
+	## CI ID
+	#fields.append('sys_id')
+	## CI Status
+	#fields.append('operational_status')
+	## Manufacturer
+	#fields.append('vendor')
+	## Model 
+	#fields.append('model_id')
+	## Monitor
+	#fields.append('monitor')
+	## Monitored Type
+	#fields.append('type')
 	#
+	#sys_ids = []
+	#for filtered_ci in filtered_cis:
 	#	sys_id = filtered_ci['sys_id']
 	#	if 'value' in sys_id:
 	#		sys_id = sys_id['value']
-	#	#data = servicenow.get_configuration_item_data(sys_id, fields, display_value=True)
-	#
-	#	second_data_list.append(data)
+	#	sys_ids.append(sys_id)
+	#second_data = servicenow.get_configuration_items_data(sys_ids, fields, display_value=True)
+	#second_data_list = [second_data[sys_id] for sys_id in sys_ids if sys_id in second_data]
 	#print(second_data_list)
 
 	locations = servicenow.get_locations()
@@ -3,6 +3,8 @@
 # This software is licensed under the terms and conditions of the MIT License
 # accompanying the software ("License"). This software is distributed "AS IS"
 # as set forth in the License.
+import codecs
+import json
 import logging
 import os
 import requests
@@ -13,6 +15,11 @@ __all__ = ['ServiceNow']
 logging.captureWarnings(True)
 logger = logging.getLogger(__name__)
 
+DEFAULT_PAGE_SIZE = 10000
+# Each sys_id adds 33 characters to the URL, so keep chunks well below common URL length limits
+DEFAULT_SYS_ID_CHUNK_SIZE = 200
+DEFAULT_STREAM_CHUNK_SIZE = 65536
+
 #-----
 
 class ServiceNow():
@@ -29,26 +36,71 @@ class ServiceNow():
 		self.password = password
 
 		self.base_table_url = f'https://{self.hostname}/api/now/table/'
+		self.base_stats_url = f'https://{self.hostname}/api/now/stats/'
 		self.tables_cache = {}
+		# Record counts from the last get_record_counts per table, used as totals when reporting paging progress
+		self.record_counts = {}
+
+		# Reuse one session so that authentication and connections are kept across requests
+		self.session = requests.Session()
+		self.session.auth = (self.username, self.password)
+
+		# When streaming, lists of records are decoded one record at a time from the response body and each
+		# record is passed through canonicalize (if set) as soon as it is decoded
+		self.stream = False
+		self.canonicalize = None
+
+	def _cache(self, table_name, value, sys_id=None):
+		"""
+		Memoize a record by table and sys_id; a value of None records that the sys_id was not found
+		"""
 
-	def _cache(self, table_name, value):
+		if table_name not in self.tables_cache:
+			self.tables_cache[table_name] = {}
+		if sys_id == None:
+			sys_id = value['sys_id']
+			if type(sys_id) is dict:
+				sys_id = sys_id['value']
+		self.tables_cache[table_name][sys_id] = value
+
+		return
 
+	def clear_cache(self, table_name=None):
+		if table_name == None:
+			self.tables_cache = {}
+		else:
+			self.tables_cache.pop(table_name, None)
 		return
 
 	def _get_table_name_and_value_from_link(self, link):
-		elements = link.rsplit('/')
-		# Verify https is the last element in the list
-		if elements[-1] != 'https:':
+		# Links have the form https://<instance>/api/now/table/<table name>/<sys_id>
+		elements = link.rstrip('/').split('/')
+		if elements[0] != 'https:':
 			return None, None
 	
-		if len(elements) > 2 and elements[2] == 'table':
-			value = elements[0]
-			table_name = elements[1]
+		if len(elements) > 3 and elements[-3] == 'table':
+			table_name = elements[-2]
+			value = elements[-1]
 			return table_name, value
 		else:
 			logger.info(f'Unexpected link format {link}')
 			return None, None
 	
+	def _add_parameters(self, url, parameters):
+		if len(parameters) > 0:
+			character = '?'
+			for parameter in parameters:
+				parameter_name = parameter_value = None
+				if 'name' in parameter:
+					parameter_name = parameter['name']
+				if 'value' in parameter:
+					parameter_value = parameter['value']
+				if parameter_name != None and parameter_value != None:
+					url += f'{character}{parameter_name}={parameter_value}'
+					character = '&'
+
+		return url
+
 	def _get_from_table(self, table_name, value=None, parameters=[], verify=False):
 		"""
 		parameters
@@ -70,25 +122,22 @@ class ServiceNow():
 		if value != None:
 			url += f'/{value}'
 
-		if len(parameters) > 0:
-			character = '?'
-			for parameter in parameters:
-				parameter_name = parameter_value = None
-				if 'name' in parameter:
-					parameter_name = parameter['name']
-				if 'value' in parameter:
-					parameter_value = parameter['value']
-				if parameter_name != None and parameter_value != None:
-					url += f'{character}{parameter_name}={parameter_value}'
-					character = '&'
+		url = self._add_parameters(url, parameters)
 
 		headers = {}
 		headers['Accept'] = 'application/json'
 		headers['Content-Type'] = 'application/json'
 
+		if self.stream == True and value == None:
+			records = []
+			for record in self._iterate_from_url(url, headers, verify):
+				if record == None:
+					return None
+				records.append(record)
+			return records
+
 		try:
-			response = requests.get(url, auth=(self.username, self.password), headers=headers,
-				verify=verify)
+			response = self.session.get(url, headers=headers, verify=verify)
 		except:
 			raise
 
@@ -104,45 +153,298 @@ class ServiceNow():
 			else:
 				return result
 
-	def get_from_link(self, link):
-		table_name, value = self.get_table_name_and_value_from_link(link)
-		result = self._get_from_table(table_name, value)
-		return result
+	def _iterate_from_url(self, url, headers, verify=False, chunk_size=DEFAULT_STREAM_CHUNK_SIZE):
+		"""
+		Yield the records of the result array while the response body is still being received, so that at
+		most one undecoded record and one network chunk are held at a time. Yields a single None on error.
+		"""
 
-	def get_configuration_items(self, parameters=[]):
-		table_name = 'cmdb_ci'
-		result = self._get_from_table(table_name, parameters=parameters)
-		return result
+		try:
+			response = self.session.get(url, headers=headers, verify=verify, stream=True)
+		except:
+			raise
+
+		try:
+			if response.status_code not in [200, 204]:
+				logger.info(f"Request call to get data from {url} returned an error")
+				logger.debug(f"Status: {response.status_code}; Error Response: {response.text}")
+				yield None
+				return
+			logger.info(f"{response.headers}")
+
+			decoder = json.JSONDecoder()
+			text_decoder = codecs.getincrementaldecoder('utf-8')()
+			buffer = ''
+			position = 0
+			in_result = False
+			for chunk in response.iter_content(chunk_size=chunk_size):
+				buffer = buffer[position:] + text_decoder.decode(chunk)
+				position = 0
+
+				if in_result == False:
+					# Skip ahead to the opening bracket of "result"
+					key_index = buffer.find('"result"')
+					if key_index < 0:
+						continue
+					bracket_index = buffer.find('[', key_index)
+					if bracket_index < 0:
+						continue
+					position = bracket_index + 1
+					in_result = True
+
+				while True:
+					while position < len(buffer) and buffer[position] in ' \t\r\n,':
+						position += 1
+					if position >= len(buffer) or buffer[position] == ']':
+						break
+					try:
+						record, end = decoder.raw_decode(buffer, position)
+					except ValueError:
+						# The rest of the record has not arrived yet
+						break
+					position = end
+					if self.canonicalize != None:
+						record = self.canonicalize(record)
+					yield record
+
+				if position < len(buffer) and buffer[position] == ']':
+					return
+
+			if in_result == False:
+				logger.info(f"Response from {url} did not include a result")
+		finally:
+			response.close()
+
+		return
+
+	def _get_paged_from_table(self, table_name, parameters=[], page_size=DEFAULT_PAGE_SIZE, verify=False):
+		"""
+		Get all records matching the parameters, sysparm_limit records at a time. Records are ordered by
+		sys_id so that offsets stay stable between pages.
+		"""
+
+		ordered_parameters = []
+		ordered = False
+		for parameter in parameters:
+			if parameter.get('name') == 'sysparm_query':
+				parameter = {'name':'sysparm_query', 'value':f"{parameter['value']}^ORDERBYsys_id"}
+				ordered = True
+			ordered_parameters.append(parameter)
+		if ordered == False:
+			ordered_parameters.append({'name':'sysparm_query', 'value':'ORDERBYsys_id'})
+
+		records = []
+		offset = 0
+		while True:
+			page_parameters = ordered_parameters + [{'name':'sysparm_limit', 'value':page_size},
+				{'name':'sysparm_offset', 'value':offset}]
+			page = self._get_from_table(table_name, parameters=page_parameters, verify=verify)
+			if page == None:
+				logger.info(f"Failed to get page at offset {offset} from {table_name}")
+				return None
+			records.extend(page)
+			if table_name in self.record_counts:
+				logger.info(f"Fetched {len(records)} of {self.record_counts[table_name]} records from {table_name}")
+			if len(page) < page_size:
+				break
+			offset += page_size
+
+		return records
+
+	def get_record_counts(self, table_name, parameters=[], group_by=None, verify=False):
+		"""
+		Count the records matching the parameters (e.g. sysparm_query) with the aggregate API, without
+		fetching them; returns the total and, with group_by, a dictionary of counts per group value
+		"""
+
+		url = f'{self.base_stats_url}{table_name}'
+		count_parameters = list(parameters) + [{'name':'sysparm_count', 'value':'true'}]
+		if group_by != None:
+			count_parameters.append({'name':'sysparm_group_by', 'value':group_by})
+		url = self._add_parameters(url, count_parameters)
+
+		headers = {}
+		headers['Accept'] = 'application/json'
+
+		try:
+			response = self.session.get(url, headers=headers, verify=verify)
+		except:
+			raise
+
+		if response.status_code not in [200, 204]:
+			logger.info(f"Request call to count records from {url} returned an error")
+			logger.debug(f"Status: {response.status_code}; Error Response: {response.text}")
+			return None, None
+
+		result = response.json().get('result', {})
+		if type(result) is not list:
+			result = [result]
+
+		total = 0
+		groups = {}
+		for group in result:
+			count = int(group.get('stats', {}).get('count', 0))
+			total += count
+			for groupby_field in group.get('groupby_fields', []):
+				groups[groupby_field.get('value')] = count
+		self.record_counts[table_name] = total
+
+		return total, groups
+
+	def get_records_by_sys_ids(self, table_name, sys_ids, fields=[], display_value=False,
+		chunk_size=DEFAULT_SYS_ID_CHUNK_SIZE, failed_sys_ids=None):
+		"""
+		Get the records for a list of sys_ids with one sys_idIN query per chunk; returns a dictionary
+		keyed by sys_id. The sys_ids of chunks that could not be fetched are added to failed_sys_ids, if given
+		"""
 
-	def get_configuration_item_data(self, sys_id, fields=[], display_value=True):
-		table_name = 'cmdb_ci'
 		parameters = []
 		if display_value == True:
 			parameters.append({'name':'sysparm_display_value', 'value':'all'})
-		data = self._get_from_table(table_name, value=sys_id, parameters=parameters)
+		if len(fields) > 0:
+			if 'sys_id' not in fields:
+				fields = ['sys_id'] + list(fields)
+			parameters.append({'name':'sysparm_fields', 'value':','.join(fields)})
+		parameters.append({'name':'sysparm_exclude_reference_link', 'value':'true'})
+
+		records = {}
+		sys_ids = list(sys_ids)
+		for index in range(0, len(sys_ids), chunk_size):
+			chunk = sys_ids[index:index + chunk_size]
+			chunk_parameters = parameters + [{'name':'sysparm_query', 'value':'sys_idIN' + ','.join(chunk)},
+				{'name':'sysparm_limit', 'value':len(chunk)}]
+			result = self._get_from_table(table_name, parameters=chunk_parameters)
+			if result == None:
+				logger.info(f"Failed to get {len(chunk)} records from {table_name}")
+				if failed_sys_ids != None:
+					failed_sys_ids.update(chunk)
+				continue
+			for record in result:
+				sys_id = record['sys_id']
+				if type(sys_id) is dict:
+					sys_id = sys_id['value']
+				records[sys_id] = record
 
-		configuration_item_data = {}
+		return records
+
+	def resolve_references(self, table_name, sys_ids, fields=[]):
+		"""
+		Resolve reference sys_ids to records, fetching only those not already resolved during this run
+		"""
+
+		cache = self.tables_cache.get(table_name, {})
+		unresolved = set()
+		for sys_id in sys_ids:
+			if sys_id not in [None, ''] and sys_id not in cache:
+				unresolved.add(sys_id)
+
+		if len(unresolved) > 0:
+			# Only sys_ids missing from a successful response are remembered as not found; those in chunks
+			# that failed are asked for again next time
+			failed = set()
+			records = self.get_records_by_sys_ids(table_name, sorted(unresolved), fields=fields,
+				failed_sys_ids=failed)
+			for sys_id in unresolved:
+				if sys_id in records or sys_id not in failed:
+					self._cache(table_name, records.get(sys_id), sys_id=sys_id)
+			logger.info(f"Resolved {len(records)} of {len(unresolved)} new references from {table_name}")
+			if len(failed) > 0:
+				logger.info(f"Unable to resolve {len(failed)} references from {table_name}; will retry")
+
+		cache = self.tables_cache.get(table_name, {})
+		resolved = {}
+		for sys_id in sys_ids:
+			if cache.get(sys_id) != None:
+				resolved[sys_id] = cache[sys_id]
+
+		return resolved
+
+	def get_from_link(self, link):
+		table_name, value = self._get_table_name_and_value_from_link(link)
+		if table_name == None:
+			return None
+		result = self.resolve_references(table_name, [value])
+		return result.get(value)
+
+	def get_configuration_items(self, parameters=[], page_size=None):
+		table_name = 'cmdb_ci'
+		if page_size != None:
+			result = self._get_paged_from_table(table_name, parameters=parameters, page_size=page_size)
+		else:
+			result = self._get_from_table(table_name, parameters=parameters)
+		return result
+
+	def _select_fields(self, data, fields, display_value=True):
+		selected_data = {}
 		for field in fields:
 			if field in data:
-				if display_value == True:
+				if type(data[field]) is not dict:
+					selected_data[field] = data[field]
+				elif display_value == True:
 					if 'display_value' in data[field]:
-						configuration_item_data[field] = data[field]['display_value']
+						selected_data[field] = data[field]['display_value']
 				else:
 					if 'value' in data[field]:
-						configuration_item_data[field] = data[field]['value']
+						selected_data[field] = data[field]['value']
 				
-				if field not in configuration_item_data:
+				if field not in selected_data:
 					logger.info(f'Did not find value for {field}')
 
+		return selected_data
+
+	def get_configuration_items_by_class(self, table_name, parameters=[], page_size=DEFAULT_PAGE_SIZE):
+		"""
+		Get configuration items from a single CMDB class table (e.g. cmdb_ci_ip_switch), which avoids joining
+		every class extension of cmdb_ci
+		"""
+
+		if page_size != None:
+			result = self._get_paged_from_table(table_name, parameters=parameters, page_size=page_size)
+		else:
+			result = self._get_from_table(table_name, parameters=parameters)
+		return result
+
+	def get_configuration_item_data(self, sys_id, fields=[], display_value=True):
+		table_name = 'cmdb_ci'
+		parameters = []
+		if display_value == True:
+			parameters.append({'name':'sysparm_display_value', 'value':'all'})
+		data = self._get_from_table(table_name, value=sys_id, parameters=parameters)
+
+		configuration_item_data = self._select_fields(data, fields, display_value)
+
 		return configuration_item_data
 
-	def get_locations(self, parameters=[]):
+	def get_configuration_items_data(self, sys_ids, fields=[], display_value=True, chunk_size=DEFAULT_SYS_ID_CHUNK_SIZE):
+		"""
+		Bulk version of get_configuration_item_data; fetches the fields for many CIs with one query per chunk
+		of sys_ids and returns a dictionary keyed by sys_id
+		"""
+
+		table_name = 'cmdb_ci'
+		# Ask for values as well as display values so that sys_id keys are always raw values
+		records = self.get_records_by_sys_ids(table_name, sys_ids, fields=fields, display_value=True,
+			chunk_size=chunk_size)
+
+		configuration_items_data = {}
+		for sys_id, data in records.items():
+			configuration_items_data[sys_id] = self._select_fields(data, fields, display_value)
+
+		return configuration_items_data
+
+	def get_locations(self, parameters=[], page_size=None):
 		table_name = 'cmn_location'
-		result = self._get_from_table(table_name, parameters=parameters)
+		if page_size != None:
+			result = self._get_paged_from_table(table_name, parameters=parameters, page_size=page_size)
+		else:
+			result = self._get_from_table(table_name, parameters=parameters)
 		return result
 
-	def get_relationships(self, parameters=[]):
+	def get_relationships(self, parameters=[], page_size=None):
 		table_name = 'cmdb_rel_ci'
-		result = self._get_from_table(table_name, parameters=parameters)
+		if page_size != None:
+			result = self._get_paged_from_table(table_name, parameters=parameters, page_size=page_size)
+		else:
+			result = self._get_from_table(table_name, parameters=parameters)
 		return result
 		
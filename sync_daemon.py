@@ -0,0 +1,152 @@
+# Daemon mode for sync_servicenow.py: scheduled cycles with warm caches and a status endpoint
+
+import datetime
+import json
+import logging
+import os
+import random
+import signal
+import sys
+import threading
+import time
+
+from sync_servicenow import sync_context_create, sync_run
+from sync_instrumentation import sync_instrumentation_report
+
+logger = logging.getLogger(__name__)
+
+
+#----- Daemon functions
+
+SYNC_DAEMON_INTERVAL = 3600
+SYNC_DAEMON_JITTER = 300
+SYNC_DAEMON_FULL_REFRESH_CYCLES = 24
+SYNC_DAEMON_STATUS_ADDRESS = '127.0.0.1'
+
+def sync_daemon_timestamp(value):
+	if value == None:
+		return None
+	return datetime.datetime.fromtimestamp(value, datetime.timezone.utc).isoformat()
+
+def sync_daemon_status_write(status, status_file):
+	if status_file == None or status_file == '':
+		return
+
+	# Write to a temporary file first so readers never see a partial status
+	temporary_file = f"{status_file}.tmp"
+	with open(temporary_file, 'w') as file:
+		json.dump(status, file, indent=2)
+	os.replace(temporary_file, status_file)
+
+	return
+
+def sync_daemon_status_server_start(status, port):
+	if port == None:
+		return None
+
+	import http.server
+
+	class SyncDaemonStatusHandler(http.server.BaseHTTPRequestHandler):
+
+		def do_GET(self):
+			if self.path not in ['/', '/status', '/health']:
+				self.send_error(404)
+				return
+
+			status = dict(self.server.status)
+			body = json.dumps(status, indent=2).encode('utf-8')
+			# Report failures on /health with a status code so that simple probes can use it
+			code = 200
+			if self.path == '/health' and status['healthy'] != True:
+				code = 503
+			self.send_response(code)
+			self.send_header('Content-Type', 'application/json')
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+		def log_message(self, format, *args):
+			logger.debug(format % args)
+
+	server = http.server.ThreadingHTTPServer((SYNC_DAEMON_STATUS_ADDRESS, port), SyncDaemonStatusHandler)
+	server.status = status
+	thread = threading.Thread(target=server.serve_forever, daemon=True)
+	thread.start()
+	logger.info(f"Serving daemon status on http://{SYNC_DAEMON_STATUS_ADDRESS}:{port}/status")
+
+	return server
+
+def sync_daemon_run(args, instrumentation, sink=None):
+
+	context = sync_context_create()
+
+	status = {}
+	status['healthy'] = None
+	status['state'] = 'starting'
+	status['cycle'] = 0
+	status['last_cycle_start'] = None
+	status['last_cycle_end'] = None
+	status['last_cycle_duration'] = None
+	status['last_cycle_full_refresh'] = None
+	status['last_cycle_stats'] = None
+	status['last_success'] = None
+	status['last_error'] = None
+	status['next_cycle'] = None
+
+	stop = threading.Event()
+	def stop_handler(signal_number, frame):
+		logger.info(f"Received signal {signal_number}; stopping after the current cycle")
+		stop.set()
+	signal.signal(signal.SIGTERM, stop_handler)
+
+	server = sync_daemon_status_server_start(status, args.daemon_status_port)
+
+	full_refresh_cycles = max(args.daemon_full_refresh, 1)
+	try:
+		while not stop.is_set():
+			status['cycle'] += 1
+			context['full_refresh'] = (status['cycle'] - 1) % full_refresh_cycles == 0
+			status['state'] = 'running'
+			start = time.time()
+			status['last_cycle_start'] = sync_daemon_timestamp(start)
+			status['last_cycle_full_refresh'] = context['full_refresh']
+			sync_daemon_status_write(status, args.daemon_status_file)
+
+			try:
+				stats = sync_run(args, instrumentation, context, sink)
+				status['healthy'] = True
+				status['last_cycle_stats'] = stats
+				status['last_success'] = sync_daemon_timestamp(time.time())
+				status['last_error'] = None
+			except Exception as e:
+				logger.info(f"Synchronization cycle {status['cycle']} failed: {e}")
+				logger.debug("Unexpected error {}".format(sys.exc_info()[0]))
+				status['healthy'] = False
+				status['last_error'] = repr(e)
+				# Drop the connections so the next cycle authenticates again
+				context['servicenow'] = None
+				context['netim'] = None
+				context['netim_inventory'] = None
+
+			end = time.time()
+			delay = args.daemon_interval + random.uniform(0, max(args.daemon_jitter, 0))
+			# Keep the schedule anchored to the start of each cycle
+			delay = max(delay - (end - start), 0)
+			status['state'] = 'sleeping'
+			status['last_cycle_end'] = sync_daemon_timestamp(end)
+			status['last_cycle_duration'] = end - start
+			status['next_cycle'] = sync_daemon_timestamp(end + delay)
+			sync_daemon_status_write(status, args.daemon_status_file)
+			logger.info("Cycle {} finished in {:.1f}s; next cycle in {:.0f}s".format(status['cycle'], end - start, delay))
+			sync_instrumentation_report(instrumentation)
+
+			stop.wait(delay)
+	except KeyboardInterrupt:
+		logger.info("Interrupted; stopping daemon")
+	finally:
+		status['state'] = 'stopped'
+		sync_daemon_status_write(status, args.daemon_status_file)
+		if server != None:
+			server.shutdown()
+
+	return
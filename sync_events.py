@@ -0,0 +1,381 @@
+# Event receiver for sync_servicenow.py: ServiceNow record changes pushed over HTTP and processed in batches
+
+import json
+import logging
+import signal
+import sys
+import threading
+import time
+
+from sync_servicenow import sync_servicenow_devices_filter, sync_servicenow_record_field_value, \
+	sync_servicenow_api_locations_import, sync_servicenow_configuration_read, sync_servicenow_authenticate, \
+	SYNC_SERVICENOW_LOOKUP_DEVICES_LOCATION, SYNC_SERVICENOW_LOOKUP_LOCATIONS_NAME, SYNC_REPORT_EVENTS, \
+	SyncReportSink, sync_report_category, sync_servicenow_netim_devices_comparison_report, \
+	sync_servicenow_netim_sites_comparison_report, SYNC_SERVICENOW_INPUT_API_DEVICES_NAME, \
+	SYNC_SERVICENOW_INPUT_API_LOCATIONS_NAME, sync_servicenow_input_globals, sync_servicenow_input_value, \
+	sync_servicenow_input_canonicalize, sync_servicenow_input_validate, sync_servicenow_location_key, \
+	sync_servicenow_to_netim_devices_convert, sync_servicenow_to_netim_locations_convert, \
+	sync_servicenow_netim_devices_comparison, sync_fuzzy_index, sync_servicenow_netim_devices_fuzzy_match, \
+	sync_servicenow_netim_sites_comparison, sync_netim_authenticate, sync_netim_inventory_get, \
+	sync_netim_inventory_save, sync_context_create, sync_reconcile
+from sync_instrumentation import sync_instrumentation_report, sync_stage
+
+logger = logging.getLogger(__name__)
+
+
+#----- Event receiver functions
+
+SYNC_EVENTS_ADDRESS = '127.0.0.1'
+SYNC_EVENTS_WINDOW = 5
+SYNC_EVENTS_BATCH_SIZE = 500
+SYNC_EVENTS_MAX_BODY = 10 * 1024 * 1024
+SYNC_EVENTS_TOKEN_HEADER = 'X-Sync-Token'
+
+SYNC_EVENTS_TABLE_DEVICES = 'cmdb_ci'
+SYNC_EVENTS_TABLE_LOCATIONS = 'cmn_location'
+
+SYNC_EVENTS_OPERATION_UPSERT = 'upsert'
+SYNC_EVENTS_OPERATION_DELETE = 'delete'
+
+SYNC_EVENTS_DELETED_DEVICE = 'deleted_device'
+SYNC_EVENTS_DELETED_LOCATION = 'deleted_location'
+
+def sync_events_queue_create():
+	queue = {}
+	queue['condition'] = threading.Condition()
+	# Pending events keyed by (table, sys_id), so that later events for a record replace earlier ones
+	queue['pending'] = {}
+	queue['first'] = None
+	queue['received'] = 0
+	queue['coalesced'] = 0
+	return queue
+
+def sync_events_event_parse(payload):
+	# Events are sent by a ServiceNow business rule or outbound REST message as
+	# {"table": ..., "operation": "insert|update|delete", "sys_id": ..., "record": {...}}
+	if type(payload) is not dict:
+		return None
+
+	table = payload.get('table')
+	operation = payload.get('operation')
+	record = payload.get('record')
+	if record == None:
+		record = {}
+	if type(record) is not dict:
+		return None
+
+	# Business rules sending records from class tables report the class table, so map them to cmdb_ci
+	if table == None:
+		return None
+	if table != SYNC_EVENTS_TABLE_LOCATIONS and (table == SYNC_EVENTS_TABLE_DEVICES or table.startswith('cmdb_ci_')):
+		table = SYNC_EVENTS_TABLE_DEVICES
+	elif table != SYNC_EVENTS_TABLE_LOCATIONS:
+		return None
+
+	if operation in ['insert', 'update']:
+		operation = SYNC_EVENTS_OPERATION_UPSERT
+	elif operation != SYNC_EVENTS_OPERATION_DELETE:
+		return None
+
+	sys_id = payload.get('sys_id')
+	if sys_id == None:
+		sys_id = sync_servicenow_record_field_value(record, 'sys_id')
+	if sys_id == None or sys_id == '':
+		return None
+	record['sys_id'] = sys_id
+
+	event = {}
+	event['table'] = table
+	event['operation'] = operation
+	event['sys_id'] = sys_id
+	event['record'] = record
+	return event
+
+def sync_events_enqueue(queue, events):
+	with queue['condition']:
+		for event in events:
+			key = (event['table'], event['sys_id'])
+			if key in queue['pending']:
+				queue['coalesced'] += 1
+			queue['pending'][key] = event
+			queue['received'] += 1
+		if queue['first'] == None and len(queue['pending']) > 0:
+			queue['first'] = time.monotonic()
+		queue['condition'].notify_all()
+	return
+
+def sync_events_dequeue(queue, window, batch_size, stop):
+	# Wait for the first event, then keep collecting until the window closes or the batch is full
+	with queue['condition']:
+		while not stop.is_set():
+			if queue['first'] != None:
+				remaining = queue['first'] + window - time.monotonic()
+				if remaining <= 0 or len(queue['pending']) >= batch_size:
+					break
+				queue['condition'].wait(remaining)
+			else:
+				queue['condition'].wait(1)
+
+		keys = list(queue['pending'].keys())[:batch_size]
+		events = [queue['pending'].pop(key) for key in keys]
+		if len(queue['pending']) > 0:
+			queue['first'] = time.monotonic()
+		else:
+			queue['first'] = None
+
+	return events
+
+def sync_events_server_start(queue, address, port, token=None):
+	import http.server
+
+	class SyncEventRequestHandler(http.server.BaseHTTPRequestHandler):
+
+		def do_POST(self):
+			token = self.server.token
+			if token != None and self.headers.get(SYNC_EVENTS_TOKEN_HEADER) != token:
+				self.send_error(401)
+				return
+
+			try:
+				length = int(self.headers.get('Content-Length', 0))
+			except ValueError:
+				length = -1
+			if length <= 0 or length > SYNC_EVENTS_MAX_BODY:
+				self.send_error(400, 'Missing or oversized body')
+				return
+
+			try:
+				payload = json.loads(self.rfile.read(length))
+			except ValueError:
+				self.send_error(400, 'Body is not valid JSON')
+				return
+
+			# Accept a single event, a list of events, or ServiceNow's {"result": [...]} wrapper
+			if type(payload) is dict and 'result' in payload:
+				payload = payload['result']
+			if type(payload) is not list:
+				payload = [payload]
+
+			events = []
+			for item in payload:
+				event = sync_events_event_parse(item)
+				if event == None:
+					logger.info(f"Ignoring unsupported event {item}")
+					continue
+				events.append(event)
+			sync_events_enqueue(self.server.queue, events)
+
+			body = json.dumps({'accepted':len(events), 'ignored':len(payload) - len(events)}).encode('utf-8')
+			self.send_response(202)
+			self.send_header('Content-Type', 'application/json')
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+		def log_message(self, format, *args):
+			logger.debug(format % args)
+
+	server = http.server.ThreadingHTTPServer((address, port), SyncEventRequestHandler)
+	server.queue = queue
+	server.token = token
+	thread = threading.Thread(target=server.serve_forever, daemon=True)
+	thread.start()
+	logger.info(f"Receiving ServiceNow events on http://{address}:{port}/")
+
+	return server
+
+def sync_events_records_merge(servicenow, table, records, cache, name_field, display_value=False):
+	# Business rules may only send the changed fields, so each record is laid over the full record: the one
+	# cached from earlier events or the warm-up, or else the one fetched from ServiceNow by sys_id
+	missing_sys_ids = [record['sys_id'] for record in records if record['sys_id'] not in cache]
+	fetched = {}
+	if len(missing_sys_ids) > 0:
+		fetched = servicenow.get_records_by_sys_ids(table, missing_sys_ids, display_value=display_value)
+		logger.info(f"Fetched {len(fetched)} of {len(missing_sys_ids)} full records from {table}")
+
+	merged_records = []
+	for record in records:
+		sys_id = record['sys_id']
+		merged = dict(cache.get(sys_id, fetched.get(sys_id, {})))
+		merged.update(record)
+		# A record that is still without a name cannot be compared or created
+		if sync_servicenow_record_field_value(merged, name_field) in [None, '']:
+			logger.info(f"Ignoring event for {table} record {sys_id} without a name")
+			continue
+		cache[sys_id] = merged
+		merged_records.append(merged)
+
+	return merged_records
+
+def sync_events_location_devices(locations, devices_cache, device_upserts, lookup_table):
+	# The cached devices at the changed locations, other than those already changed in the batch
+	if len(locations) == 0:
+		return []
+	location_name_field = lookup_table[SYNC_SERVICENOW_LOOKUP_LOCATIONS_NAME]
+	device_location_field = lookup_table[SYNC_SERVICENOW_LOOKUP_DEVICES_LOCATION]
+	location_keys = set(sync_servicenow_location_key(sync_servicenow_input_value(location.get(location_name_field))) \
+		for location in locations)
+	upserted_sys_ids = set(device['sys_id'] for device in device_upserts)
+	return [device for sys_id, device in devices_cache.items() if sys_id not in upserted_sys_ids and \
+		sync_servicenow_location_key(sync_servicenow_input_value(device.get(device_location_field))) in location_keys]
+
+def sync_events_deleted_record(deleted):
+	return {'name':deleted['name'], 'cmdb_ci':deleted['sys_id']}
+
+def sync_events_deletes_report(deleted_devices, deleted_locations, summary=True, sink=None):
+	if sink == None:
+		sink = SyncReportSink(summary=summary)
+
+	# Removing devices from NetIM is left to aging (--aging_days), so deletes are only reported
+	if len(deleted_devices) > 0:
+		sync_report_category(sink, SYNC_REPORT_EVENTS, SYNC_EVENTS_DELETED_DEVICE, deleted_devices,
+			f"There are {len(deleted_devices)} device(s) that were deleted from the CMDB; they are left to aging:",
+			sync_events_deleted_record)
+	if len(deleted_locations) > 0:
+		sync_report_category(sink, SYNC_REPORT_EVENTS, SYNC_EVENTS_DELETED_LOCATION, deleted_locations,
+			f"There are {len(deleted_locations)} location(s) that were deleted from the CMDB; their NetIM sites " \
+			"are kept:", sync_events_deleted_record)
+
+	return
+
+def sync_events_process(events, args, instrumentation, context, sink=None):
+
+	config = context['servicenow_config']
+	servicenow = context['servicenow']
+	locations_cache = context['servicenow_locations']['records']
+	devices_cache = context['servicenow_devices']['records']
+	lookup_table = sync_servicenow_input_globals(True)
+
+	location_upserts = []
+	location_deletes = []
+	device_upserts = []
+	device_deletes = []
+	for event in events:
+		if event['operation'] == SYNC_EVENTS_OPERATION_DELETE:
+			# The name is only known from the cache, since a delete event may carry nothing but the sys_id
+			if event['table'] == SYNC_EVENTS_TABLE_LOCATIONS:
+				cache, deletes, name_field = locations_cache, location_deletes, SYNC_SERVICENOW_INPUT_API_LOCATIONS_NAME
+			else:
+				cache, deletes, name_field = devices_cache, device_deletes, SYNC_SERVICENOW_INPUT_API_DEVICES_NAME
+			cached = cache.pop(event['sys_id'], {})
+			name = sync_servicenow_record_field_value(event['record'], name_field)
+			if name in [None, '']:
+				name = sync_servicenow_record_field_value(cached, name_field)
+			deletes.append({'sys_id':event['sys_id'], 'name':name if name != None else ''})
+		elif event['table'] == SYNC_EVENTS_TABLE_LOCATIONS:
+			location_upserts.append(event['record'])
+		else:
+			device_upserts.append(event['record'])
+
+	# Apply location changes first so that devices in the same batch see them
+	location_upserts = sync_events_records_merge(servicenow, SYNC_EVENTS_TABLE_LOCATIONS, location_upserts,
+		locations_cache, SYNC_SERVICENOW_INPUT_API_LOCATIONS_NAME)
+	device_upserts_count = len(device_upserts)
+	device_upserts = sync_events_records_merge(servicenow, SYNC_EVENTS_TABLE_DEVICES, device_upserts,
+		devices_cache, SYNC_SERVICENOW_INPUT_API_DEVICES_NAME, display_value=True)
+
+	# A changed location is compared and reconciled through the devices in the CMDB that use it, even when no
+	# device changed in the batch
+	location_devices = sync_events_location_devices(location_upserts, devices_cache, device_upserts, lookup_table)
+
+	stats = {}
+	stats['events'] = len(events)
+	stats['device_upserts'] = len(device_upserts)
+	stats['device_deletes'] = len(device_deletes)
+	stats['location_upserts'] = len(location_upserts)
+	stats['location_deletes'] = len(location_deletes)
+	stats['location_devices'] = len(location_devices)
+	stats['rejected_upserts'] = device_upserts_count - len(device_upserts)
+
+	sync_events_deletes_report(device_deletes, location_deletes, args.summary, sink)
+
+	devices = sync_servicenow_devices_filter(device_upserts + location_devices,
+		include_filters=config['include_filters'], exclude_filters=config['exclude_filters'])
+	if len(devices) == 0:
+		return stats
+
+	with sync_stage(instrumentation, 'canonicalize'):
+		canonical_devices, canonical_locations = sync_servicenow_input_canonicalize(devices,
+			locations_cache.values(), lookup_table)
+	with sync_stage(instrumentation, 'validate'):
+		devices_to_import, locations_to_import, devices_with_access_addresses = \
+			sync_servicenow_input_validate(canonical_devices, canonical_locations, args.summary, sink)
+	with sync_stage(instrumentation, 'convert'):
+		converted_devices = sync_servicenow_to_netim_devices_convert(devices_to_import)
+		converted_sites = sync_servicenow_to_netim_locations_convert(locations_to_import)
+
+	netim = context['netim']
+	with sync_stage(instrumentation, 'inventory'):
+		inventory = sync_netim_inventory_get(netim, context, args.netim_inventory, args.netim_inventory_max_age)
+	with sync_stage(instrumentation, 'devices_comparison'):
+		device_comparison = sync_servicenow_netim_devices_comparison(converted_devices, netim,
+			devices_with_access_addresses, inventory.index)
+	if args.fuzzy_match != None:
+		with sync_stage(instrumentation, 'devices_fuzzy_match'):
+			sync_servicenow_netim_devices_fuzzy_match(device_comparison, sync_fuzzy_index(inventory.index),
+				args.fuzzy_match)
+	sync_servicenow_netim_devices_comparison_report(device_comparison, args.summary, sink)
+	with sync_stage(instrumentation, 'sites_comparison'):
+		site_comparison = sync_servicenow_netim_sites_comparison(converted_sites, netim, args.summary,
+			list(inventory.groups.values()))
+	sync_servicenow_netim_sites_comparison_report(site_comparison, args.summary, sink)
+
+	stats['devices_to_import'] = len(converted_devices)
+	for comparison_name, comparison_list in device_comparison.items():
+		stats[comparison_name] = len(comparison_list)
+	for comparison_name, comparison_list in site_comparison.items():
+		stats[comparison_name] = len(comparison_list)
+
+	if args.reconcile == True:
+		stats.update(sync_reconcile(netim, device_comparison, converted_devices, site_comparison, converted_sites,
+			instrumentation, inventory, devices_with_access_addresses, args.update_addresses, sink))
+	sync_netim_inventory_save(inventory, args.netim_inventory)
+
+	return stats
+
+def sync_events_run(args, instrumentation, sink=None):
+
+	if args.servicenow_yml == None or args.servicenow_yml == '':
+		print("Receiving ServiceNow events requires --servicenow_yml")
+		return
+
+	# Warm up the connections and the location table once; events keep the locations current afterwards
+	context = sync_context_create()
+	config = sync_servicenow_configuration_read(args.servicenow_yml)
+	context['servicenow_config'] = config
+	context['servicenow'] = sync_servicenow_authenticate(config)
+	sync_servicenow_api_locations_import(context['servicenow'], context)
+	context['netim'] = sync_netim_authenticate(args.netim_yml)
+	# From here on events keep the caches current, so later batches reuse the NetIM inventory snapshot
+	context['full_refresh'] = False
+
+	queue = sync_events_queue_create()
+	stop = threading.Event()
+	def stop_handler(signal_number, frame):
+		logger.info(f"Received signal {signal_number}; stopping after the current batch")
+		stop.set()
+		with queue['condition']:
+			queue['condition'].notify_all()
+	signal.signal(signal.SIGTERM, stop_handler)
+
+	server = sync_events_server_start(queue, args.events_address, args.events_port, args.events_token)
+	try:
+		while not stop.is_set():
+			events = sync_events_dequeue(queue, args.events_window, args.events_batch, stop)
+			if len(events) == 0:
+				continue
+			logger.info("Processing {} event(s); {} received and {} coalesced so far".format(len(events),
+				queue['received'], queue['coalesced']))
+			try:
+				stats = sync_events_process(events, args, instrumentation, context, sink)
+				logger.info(f"Processed event batch: {stats}")
+			except Exception as e:
+				logger.info(f"Failed to process event batch: {e}")
+				logger.debug("Unexpected error {}".format(sys.exc_info()[0]))
+			sync_instrumentation_report(instrumentation)
+	except KeyboardInterrupt:
+		logger.info("Interrupted; stopping event receiver")
+	finally:
+		server.shutdown()
+
+	return
@@ -0,0 +1,336 @@
+# Per-stage CPU profiles, memory reports and the memory budget watchdog for sync_servicenow.py
+
+import contextlib
+import io
+import logging
+import os
+import sys
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+#----- Stage instrumentation functions
+
+# Keys into the instrumentation dictionary passed to each stage of main()
+SYNC_INSTRUMENTATION_PROFILE = 'profile'
+SYNC_INSTRUMENTATION_MEMORY = 'memory'
+
+SYNC_PROFILE_TOP_COUNT = 20
+SYNC_PROFILE_MAX_STACK_DEPTH = 64
+# Call paths that contribute less than this many seconds are dropped from the collapsed stacks
+SYNC_PROFILE_MIN_STACK_TIME = 0.000001
+
+def sync_profile_create(profile_directory, top_count=SYNC_PROFILE_TOP_COUNT):
+	if profile_directory == None or profile_directory == '':
+		return None
+
+	os.makedirs(profile_directory, exist_ok=True)
+
+	profile = {}
+	profile['directory'] = profile_directory
+	profile['top_count'] = top_count
+	profile['stages'] = []
+	# Stages are numbered over the whole process, so files from earlier daemon cycles are not overwritten
+	profile['stage_count'] = 0
+	return profile
+
+def sync_profile_function_label(function):
+	filename, line_number, function_name = function
+	if filename == '~':
+		return function_name
+	return f"{function_name} ({os.path.basename(filename)}:{line_number})"
+
+def sync_profile_collapsed_stacks(stats):
+	# cProfile only records caller/callee pairs, so rebuild call paths from the roots down and split each
+	# function's own time across its paths in proportion to the cumulative time spent along each path
+	callees = {}
+	roots = []
+	for function, (cc, nc, tt, ct, callers) in stats.stats.items():
+		if len(callers) == 0:
+			roots.append(function)
+		for caller, caller_stats in callers.items():
+			if caller not in callees:
+				callees[caller] = []
+			callees[caller].append((function, caller_stats[3]))
+
+	stacks = {}
+
+	def walk(function, path, labels, path_time):
+		cc, nc, tt, ct, callers = stats.stats[function]
+		fraction = path_time / ct if ct > 0 else 0.0
+		labels = labels + [sync_profile_function_label(function)]
+		self_time = tt * fraction
+		if self_time >= SYNC_PROFILE_MIN_STACK_TIME:
+			stack = ';'.join(labels)
+			stacks[stack] = stacks.get(stack, 0.0) + self_time
+
+		if len(labels) >= SYNC_PROFILE_MAX_STACK_DEPTH:
+			return
+		for callee, edge_time in callees.get(function, []):
+			# Recursive calls are already accounted for in the caller's time
+			if callee in path:
+				continue
+			callee_time = edge_time * fraction
+			if callee_time < SYNC_PROFILE_MIN_STACK_TIME:
+				continue
+			walk(callee, path | {callee}, labels, callee_time)
+
+	for root in roots:
+		walk(root, {root}, [], stats.stats[root][3])
+
+	return stacks
+
+def sync_profile_stage_write(profile, stage_name, profiler, elapsed):
+	import pstats
+	profile['stage_count'] += 1
+	stage_index = profile['stage_count']
+	file_prefix = os.path.join(profile['directory'], f"{stage_index:02d}_{stage_name}")
+
+	stats = pstats.Stats(profiler)
+	stats.dump_stats(f"{file_prefix}.pstats")
+
+	# Collapsed stacks use integer microseconds so the output can be fed to flamegraph.pl or speedscope
+	stacks = sync_profile_collapsed_stacks(stats)
+	with open(f"{file_prefix}.collapsed", 'w') as file:
+		for stack, stack_time in sorted(stacks.items()):
+			microseconds = int(round(stack_time * 1000000))
+			if microseconds > 0:
+				file.write(f"{stack} {microseconds}\n")
+
+	stream = io.StringIO()
+	summary_stats = pstats.Stats(profiler, stream=stream)
+	summary_stats.sort_stats(pstats.SortKey.TIME).print_stats(profile['top_count'])
+	with open(f"{file_prefix}.txt", 'w') as file:
+		file.write(stream.getvalue())
+
+	# Keep a compact list of the hottest functions for the end of run summary
+	hot_functions = []
+	for function, (cc, nc, tt, ct, callers) in stats.stats.items():
+		hot_functions.append((tt, ct, nc, sync_profile_function_label(function)))
+	hot_functions.sort(reverse=True)
+
+	stage = {}
+	stage['name'] = stage_name
+	stage['elapsed'] = elapsed
+	stage['file_prefix'] = file_prefix
+	stage['hot_functions'] = hot_functions[:profile['top_count']]
+	profile['stages'].append(stage)
+	logger.info(f"Wrote profile for stage {stage_name} to {file_prefix}.*")
+
+	return
+
+def sync_profile_report(profile):
+	if profile == None or len(profile['stages']) == 0:
+		return
+
+	print("")
+	print("Profile Summary")
+	print("---------------------------------------------------------------------------------------------------")
+	for stage in profile['stages']:
+		print("")
+		print(f"Stage {stage['name']}: {stage['elapsed']:.3f}s ({stage['file_prefix']}.pstats)")
+		print(f"  {'tottime':>10} {'cumtime':>10} {'calls':>10}  function")
+		for tt, ct, nc, label in stage['hot_functions']:
+			print(f"  {tt:>10.4f} {ct:>10.4f} {nc:>10}  {label}")
+	print("")
+
+	return
+
+SYNC_MEMORY_TOP_COUNT = 10
+SYNC_MEMORY_WATCHDOG_INTERVAL = 0.5
+SYNC_MEMORY_EXIT_CODE = 3
+
+def sync_memory_rss_current():
+	# Resident set size in bytes; /proc is only available on Linux, so fall back to the peak elsewhere
+	try:
+		with open('/proc/self/statm') as file:
+			return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+	except:
+		return sync_memory_rss_peak()
+
+def sync_memory_rss_peak():
+	# The resource module is only available on Unix; elsewhere the size is not known
+	try:
+		import resource
+	except ImportError:
+		return 0
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# ru_maxrss is reported in bytes on macOS and in kilobytes elsewhere
+	if sys.platform == 'darwin':
+		return peak
+	return peak * 1024
+
+def sync_memory_megabytes(size):
+	return size / (1024 * 1024)
+
+def sync_memory_watchdog(memory):
+	budget = memory['budget']
+	while not memory['stop'].wait(SYNC_MEMORY_WATCHDOG_INTERVAL):
+		rss = sync_memory_rss_current()
+		if rss > budget:
+			message = "Memory budget of {:.0f} MB exceeded during stage {} ({:.0f} MB resident)".format(
+				sync_memory_megabytes(budget), memory['stage'], sync_memory_megabytes(rss))
+			sync_memory_abort(memory, message)
+			return
+
+def sync_memory_abort(memory, message):
+	# Stop the whole process from the watchdog thread, without waiting for the stage to end; an exception raised
+	# in the main thread could be swallowed by a bare except, so flush what was reported so far and exit
+	logger.info(message)
+	print(f"Aborting: {message}", file=sys.stderr)
+	try:
+		if memory.get('sink') != None:
+			memory['sink'].flush()
+		for handler in logger.handlers:
+			handler.flush()
+		sys.stdout.flush()
+		sys.stderr.flush()
+	except:
+		pass
+	os._exit(SYNC_MEMORY_EXIT_CODE)
+
+def sync_memory_create(report=False, budget_mb=None, top_count=SYNC_MEMORY_TOP_COUNT):
+	if report != True and budget_mb == None:
+		return None
+	import tracemalloc
+
+	memory = {}
+	memory['tracing'] = report == True
+	memory['top_count'] = top_count
+	memory['budget'] = None
+	memory['stage'] = None
+	memory['sink'] = None
+	memory['stages'] = []
+
+	if memory['tracing'] == True and not tracemalloc.is_tracing():
+		tracemalloc.start()
+
+	if budget_mb != None and sync_memory_rss_current() == 0:
+		logger.info("Resident memory cannot be measured on this platform; --memory_budget is not enforced")
+	elif budget_mb != None:
+		memory['budget'] = budget_mb * 1024 * 1024
+		memory['stop'] = threading.Event()
+		watchdog = threading.Thread(target=sync_memory_watchdog, args=(memory,), daemon=True)
+		watchdog.start()
+
+	return memory
+
+def sync_memory_stop(memory):
+	if memory == None:
+		return
+	import tracemalloc
+	if 'stop' in memory:
+		memory['stop'].set()
+	if memory['tracing'] == True:
+		tracemalloc.stop()
+	return
+
+def sync_memory_snapshot():
+	import tracemalloc
+	snapshot = tracemalloc.take_snapshot()
+	return snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+def sync_memory_stage_begin(memory, stage_name):
+	import tracemalloc
+	memory['stage'] = stage_name
+	memory['stage_rss'] = sync_memory_rss_current()
+	if memory['tracing'] == True:
+		tracemalloc.reset_peak()
+		memory['stage_traced'] = tracemalloc.get_traced_memory()[0]
+		memory['stage_snapshot'] = sync_memory_snapshot()
+	return
+
+def sync_memory_stage_end(memory, stage_name):
+	import tracemalloc
+	stage = {}
+	stage['name'] = stage_name
+	stage['rss_before'] = memory['stage_rss']
+	stage['rss_after'] = sync_memory_rss_current()
+	stage['rss_peak'] = sync_memory_rss_peak()
+	stage['retained'] = None
+	stage['peak'] = None
+	stage['top_sites'] = []
+
+	if memory['tracing'] == True:
+		current, peak = tracemalloc.get_traced_memory()
+		stage['retained'] = current - memory['stage_traced']
+		stage['peak'] = peak - memory['stage_traced']
+
+		# Compare against the snapshot from the start of the stage to find where retained memory was allocated
+		snapshot = sync_memory_snapshot()
+		differences = snapshot.compare_to(memory['stage_snapshot'], 'lineno')
+		for difference in differences[:memory['top_count']]:
+			frame = difference.traceback[0]
+			stage['top_sites'].append((difference.size_diff, difference.count_diff,
+				f"{frame.filename}:{frame.lineno}"))
+		memory['stage_snapshot'] = None
+
+	memory['stages'].append(stage)
+	memory['stage'] = None
+
+	return
+
+def sync_memory_report(memory):
+	if memory == None or len(memory['stages']) == 0:
+		return
+
+	print("")
+	print("Memory Summary")
+	print("---------------------------------------------------------------------------------------------------")
+	for stage in memory['stages']:
+		print("")
+		text = "Stage {}: resident {:.1f} MB -> {:.1f} MB, peak resident {:.1f} MB".format(stage['name'],
+			sync_memory_megabytes(stage['rss_before']), sync_memory_megabytes(stage['rss_after']),
+			sync_memory_megabytes(stage['rss_peak']))
+		if stage['retained'] != None:
+			text += ", retained {:.1f} MB, stage peak {:.1f} MB".format(sync_memory_megabytes(stage['retained']),
+				sync_memory_megabytes(stage['peak']))
+		print(text)
+		for size_diff, count_diff, site in stage['top_sites']:
+			print("  {:>10.1f} MB {:>10} blocks  {}".format(sync_memory_megabytes(size_diff), count_diff, site))
+	print("")
+
+	return
+
+def sync_instrumentation_report(instrumentation):
+	# Report the stages run since the last report and forget them, so the daemon and event receiver report each
+	# cycle or batch instead of holding every stage until they exit
+	profile = instrumentation.get(SYNC_INSTRUMENTATION_PROFILE)
+	memory = instrumentation.get(SYNC_INSTRUMENTATION_MEMORY)
+	sync_profile_report(profile)
+	sync_memory_report(memory)
+	if profile != None:
+		profile['stages'] = []
+	if memory != None:
+		memory['stages'] = []
+	return
+
+@contextlib.contextmanager
+def sync_stage(instrumentation, stage_name):
+	profile = instrumentation.get(SYNC_INSTRUMENTATION_PROFILE)
+	memory = instrumentation.get(SYNC_INSTRUMENTATION_MEMORY)
+	# With no instrumentation enabled, a stage is a bare yield
+	if profile == None and memory == None:
+		yield
+		return
+
+	if memory != None:
+		sync_memory_stage_begin(memory, stage_name)
+	profiler = None
+	if profile != None:
+		import cProfile
+		profiler = cProfile.Profile()
+	start = time.perf_counter()
+	if profiler != None:
+		profiler.enable()
+	try:
+		yield
+	finally:
+		if profiler != None:
+			profiler.disable()
+			sync_profile_stage_write(profile, stage_name, profiler, time.perf_counter() - start)
+		if memory != None:
+			sync_memory_stage_end(memory, stage_name)
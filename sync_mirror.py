@@ -0,0 +1,323 @@
+# SQLite mirror of the ServiceNow and NetIM data for sync_servicenow.py, compared with SQL joins
+
+import logging
+import time
+
+from sync_servicenow import NETIM_DEVICE_NAME, NETIM_DEVICE_DEVICENAME, NETIM_DEVICE_DISPLAYNAME, \
+	NETIM_DEVICE_ACCESSADDRESS, NETIM_DEVICE_GROUP, NETIM_DEVICE_CMDB_ID, NETIM_DEVICE_CLASS, NETIM_SITE_NAME, \
+	NETIM_SITE_COUNTRY, NETIM_SITE_REGION, NETIM_SITE_CITY, NETIM_SITE_LATITUDE, NETIM_SITE_LONGITUDE, \
+	SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_NEW, SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_DIFFERENT, \
+	SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_NO_UPDATES, SYNC_SERVICENOW_NETIM_COMPARISON_SITES_NEW, \
+	SYNC_SERVICENOW_NETIM_COMPARISON_SITES_EXISTING, SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_MATCH, \
+	SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_COUNTRY_EMPTY, \
+	SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_COUNTRY_NOT_FOUND, \
+	SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_REGION_EMPTY, \
+	SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_REGION_NOT_FOUND, \
+	SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_CITY_EMPTY, SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_CITY_NOT_FOUND, \
+	SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_COORDINATES_MISSING, sync_servicenow_netim_device_name_key, \
+	sync_netim_device_address, sync_netim_devices_external_records, NETIM_COUNTRY_NAME, NETIM_COUNTRY_ID, \
+	NETIM_REGION_NAME, NETIM_REGION_ID, NETIM_CITY_NAME, NETIM_CITY_ID
+
+logger = logging.getLogger(__name__)
+
+
+#----- SQLite mirror functions
+
+SYNC_MIRROR_VERSION = '2'
+
+# Regions and cities are requested again once they have been in the mirror this many seconds
+SYNC_MIRROR_GEO_MAX_AGE = 86400
+
+# Names are indexed by the same normalized key as the in-memory comparison (sync_servicenow_netim_device_name_key)
+SYNC_MIRROR_SCHEMA = [
+	'CREATE TABLE IF NOT EXISTS mirror_state (key TEXT PRIMARY KEY, value TEXT)',
+	'CREATE TABLE IF NOT EXISTS servicenow_devices (name TEXT PRIMARY KEY, name_key TEXT, address TEXT, site TEXT, ' \
+		'cmdb_ci TEXT, device_class TEXT)',
+	'CREATE INDEX IF NOT EXISTS servicenow_devices_name_key ON servicenow_devices (name_key)',
+	'CREATE INDEX IF NOT EXISTS servicenow_devices_address ON servicenow_devices (address)',
+	'CREATE INDEX IF NOT EXISTS servicenow_devices_site ON servicenow_devices (site)',
+	'CREATE INDEX IF NOT EXISTS servicenow_devices_cmdb_ci ON servicenow_devices (cmdb_ci)',
+	'CREATE TABLE IF NOT EXISTS servicenow_device_addresses (name TEXT, address TEXT, PRIMARY KEY (name, address))',
+	'CREATE INDEX IF NOT EXISTS servicenow_device_addresses_address ON servicenow_device_addresses (address)',
+	'CREATE TABLE IF NOT EXISTS servicenow_locations (name TEXT PRIMARY KEY, city TEXT, region TEXT, country TEXT, ' \
+		'latitude TEXT, longitude TEXT)',
+	'CREATE INDEX IF NOT EXISTS servicenow_locations_geo ON servicenow_locations (country, region, city)',
+	'CREATE TABLE IF NOT EXISTS netim_devices (seq INTEGER PRIMARY KEY, id, name TEXT, display_name TEXT, ' \
+		'device_name TEXT, address TEXT)',
+	'CREATE INDEX IF NOT EXISTS netim_devices_id ON netim_devices (id)',
+	'CREATE INDEX IF NOT EXISTS netim_devices_address ON netim_devices (address)',
+	'CREATE TABLE IF NOT EXISTS netim_device_names (name_key TEXT, seq INTEGER, PRIMARY KEY (name_key, seq))',
+	'CREATE TABLE IF NOT EXISTS netim_groups (name TEXT PRIMARY KEY, id)',
+	'CREATE TABLE IF NOT EXISTS netim_countries (id PRIMARY KEY, name TEXT)',
+	'CREATE INDEX IF NOT EXISTS netim_countries_name ON netim_countries (name)',
+	'CREATE TABLE IF NOT EXISTS netim_regions (country_id, id, name TEXT, PRIMARY KEY (country_id, id))',
+	'CREATE INDEX IF NOT EXISTS netim_regions_name ON netim_regions (country_id, name)',
+	'CREATE TABLE IF NOT EXISTS netim_cities (region_id, id, name TEXT, PRIMARY KEY (region_id, id))',
+	'CREATE INDEX IF NOT EXISTS netim_cities_name ON netim_cities (region_id, name)',
+	'CREATE TABLE IF NOT EXISTS netim_geo_loaded (kind TEXT, id, loaded REAL, PRIMARY KEY (kind, id))',
+	'CREATE TABLE IF NOT EXISTS device_comparison (name TEXT PRIMARY KEY, category TEXT)',
+	'CREATE TABLE IF NOT EXISTS site_comparison (name TEXT PRIMARY KEY, category TEXT)',
+	'CREATE TABLE IF NOT EXISTS location_validation (name TEXT, category TEXT, PRIMARY KEY (name, category))']
+
+SYNC_MIRROR_DEVICES_COMPARISON = '''
+	WITH matched AS (
+		SELECT s.name, (SELECT n.seq FROM netim_device_names n WHERE n.name_key = s.name_key
+			ORDER BY n.seq LIMIT 1) AS netim_seq
+		FROM servicenow_devices s)
+	SELECT m.name, CASE
+		WHEN m.netim_seq IS NULL THEN 'new_device'
+		WHEN EXISTS (SELECT 1 FROM servicenow_device_addresses a JOIN netim_devices d ON d.seq = m.netim_seq
+			WHERE a.name = m.name AND a.address = d.address) THEN 'no_updates'
+		ELSE 'different_address' END
+	FROM matched m ORDER BY m.name'''
+
+SYNC_MIRROR_SITES_COMPARISON = '''
+	SELECT l.name, CASE WHEN EXISTS (SELECT 1 FROM netim_groups g WHERE g.name = l.name) THEN 'existing_site'
+		ELSE 'new_site' END
+	FROM servicenow_locations l ORDER BY l.name'''
+
+# The first country and region with a name is used, as with the lists from NetIM
+SYNC_MIRROR_LOCATION_VALIDATION = '''
+	WITH site_countries AS (
+		SELECT l.*, (SELECT c.id FROM netim_countries c WHERE c.name = l.country ORDER BY c.rowid LIMIT 1) AS country_id
+		FROM servicenow_locations l),
+	site_regions AS (
+		SELECT s.*, (SELECT r.id FROM netim_regions r WHERE r.country_id = s.country_id AND r.name = s.region
+			ORDER BY r.rowid LIMIT 1) AS region_id
+		FROM site_countries s)
+	SELECT s.name, s.latitude, s.longitude, s.country, s.country_id, s.region, s.region_id, s.city,
+		EXISTS (SELECT 1 FROM netim_cities c WHERE c.region_id = s.region_id AND c.name = s.city) AS city_found
+	FROM site_regions s ORDER BY s.name'''
+
+SYNC_MIRROR_REGIONS_MISSING = '''
+	SELECT DISTINCT c.id FROM servicenow_locations l JOIN netim_countries c ON c.name = l.country
+	WHERE l.region != '' AND NOT EXISTS (SELECT 1 FROM netim_geo_loaded g WHERE g.kind = 'regions' AND g.id = c.id
+		AND g.loaded >= ?)'''
+
+SYNC_MIRROR_CITIES_MISSING = '''
+	SELECT DISTINCT r.id FROM servicenow_locations l JOIN netim_countries c ON c.name = l.country
+	JOIN netim_regions r ON r.country_id = c.id AND r.name = l.region
+	WHERE l.city != '' AND NOT EXISTS (SELECT 1 FROM netim_geo_loaded g WHERE g.kind = 'cities' AND g.id = r.id
+		AND g.loaded >= ?)'''
+
+def sync_mirror_open(mirror_file):
+	import sqlite3
+	connection = sqlite3.connect(mirror_file)
+	with connection:
+		connection.execute(SYNC_MIRROR_SCHEMA[0])
+		# Mirrors from an earlier version have no load times for the regions and cities, so they are loaded again
+		if sync_mirror_state_get(connection, 'version') != SYNC_MIRROR_VERSION:
+			connection.execute('DROP TABLE IF EXISTS netim_geo_loaded')
+		for statement in SYNC_MIRROR_SCHEMA:
+			connection.execute(statement)
+		connection.execute('INSERT OR REPLACE INTO mirror_state (key, value) VALUES (?, ?)',
+			('version', SYNC_MIRROR_VERSION))
+	return connection
+
+def sync_mirror_state_get(connection, key):
+	row = connection.execute('SELECT value FROM mirror_state WHERE key = ?', (key,)).fetchone()
+	if row == None:
+		return None
+	return row[0]
+
+def sync_mirror_state_set(connection, key, value):
+	connection.execute('INSERT OR REPLACE INTO mirror_state (key, value) VALUES (?, ?)', (key, value))
+	return
+
+def sync_mirror_table_refresh(connection, table, key_columns, value_columns, rows):
+	# Bring a table in line with rows (key values followed by other values): new and changed rows are written and
+	# rows that are no longer present are deleted, so unchanged rows are not touched; returns the rows changed
+	columns = key_columns + value_columns
+	keys = ', '.join(key_columns)
+
+	connection.execute('DROP TABLE IF EXISTS temp.mirror_keys')
+	connection.execute(f'CREATE TEMP TABLE mirror_keys ({keys}, PRIMARY KEY ({keys}))')
+	key_count = len(key_columns)
+	connection.executemany(f"INSERT OR IGNORE INTO temp.mirror_keys VALUES ({', '.join(['?'] * key_count)})",
+		(row[:key_count] for row in rows))
+	changes = connection.total_changes
+
+	statement = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['?'] * len(columns))}) " \
+		f"ON CONFLICT ({keys}) DO "
+	if len(value_columns) == 0:
+		statement += 'NOTHING'
+	else:
+		statement += 'UPDATE SET ' + ', '.join(f'{column} = excluded.{column}' for column in value_columns) + \
+			' WHERE ' + ' OR '.join(f'{column} IS NOT excluded.{column}' for column in value_columns)
+	connection.executemany(statement, rows)
+
+	connection.execute(f'DELETE FROM {table} WHERE ({keys}) NOT IN (SELECT {keys} FROM temp.mirror_keys)')
+	connection.execute('DROP TABLE temp.mirror_keys')
+
+	return connection.total_changes - changes
+
+def sync_mirror_servicenow_refresh(connection, converted_devices, converted_sites, devices_with_access_addresses=None):
+	device_rows = []
+	address_rows = []
+	for device in converted_devices:
+		device_name = device[NETIM_DEVICE_NAME]
+		device_rows.append((device_name, sync_servicenow_netim_device_name_key(device_name),
+			device[NETIM_DEVICE_ACCESSADDRESS], device[NETIM_DEVICE_GROUP], device[NETIM_DEVICE_CMDB_ID],
+			device.get(NETIM_DEVICE_CLASS, '')))
+		if devices_with_access_addresses != None and device_name in devices_with_access_addresses:
+			addresses = devices_with_access_addresses[device_name]
+		else:
+			addresses = [device[NETIM_DEVICE_ACCESSADDRESS]]
+		for address in addresses:
+			address_rows.append((device_name, address))
+
+	site_rows = []
+	for site in converted_sites:
+		site_rows.append((site[NETIM_SITE_NAME].strip(), site[NETIM_SITE_CITY], site[NETIM_SITE_REGION],
+			site[NETIM_SITE_COUNTRY], site[NETIM_SITE_LATITUDE], site[NETIM_SITE_LONGITUDE]))
+
+	with connection:
+		changes = sync_mirror_table_refresh(connection, 'servicenow_devices', ['name'],
+			['name_key', 'address', 'site', 'cmdb_ci', 'device_class'], device_rows)
+		changes += sync_mirror_table_refresh(connection, 'servicenow_device_addresses', ['name', 'address'], [],
+			address_rows)
+		changes += sync_mirror_table_refresh(connection, 'servicenow_locations', ['name'],
+			['city', 'region', 'country', 'latitude', 'longitude'], site_rows)
+	logger.info(f"Mirrored ServiceNow devices and locations with {changes} change(s)")
+
+	return changes
+
+def sync_mirror_netim_refresh(connection, inventory):
+	# The NetIM devices are only written again when the inventory is not the one already mirrored
+	signature = f"{inventory.loaded}:{len(inventory.devices)}:{inventory.fingerprint}"
+
+	with connection:
+		group_rows = [(group_name, group.get('id')) for group_name, group in inventory.groups.items()]
+		changes = sync_mirror_table_refresh(connection, 'netim_groups', ['name'], ['id'], group_rows)
+
+		if sync_mirror_state_get(connection, 'netim_inventory') != signature:
+			connection.execute('DELETE FROM netim_devices')
+			connection.execute('DELETE FROM netim_device_names')
+			device_rows = []
+			for sequence, netim_device in enumerate(inventory.devices):
+				device_rows.append((sequence, netim_device.get('id'), netim_device.get(NETIM_DEVICE_NAME),
+					netim_device.get(NETIM_DEVICE_DISPLAYNAME), netim_device.get(NETIM_DEVICE_DEVICENAME),
+					sync_netim_device_address(netim_device)))
+			connection.executemany('INSERT INTO netim_devices VALUES (?, ?, ?, ?, ?, ?)', device_rows)
+			connection.executemany('INSERT OR IGNORE INTO netim_device_names VALUES (?, ?)',
+				((key, sequence) for key, sequence, address in sync_netim_devices_external_records(inventory.devices)))
+			sync_mirror_state_set(connection, 'netim_inventory', signature)
+			changes += len(device_rows)
+	logger.info(f"Mirrored NetIM devices and groups with {changes} change(s)")
+
+	return changes
+
+def sync_mirror_geo_items(response):
+	if response != None and 'items' in response:
+		return response['items']
+	return None
+
+def sync_mirror_geo_refresh(connection, netim, max_age=SYNC_MIRROR_GEO_MAX_AGE):
+	# Countries, regions and cities are reference data, so they are only requested for what the mirror lacks or
+	# has held for longer than max_age seconds
+	now = time.time()
+	with connection:
+		if connection.execute("SELECT 1 FROM netim_geo_loaded WHERE kind = 'countries' AND loaded >= ?",
+			(now - max_age,)).fetchone() == None:
+			countries = sync_mirror_geo_items(netim.get_all_countries())
+			if countries != None:
+				connection.execute('DELETE FROM netim_countries')
+				connection.executemany('INSERT OR REPLACE INTO netim_countries VALUES (?, ?)',
+					[(country[NETIM_COUNTRY_ID], country[NETIM_COUNTRY_NAME]) for country in countries])
+				connection.execute("INSERT OR REPLACE INTO netim_geo_loaded VALUES ('countries', 0, ?)", (now,))
+
+		for (country_id,) in connection.execute(SYNC_MIRROR_REGIONS_MISSING, (now - max_age,)).fetchall():
+			regions = sync_mirror_geo_items(netim.get_regions_by_country_id(country_id))
+			if regions != None:
+				connection.execute('DELETE FROM netim_regions WHERE country_id = ?', (country_id,))
+				connection.executemany('INSERT OR REPLACE INTO netim_regions VALUES (?, ?, ?)',
+					[(country_id, region[NETIM_REGION_ID], region[NETIM_REGION_NAME]) for region in regions])
+				connection.execute("INSERT OR REPLACE INTO netim_geo_loaded VALUES ('regions', ?, ?)",
+					(country_id, now))
+
+		for (region_id,) in connection.execute(SYNC_MIRROR_CITIES_MISSING, (now - max_age,)).fetchall():
+			cities = sync_mirror_geo_items(netim.get_cities_by_region_id(region_id))
+			if cities != None:
+				connection.execute('DELETE FROM netim_cities WHERE region_id = ?', (region_id,))
+				connection.executemany('INSERT OR REPLACE INTO netim_cities VALUES (?, ?, ?)',
+					[(region_id, city[NETIM_CITY_ID], city[NETIM_CITY_NAME]) for city in cities])
+				connection.execute("INSERT OR REPLACE INTO netim_geo_loaded VALUES ('cities', ?, ?)",
+					(region_id, now))
+	return
+
+def sync_mirror_names(compared_records, records, name_field):
+	# The mirror holds every record; when only some are compared (see --snapshot), the names of those
+	if compared_records is records:
+		return None
+	return set(record[name_field].strip() for record in compared_records)
+
+def sync_mirror_results_save(connection, table, comparison_dict, names=None):
+	# Keep the latest comparison of every record in the mirror for queries between runs, and return the
+	# results for the names asked for
+	with connection:
+		connection.execute(f'DELETE FROM {table}')
+		for category, category_names in comparison_dict.items():
+			connection.executemany(f'INSERT OR IGNORE INTO {table} VALUES (?, ?)',
+				[(name, category) for name in category_names])
+
+	if names == None:
+		return comparison_dict
+	return {category:[name for name in category_names if name in names] \
+		for category, category_names in comparison_dict.items()}
+
+def sync_mirror_devices_comparison(connection, names=None):
+	comparison_dict = {}
+	comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_NEW] = []
+	comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_DIFFERENT] = []
+	comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_NO_UPDATES] = []
+
+	for device_name, category in connection.execute(SYNC_MIRROR_DEVICES_COMPARISON):
+		comparison_dict[category].append(device_name)
+
+	return sync_mirror_results_save(connection, 'device_comparison', comparison_dict, names)
+
+def sync_mirror_sites_comparison(connection, names=None):
+	comparison_dict = {}
+	comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_SITES_EXISTING] = []
+	comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_SITES_NEW] = []
+
+	for site_name, category in connection.execute(SYNC_MIRROR_SITES_COMPARISON):
+		comparison_dict[category].append(site_name)
+
+	return sync_mirror_results_save(connection, 'site_comparison', comparison_dict, names)
+
+def sync_mirror_location_validation(connection, netim, names=None):
+	comparison_dict = {}
+	comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_MATCH] = []
+	comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_COUNTRY_EMPTY] = []
+	comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_COUNTRY_NOT_FOUND] = []
+	comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_REGION_EMPTY] = []
+	comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_REGION_NOT_FOUND] = []
+	comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_CITY_EMPTY] = []
+	comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_CITY_NOT_FOUND] = []
+	comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_COORDINATES_MISSING] = []
+
+	sync_mirror_geo_refresh(connection, netim)
+
+	for site_name, latitude, longitude, country, country_id, region, region_id, city, city_found in \
+		connection.execute(SYNC_MIRROR_LOCATION_VALIDATION).fetchall():
+		if latitude == '' or longitude == '':
+			comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_COORDINATES_MISSING].append(site_name)
+
+		if country == '':
+			category = SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_COUNTRY_EMPTY
+		elif country_id == None:
+			category = SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_COUNTRY_NOT_FOUND
+		elif region == '':
+			category = SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_REGION_EMPTY
+		elif region_id == None:
+			category = SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_REGION_NOT_FOUND
+		elif city == '':
+			category = SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_CITY_EMPTY
+		elif city_found == 0:
+			category = SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_CITY_NOT_FOUND
+		else:
+			category = SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_MATCH
+		comparison_dict[category].append(site_name)
+
+	return sync_mirror_results_save(connection, 'location_validation', comparison_dict, names)
@@ -6,20 +6,38 @@
 # * Date/time of synchronization
 
 import argparse
+import bisect
+import collections
+import contextlib
+import copy
 import csv
 import datetime
+import functools
+import gc
 import getpass
+import hashlib
+import heapq
+import io
+import ipaddress
+import json
 import logging
+import os
+import re
 import sys
+import tempfile
+import threading
 import time
 import yaml
 
-from ServiceNowAPI.servicenow import ServiceNow
+from sync_instrumentation import sync_stage, sync_instrumentation_report, SYNC_INSTRUMENTATION_PROFILE, \
+	SYNC_INSTRUMENTATION_MEMORY, SYNC_PROFILE_TOP_COUNT, SYNC_MEMORY_TOP_COUNT, sync_profile_create, \
+	sync_memory_create, sync_memory_stop
 
-import steelscript
-from steelscript.common.service import UserAuth, Auth
-from steelscript.common.exceptions import RvbdHTTPException
-from steelscript.netim.core import NetIM
+# The ServiceNow client (and requests) and steelscript with its reschema/sleepwalker stack are imported when
+# first authenticating, so runs that never use them (CSV input, --validate_only) do not pay for loading them
+# Likewise, the modules behind optional features (worker pools, the HTTP receivers, profiling and memory tracing)
+# and the feature modules next to this script (sync_mirror, sync_daemon, sync_events, sync_shards and
+# sync_targets) are imported by the functions that use them
 
 logging.captureWarnings(True)
 logger = logging.getLogger(__name__)
@@ -53,19 +71,186 @@ def read_from_csv(file_path):
 
 	return fields, rows
 
-def dictionary_from_csv(file_path):
+def dictionary_from_csv(file_path, workers=None):
+
+	# Large files are split across worker processes
+	if workers != None and workers > 1:
+		try:
+			if os.path.getsize(file_path) >= CSV_PARALLEL_MIN_SIZE:
+				return dictionary_from_csv_parallel(file_path, workers)
+		except OSError:
+			pass
 
 	reader = None
-	fields = []
 	rows = []
+	# Line where the record being read starts, for error reporting
+	record_line = 1
 	try:
 		with open(file_path, encoding=CSV_ENCODING, errors='replace') as file:
 			reader = csv.DictReader(file, skipinitialspace=True, quoting=csv.QUOTE_MINIMAL)
-			rows = list(reader)
+			# Reading the field names consumes the header, so the first record starts after it
+			if reader.fieldnames != None:
+				record_line = reader.line_num + 1
+			for row in reader:
+				rows.append(row)
+				record_line = reader.line_num + 1
 	except:
-		logger.debug(f"Error reading file {file_path}")
+		logger.debug(f"Error reading file {file_path} at line {record_line}")
 		logger.debug("Unexpected error {}".format(sys.exc_info()[0]))
+		rows = []
+
+	return rows
+
+# Files smaller than this are read in one process; the scan for chunk boundaries reads this much at a time
+CSV_PARALLEL_MIN_SIZE = 64 * 1024 * 1024
+CSV_SCAN_BLOCK_SIZE = 16 * 1024 * 1024
+
+def csv_chunk_boundaries(file_path, chunk_count):
+	# Find where records start near each of chunk_count equal byte ranges: a newline ends a record when an even
+	# number of quote characters precede it, which holds for RFC 4180 files (a field with a quote, comma or
+	# newline in it is quoted and its quotes are doubled). Returns the end of the header and (start, end) for
+	# each chunk. Files that are not RFC 4180 can be cut inside a record, which csv_chunk_parse() detects.
+	file_size = os.path.getsize(file_path)
+	targets = [0] + [file_size * chunk_index // chunk_count for chunk_index in range(1, chunk_count)]
+	boundaries = []
+
+	position = 0
+	quotes = 0
+	with open(file_path, 'rb') as file:
+		while len(boundaries) < len(targets):
+			block = file.read(CSV_SCAN_BLOCK_SIZE)
+			if len(block) == 0:
+				break
+
+			counted = 0
+			block_quotes = quotes
+			search = 0
+			while len(boundaries) < len(targets):
+				target = targets[len(boundaries)]
+				if len(boundaries) > 0:
+					target = max(target, boundaries[-1])
+				search = max(search, target - position)
+				if search >= len(block):
+					break
+				newline = block.find(b'\n', search)
+				if newline == -1:
+					break
+
+				block_quotes += block.count(b'"', counted, newline)
+				counted = newline + 1
+				search = newline + 1
+				if block_quotes % 2 == 0:
+					boundaries.append(position + newline + 1)
+
+			quotes += block.count(b'"')
+			position += len(block)
+
+	if len(boundaries) == 0:
+		# No record ends in the file; it is all header
+		return file_size, []
+
+	header_end = boundaries[0]
+	chunks = []
+	for boundary_index, start in enumerate(boundaries):
+		if boundary_index + 1 < len(boundaries):
+			end = boundaries[boundary_index + 1]
+		else:
+			end = file_size
+		if end > start:
+			chunks.append((start, end))
+
+	return header_end, chunks
+
+# Parsed chunks are sent back as one string with these separators, which is far quicker to pass between
+# processes than a list of lists of strings
+CSV_RECORD_SEPARATOR = '\x1e'
+CSV_UNIT_SEPARATOR = '\x1f'
+# Row added after each chunk; it is only read back as a row of its own if the chunk ends outside a quoted field
+CSV_CHUNK_END = '\x1d\x1d'
+
+def csv_chunk_rows_parse(text, field_count=None):
+	# Returns the rows of text, or None unless text ends between records and every row has field_count values
+	if CSV_CHUNK_END in text:
+		return None
+
+	rows = []
+	reader = csv.reader(io.StringIO(text + '\n' + CSV_CHUNK_END + '\n', newline=None), skipinitialspace=True,
+		quoting=csv.QUOTE_MINIMAL)
+	try:
+		for row in reader:
+			# As csv.DictReader does, skip rows with no values at all
+			if row != []:
+				rows.append(row)
+	except csv.Error:
+		return None
+
+	if len(rows) == 0 or rows.pop() != [CSV_CHUNK_END]:
+		return None
+	if field_count != None and any(len(row) != field_count for row in rows):
+		return None
+	return rows
+
+def csv_chunk_parse(file_path, start, end, field_count):
+	# Parse one byte range of records; returns the rows (encoded when possible) and the number of rows, or None
+	# when the chunk does not parse cleanly and the file has to be read in one process instead
+	with open(file_path, 'rb') as file:
+		file.seek(start)
+		text = file.read(end - start).decode(CSV_ENCODING, errors='replace')
+
+	rows = csv_chunk_rows_parse(text, field_count)
+	if rows == None:
+		return None, 0
+
+	if CSV_RECORD_SEPARATOR in text or CSV_UNIT_SEPARATOR in text:
+		return rows, len(rows)
+	return CSV_RECORD_SEPARATOR.join(CSV_UNIT_SEPARATOR.join(row) for row in rows), len(rows)
+
+def csv_chunk_rows(chunk_rows, row_count):
+	if type(chunk_rows) is not str:
+		return chunk_rows
+	if row_count == 0:
+		return []
+	return [record.split(CSV_UNIT_SEPARATOR) for record in chunk_rows.split(CSV_RECORD_SEPARATOR)]
+
+def dictionary_from_csv_parallel(file_path, workers):
+	# Same rows as dictionary_from_csv(), parsed by worker processes from chunks cut at record boundaries and
+	# put back together in file order. Any chunk that does not parse cleanly, with every row having a value for
+	# each field, sends the whole file back to the single-process reader, which also reports errors.
+	import concurrent.futures
+	header_end, chunks = csv_chunk_boundaries(file_path, workers * 4)
+
+	with open(file_path, 'rb') as file:
+		header = file.read(header_end).decode(CSV_ENCODING, errors='replace')
+	header_rows = csv_chunk_rows_parse(header)
+	if header_rows == None or len(header_rows) != 1:
+		logger.info(f"Unable to split {file_path} into chunks; reading it in one process")
+		return dictionary_from_csv(file_path)
+	fields = header_rows[0]
+
+	rows = []
+	aligned = True
+	# Millions of new rows would otherwise set off repeated garbage collections of everything read so far
+	gc_enabled = gc.isenabled()
+	gc.disable()
+	try:
+		with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+			chunk_results = executor.map(csv_chunk_parse, [file_path] * len(chunks), [chunk[0] for chunk in chunks],
+				[chunk[1] for chunk in chunks], [len(fields)] * len(chunks))
+			for chunk_rows, row_count in chunk_results:
+				if chunk_rows == None:
+					aligned = False
+					executor.shutdown(wait=False, cancel_futures=True)
+					break
+				rows.extend(dict(zip(fields, row)) for row in csv_chunk_rows(chunk_rows, row_count))
+	finally:
+		if gc_enabled == True:
+			gc.enable()
 
+	if aligned == False:
+		logger.info(f"Chunks of {file_path} do not parse cleanly on their own; reading it in one process")
+		return dictionary_from_csv(file_path)
+
+	logger.info(f"Read {len(rows)} rows from {file_path} in {len(chunks)} chunks with {workers} processes")
 	return rows
 
 def yamlread(filename):
@@ -236,77 +421,620 @@ def sync_servicenow_devices_filter(devices, include_filters=[], exclude_filters=
 	filtered_devices = [device for device in included_devices if device not in excluded_devices]
 	return filtered_devices
 
-def sync_servicenow_api_devices_import(servicenow, include_filters=[], exclude_filters=[]):
+def sync_servicenow_record_field_value(record, field):
+	if field not in record:
+		return None
+	if type(record[field]) is dict:
+		return record[field].get('value')
+	return record[field]
+
+SYNC_SERVICENOW_RECORD_INTERN_LENGTH = 64
+
+def sync_servicenow_record_compact(record):
+	# Canonical form of a streamed record: reference links are dropped and field names and short values
+	# (classes, statuses, locations) are shared between records instead of repeated per record
+	compact = {}
+	for field, value in record.items():
+		if type(value) is dict:
+			value = {sys.intern(key):sync_servicenow_record_compact_value(item) for key, item in value.items()
+				if key != 'link'}
+		else:
+			value = sync_servicenow_record_compact_value(value)
+		compact[sys.intern(field)] = value
+	return compact
+
+def sync_servicenow_record_compact_value(value):
+	if type(value) is str and len(value) <= SYNC_SERVICENOW_RECORD_INTERN_LENGTH:
+		return sys.intern(value)
+	return value
+
+def sync_servicenow_api_records_refresh_full(cache, full_refresh):
+	return cache == None or full_refresh == True or cache['watermark'] == None
+
+def sync_servicenow_api_records_refresh_parameters(parameters, cache, full_refresh):
+	if sync_servicenow_api_records_refresh_full(cache, full_refresh):
+		return parameters
+
+	# Add the watermark to any existing query, since only one sysparm_query is honored
+	update_query = f"sys_updated_on>={cache['watermark']}"
+	update_parameters = []
+	for parameter in parameters:
+		if parameter.get('name') == 'sysparm_query':
+			update_query = f"{parameter['value']}^{update_query}"
+		else:
+			update_parameters.append(parameter)
+	update_parameters.append({'name':'sysparm_query', 'value':update_query})
+
+	return update_parameters
+
+def sync_servicenow_api_records_prune(get_records, parameters, cache):
+	# Records deleted in ServiceNow never show up as updated, so list the sys_ids that still match the query and
+	# drop the cached records that are not among them; if the listing fails, the cache is kept as it is
+	existing_parameters = [parameter for parameter in parameters \
+		if parameter.get('name') not in ['sysparm_fields', 'sysparm_display_value', 'sysparm_exclude_reference_link']]
+	existing_parameters.append({'name':'sysparm_fields', 'value':'sys_id'})
+	existing_parameters.append({'name':'sysparm_exclude_reference_link', 'value':'true'})
+	records = get_records(parameters=existing_parameters)
+	if records == None:
+		logger.info("Unable to list the records in ServiceNow; keeping {} cached record(s)".format(
+			len(cache['records'])))
+		return
+
+	existing_sys_ids = set(sync_servicenow_record_field_value(record, 'sys_id') for record in records)
+	removed_sys_ids = [sys_id for sys_id in cache['records'] if sys_id not in existing_sys_ids]
+	for sys_id in removed_sys_ids:
+		del cache['records'][sys_id]
+	if len(removed_sys_ids) > 0:
+		logger.info("Dropped {} cached record(s) no longer in ServiceNow".format(len(removed_sys_ids)))
+	return
+
+def sync_servicenow_api_records_refresh(get_records, parameters, cache, full_refresh):
+	# Without a cache, or on a full refresh, get every record; otherwise only ask for records updated since
+	# the newest record seen so far. The watermark is inclusive, so records at the boundary are fetched again.
+	incremental = not sync_servicenow_api_records_refresh_full(cache, full_refresh)
+	if incremental == False:
+		records = get_records(parameters=parameters)
+		if records == None or cache == None:
+			return records
+		cache['records'] = {}
+	else:
+		records = get_records(parameters=sync_servicenow_api_records_refresh_parameters(parameters, cache,
+			full_refresh))
+		if records == None:
+			return None
+
+	for record in records:
+		sys_id = sync_servicenow_record_field_value(record, 'sys_id')
+		cache['records'][sys_id] = record
+		updated = sync_servicenow_record_field_value(record, 'sys_updated_on')
+		if updated != None and (cache['watermark'] == None or updated > cache['watermark']):
+			cache['watermark'] = updated
+	if incremental == True:
+		sync_servicenow_api_records_prune(get_records, parameters, cache)
+	logger.info("Refreshed {} record(s) from ServiceNow; {} cached".format(len(records), len(cache['records'])))
+
+	return list(cache['records'].values())
+
+SYNC_SERVICENOW_CLASS_TABLES_PAGE_SIZE = 10000
+SYNC_SERVICENOW_CLASS_TABLES_WORKERS = 4
+
+def sync_servicenow_class_tables_get(config, include_filters=[], exclude_filters=[]):
+	# class_tables:
+	#   - cmdb_ci_ip_switch
+	#   - name: cmdb_ci_ip_router
+	#     fields: [u_site_code]                  (in addition to the fields the synchronization uses)
+	#     page_size: 5000
+	class_tables = []
+	if config == None or config.get('class_tables') == None:
+		return class_tables
+
+	# Fields used by input validation, filters and incremental refresh
+	required_fields = [SYNC_SERVICENOW_INPUT_API_DEVICES_NAME, SYNC_SERVICENOW_INPUT_API_DEVICES_CLASS,
+		SYNC_SERVICENOW_INPUT_API_DEVICES_LOCATION, SYNC_SERVICENOW_INPUT_API_DEVICES_ADDRESS,
+		SYNC_SERVICENOW_INPUT_API_DEVICES_ID, SYNC_SERVICENOW_INPUT_API_DEVICES_STATUS,
+		SYNC_SERVICENOW_INPUT_API_DEVICES_MANUFACTURER, SYNC_SERVICENOW_INPUT_API_DEVICES_MODEL,
+		SYNC_SERVICENOW_INPUT_API_DEVICES_MONITOR, 'sys_updated_on']
+	for device_filter in list(include_filters) + list(exclude_filters):
+		filter_name, filter_value = filter_name_value_pair_get(device_filter)
+		if filter_name != None and filter_name not in required_fields:
+			required_fields.append(filter_name)
+
+	for class_table in config['class_tables']:
+		if type(class_table) is dict:
+			name = class_table.get('name')
+			extra_fields = class_table.get('fields', [])
+			page_size = class_table.get('page_size', SYNC_SERVICENOW_CLASS_TABLES_PAGE_SIZE)
+		else:
+			name = class_table
+			extra_fields = []
+			page_size = SYNC_SERVICENOW_CLASS_TABLES_PAGE_SIZE
+		if name == None or name == '':
+			logger.info(f"Invalid class table {class_table}")
+			continue
+		fields = required_fields + [field for field in extra_fields if field not in required_fields]
+		class_tables.append({'name':name, 'fields':fields, 'page_size':page_size})
+
+	return class_tables
+
+def sync_servicenow_api_class_table_parameters(servicenow, class_table):
 
-	# Get all configuration items from ServiceNow
 	parameters = []
 	parameters.append({'name':'sysparm_display_value', 'value':'all'})
-	devices = servicenow.get_configuration_items(parameters=parameters)
+	parameters.append({'name':'sysparm_fields', 'value':','.join(class_table['fields'])})
+
+	def get_configuration_items(parameters=[]):
+		return servicenow.get_configuration_items_by_class(class_table['name'], parameters=parameters,
+			page_size=class_table['page_size'])
+
+	return get_configuration_items, parameters
+
+def sync_servicenow_api_class_table_import(servicenow, class_table, context=None):
+
+	get_configuration_items, parameters = sync_servicenow_api_class_table_parameters(servicenow, class_table)
+
+	if context == None:
+		devices = get_configuration_items(parameters=parameters)
+	else:
+		devices = sync_servicenow_api_records_refresh(get_configuration_items, parameters,
+			context['servicenow_class_tables'][class_table['name']], context['full_refresh'])
+	if devices == None:
+		logger.info(f"Failed to get configuration items from {class_table['name']}")
+		devices = []
+	logger.info("There are {} configuration items in {}".format(len(devices), class_table['name']))
+
+	return devices
+
+def sync_servicenow_api_class_table_cached(servicenow, class_table, context=None):
+	# The pre-flight counted nothing to fetch; an incremental cycle keeps the cached records that still exist, a
+	# full refresh has none
+	if context == None:
+		return []
+	cache = context['servicenow_class_tables'][class_table['name']]
+	if sync_servicenow_api_records_refresh_full(cache, context['full_refresh']):
+		cache['records'] = {}
+		cache['watermark'] = None
+	elif len(cache['records']) > 0:
+		get_configuration_items, parameters = sync_servicenow_api_class_table_parameters(servicenow, class_table)
+		sync_servicenow_api_records_prune(get_configuration_items, parameters, cache)
+	logger.info("There are {} cached configuration items in {}".format(len(cache['records']), class_table['name']))
+
+	return list(cache['records'].values())
+
+def sync_servicenow_api_class_tables_import(servicenow, class_tables, context=None,
+	workers=SYNC_SERVICENOW_CLASS_TABLES_WORKERS, empty_class_tables=[]):
+	import concurrent.futures
+
+	# Each table keeps its own cache and watermark; create them before the workers start
+	if context != None:
+		for class_table in class_tables:
+			if class_table['name'] not in context['servicenow_class_tables']:
+				context['servicenow_class_tables'][class_table['name']] = {'records':{}, 'watermark':None}
+
+	fetched_tables = [class_table for class_table in class_tables if class_table['name'] not in empty_class_tables]
+	workers = min(workers, len(fetched_tables))
+	with concurrent.futures.ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+		futures = {}
+		for class_table in fetched_tables:
+			futures[class_table['name']] = executor.submit(sync_servicenow_api_class_table_import, servicenow,
+				class_table, context)
+		results = []
+		for class_table in class_tables:
+			if class_table['name'] in futures:
+				results.append(futures[class_table['name']].result())
+			else:
+				results.append(sync_servicenow_api_class_table_cached(servicenow, class_table, context))
+
+	# Merge in the configured order; a CI appears in only one class table, but keep the first if not
+	devices = []
+	sys_ids = set()
+	for class_devices in results:
+		for device in class_devices:
+			sys_id = sync_servicenow_record_field_value(device, SYNC_SERVICENOW_INPUT_API_DEVICES_ID)
+			if sys_id in sys_ids:
+				continue
+			sys_ids.add(sys_id)
+			devices.append(device)
+
+	return devices
+
+def sync_servicenow_api_devices_import(servicenow, include_filters=[], exclude_filters=[], context=None,
+	relationship_types={}, class_tables=[], preflight=None):
+
+	# Without pre-flight counts, the whole table is requested at once as before
+	page_size = None
+	workers = SYNC_SERVICENOW_CLASS_TABLES_WORKERS
+	empty_class_tables = []
+	if preflight != None:
+		page_size = preflight['devices_page_size']
+		workers = preflight['workers']
+		empty_class_tables = preflight['empty_classes']
+
+	if len(class_tables) > 0:
+		# Get configuration items from the allowlisted class tables in parallel
+		devices = sync_servicenow_api_class_tables_import(servicenow, class_tables, context, workers,
+			empty_class_tables)
+	else:
+		# Get all configuration items from ServiceNow
+		parameters = []
+		parameters.append({'name':'sysparm_display_value', 'value':'all'})
+
+		def get_configuration_items(parameters=[]):
+			return servicenow.get_configuration_items(parameters=parameters, page_size=page_size)
+
+		if context == None:
+			devices = get_configuration_items(parameters=parameters)
+		else:
+			devices = sync_servicenow_api_records_refresh(get_configuration_items, parameters,
+				context['servicenow_devices'], context['full_refresh'])
 	logger.info("There are {} configuration items from ServiceNow".format(len(devices)))
 
+	# Fill in missing locations from related CIs before filtering, while racks and chassis are still in the list
+	if len(relationship_types) > 0:
+		relationships = sync_servicenow_api_relationships_import(servicenow, relationship_types, context)
+		ancestors = sync_servicenow_relationships_index(relationships, relationship_types)
+		sync_servicenow_devices_locations_infer(devices, ancestors)
+
 	filtered_devices = sync_servicenow_devices_filter(devices, include_filters=include_filters, 
 		exclude_filters=exclude_filters)
 
 	return filtered_devices
 
-def sync_servicenow_api_locations_import(servicenow):
+def sync_servicenow_api_locations_import(servicenow, context=None, page_size=None):
+
+	def get_locations(parameters=[]):
+		return servicenow.get_locations(parameters=parameters, page_size=page_size)
 
-	locations = servicenow.get_locations()
+	if context == None:
+		locations = get_locations()
+	else:
+		locations = sync_servicenow_api_records_refresh(get_locations, [],
+			context['servicenow_locations'], context['full_refresh'])
 
 	return locations
 
+SYNC_SERVICENOW_TABLE_LOCATIONS = 'cmn_location'
+
+SYNC_SERVICENOW_RELATIONSHIPS_PAGE_SIZE = 10000
+SYNC_SERVICENOW_RELATIONSHIPS_MAX_DEPTH = 10
+SYNC_SERVICENOW_RELATIONSHIPS_ANCESTOR_PARENT = 'parent'
+SYNC_SERVICENOW_RELATIONSHIPS_ANCESTOR_CHILD = 'child'
+
+def sync_servicenow_relationship_types_get(config):
+	# relationship_types:
+	#   - Contains::Contained by                  (the parent is the ancestor)
+	#   - name: Located in::Houses
+	#     ancestor: child                         (the child is the ancestor)
+	relationship_types = {}
+	if config == None or config.get('relationship_types') == None:
+		return relationship_types
+
+	for relationship_type in config['relationship_types']:
+		ancestor = SYNC_SERVICENOW_RELATIONSHIPS_ANCESTOR_PARENT
+		if type(relationship_type) is dict:
+			name = relationship_type.get('name')
+			ancestor = relationship_type.get('ancestor', ancestor)
+		else:
+			name = relationship_type
+		if name == None or name == '' or \
+			ancestor not in [SYNC_SERVICENOW_RELATIONSHIPS_ANCESTOR_PARENT, SYNC_SERVICENOW_RELATIONSHIPS_ANCESTOR_CHILD]:
+			logger.info(f"Invalid relationship type {relationship_type}")
+			continue
+		relationship_types[name] = ancestor
+
+	return relationship_types
+
+def sync_servicenow_api_relationships_import(servicenow, relationship_types, context=None):
+
+	# Only the configured relationship types, and only the fields needed to build the index
+	parameters = []
+	parameters.append({'name':'sysparm_query', 'value':'type.nameIN' + ','.join(relationship_types.keys())})
+	parameters.append({'name':'sysparm_fields', 'value':'sys_id,parent,child,type.name,sys_updated_on'})
+	parameters.append({'name':'sysparm_exclude_reference_link', 'value':'true'})
+
+	def get_relationships(parameters=[]):
+		return servicenow.get_relationships(parameters=parameters, page_size=SYNC_SERVICENOW_RELATIONSHIPS_PAGE_SIZE)
+
+	if context == None:
+		relationships = get_relationships(parameters=parameters)
+	else:
+		relationships = sync_servicenow_api_records_refresh(get_relationships, parameters,
+			context['servicenow_relationships'], context['full_refresh'])
+	if relationships == None:
+		relationships = []
+	logger.info("There are {} relationships from ServiceNow".format(len(relationships)))
+
+	return relationships
+
+def sync_servicenow_relationships_index(relationships, relationship_types):
+	# Adjacency index from a CI's sys_id to the sys_ids of the CIs that contain or house it
+	ancestors = {}
+	for relationship in relationships:
+		relationship_type = relationship.get('type.name')
+		if relationship_type not in relationship_types:
+			continue
+		parent = sync_servicenow_record_field_value(relationship, 'parent')
+		child = sync_servicenow_record_field_value(relationship, 'child')
+		if parent in [None, ''] or child in [None, '']:
+			continue
+		if relationship_types[relationship_type] == SYNC_SERVICENOW_RELATIONSHIPS_ANCESTOR_PARENT:
+			descendant, ancestor = child, parent
+		else:
+			descendant, ancestor = parent, child
+		if descendant not in ancestors:
+			ancestors[descendant] = []
+		ancestors[descendant].append(ancestor)
+
+	return ancestors
+
+def sync_servicenow_location_infer(sys_id, ancestors, ci_locations, max_depth=SYNC_SERVICENOW_RELATIONSHIPS_MAX_DEPTH):
+	# Breadth-first search up the relationships, so the nearest located ancestor wins
+	visited = set([sys_id])
+	level = [sys_id]
+	for depth in range(max_depth):
+		next_level = []
+		for ci in level:
+			for ancestor in ancestors.get(ci, []):
+				if ancestor in visited:
+					continue
+				visited.add(ancestor)
+				if ancestor in ci_locations:
+					return ci_locations[ancestor]
+				next_level.append(ancestor)
+		if len(next_level) == 0:
+			break
+		level = next_level
+
+	return None
+
+def sync_servicenow_devices_locations_infer(devices, ancestors):
+	location_field = SYNC_SERVICENOW_INPUT_API_DEVICES_LOCATION
+
+	# Locations of every CI, including racks and chassis that are filtered out of the devices later
+	ci_locations = {}
+	for device in devices:
+		if location_field in device and clean(device[location_field]) != '':
+			ci_locations[sync_servicenow_record_field_value(device, SYNC_SERVICENOW_INPUT_API_DEVICES_ID)] = \
+				device[location_field]
+
+	inferred_count = 0
+	for device_index, device in enumerate(devices):
+		if location_field in device and clean(device[location_field]) != '':
+			continue
+		sys_id = sync_servicenow_record_field_value(device, SYNC_SERVICENOW_INPUT_API_DEVICES_ID)
+		location = sync_servicenow_location_infer(sys_id, ancestors, ci_locations)
+		if location != None:
+			# Set the location on a copy, since the record may be cached between daemon cycles; the location is
+			# inferred again every cycle from the current relationships
+			device = dict(device)
+			device[location_field] = location
+			devices[device_index] = device
+			inferred_count += 1
+	logger.info(f"Inferred the location of {inferred_count} configuration item(s) from their relationships")
+
+	return inferred_count
+
+def sync_servicenow_api_locations_resolve(servicenow, devices, context=None):
+
+	# Resolve only the locations that devices refer to, with batched lookups of the distinct references
+	if context != None and context['full_refresh'] == True:
+		servicenow.clear_cache(SYNC_SERVICENOW_TABLE_LOCATIONS)
+
+	location_ids = set()
+	for device in devices:
+		location_id = sync_servicenow_record_field_value(device, SYNC_SERVICENOW_INPUT_API_DEVICES_LOCATION)
+		if location_id not in [None, '']:
+			location_ids.add(location_id)
+
+	locations = servicenow.resolve_references(SYNC_SERVICENOW_TABLE_LOCATIONS, sorted(location_ids))
+	logger.info("Resolved {} location(s) referenced by {} device(s)".format(len(locations), len(devices)))
+
+	return list(locations.values())
+
+SYNC_SERVICENOW_PREFLIGHT_PAGE_SIZE = 10000
+SYNC_SERVICENOW_PREFLIGHT_SHARDS = 4
+SYNC_SERVICENOW_PREFLIGHT_ACTION_REFUSE = 'refuse'
+SYNC_SERVICENOW_PREFLIGHT_ACTION_SHARD = 'shard'
+SYNC_SERVICENOW_PREFLIGHT_CLASSES_COUNT = 10
+
+class SyncPreflightRefused(Exception):
+	pass
+
+def sync_servicenow_api_preflight_cache(context, key, name=None):
+	if context == None:
+		return None
+	if name != None:
+		return context[key].get(name)
+	return context[key]
+
+def sync_servicenow_api_preflight(servicenow, config, class_tables, relationship_types, context=None):
+	# Count the records each fetch is about to return, with the same queries, before fetching any of them
+	full_refresh = True
+	if context != None:
+		full_refresh = context['full_refresh']
+
+	preflight = {}
+	preflight['classes'] = {}
+	if len(class_tables) > 0:
+		preflight['devices'] = 0
+		for class_table in class_tables:
+			parameters = sync_servicenow_api_records_refresh_parameters([],
+				sync_servicenow_api_preflight_cache(context, 'servicenow_class_tables', class_table['name']),
+				full_refresh)
+			count, groups = servicenow.get_record_counts(class_table['name'], parameters)
+			if count == None:
+				logger.info(f"Unable to count configuration items in {class_table['name']}; skipping pre-flight")
+				return None
+			preflight['classes'][class_table['name']] = count
+			preflight['devices'] += count
+	else:
+		parameters = sync_servicenow_api_records_refresh_parameters([],
+			sync_servicenow_api_preflight_cache(context, 'servicenow_devices'), full_refresh)
+		count, groups = servicenow.get_record_counts('cmdb_ci', parameters,
+			group_by=SYNC_SERVICENOW_INPUT_API_DEVICES_CLASS)
+		if count == None:
+			logger.info("Unable to count configuration items; skipping pre-flight")
+			return None
+		preflight['classes'] = groups
+		preflight['devices'] = count
+
+	preflight['locations'] = None
+	if config.get('resolve_locations') != True:
+		parameters = sync_servicenow_api_records_refresh_parameters([],
+			sync_servicenow_api_preflight_cache(context, 'servicenow_locations'), full_refresh)
+		preflight['locations'], groups = servicenow.get_record_counts(SYNC_SERVICENOW_TABLE_LOCATIONS, parameters)
+
+	preflight['relationships'] = None
+	if len(relationship_types) > 0:
+		parameters = [{'name':'sysparm_query', 'value':'type.nameIN' + ','.join(relationship_types.keys())}]
+		parameters = sync_servicenow_api_records_refresh_parameters(parameters,
+			sync_servicenow_api_preflight_cache(context, 'servicenow_relationships'), full_refresh)
+		preflight['relationships'], groups = servicenow.get_record_counts('cmdb_rel_ci', parameters)
+
+	classes = sorted(preflight['classes'].items(), key=lambda item: item[1], reverse=True)
+	for class_name, count in classes[:SYNC_SERVICENOW_PREFLIGHT_CLASSES_COUNT]:
+		logger.info(f"Pre-flight: {count} configuration item(s) of class {class_name}")
+
+	# Page large tables rather than asking for everything in one response, and skip class tables with nothing
+	# to fetch. On incremental cycles the counts are of changed records only, so a table without changes keeps
+	# its cached records rather than being dropped.
+	preflight['devices_page_size'] = None
+	if preflight['devices'] > SYNC_SERVICENOW_PREFLIGHT_PAGE_SIZE:
+		preflight['devices_page_size'] = SYNC_SERVICENOW_PREFLIGHT_PAGE_SIZE
+	preflight['locations_page_size'] = None
+	if preflight['locations'] != None and preflight['locations'] > SYNC_SERVICENOW_PREFLIGHT_PAGE_SIZE:
+		preflight['locations_page_size'] = SYNC_SERVICENOW_PREFLIGHT_PAGE_SIZE
+	preflight['empty_classes'] = [class_table['name'] for class_table in class_tables
+		if preflight['classes'][class_table['name']] == 0]
+	preflight['workers'] = max(min(SYNC_SERVICENOW_CLASS_TABLES_WORKERS,
+		len(class_tables) - len(preflight['empty_classes'])), 1)
+
+	# Refuse, or ask for a sharded run, when the run is larger than configured; incremental counts are only of
+	# the changes, so the limits are checked on full refreshes
+	preflight['shards'] = None
+	max_records = config.get('max_records')
+	if full_refresh == True and max_records != None and preflight['devices'] > max_records:
+		action = config.get('max_records_action', SYNC_SERVICENOW_PREFLIGHT_ACTION_REFUSE)
+		if action == SYNC_SERVICENOW_PREFLIGHT_ACTION_SHARD:
+			preflight['shards'] = config.get('max_records_shards', SYNC_SERVICENOW_PREFLIGHT_SHARDS)
+			logger.info(f"{preflight['devices']} configuration items exceed {max_records}; " \
+				f"switching to {preflight['shards']} shards")
+		else:
+			raise SyncPreflightRefused(f"ServiceNow reports {preflight['devices']} configuration items, " \
+				f"more than max_records ({max_records})")
+
+	return preflight
+
 def sync_servicenow_configuration_read(servicenow_yml):
 
 	servicenow_configuration = yamlread(servicenow_yml)
 
 	return servicenow_configuration
 
-def sync_servicenow_api_import(servicenow_yml):
-
-	config = sync_servicenow_configuration_read(servicenow_yml)
+def sync_servicenow_authenticate(config):
 
 	# Authenticate to ServiceNow
 	hostname = config['hostname']
 	username = config['username']
 	password = config['password']
 
+	from ServiceNowAPI.servicenow import ServiceNow
+
 	try:
 		servicenow = ServiceNow(hostname, username, password)
 	except:
 		logger.info(f"Failed to reach ServiceNow instance at {hostname} with {username}")
 		raise
 
+	# Decode table reads record by record from the response stream instead of all at once
+	if config.get('stream_records') == True:
+		servicenow.stream = True
+		servicenow.canonicalize = sync_servicenow_record_compact
+
+	return servicenow
+
+def sync_servicenow_api_import(servicenow_yml, context=None, preflight=None):
+
+	# Keep the configuration and session between daemon cycles
+	if context != None and context['servicenow'] != None:
+		config = context['servicenow_config']
+		servicenow = context['servicenow']
+	else:
+		config = sync_servicenow_configuration_read(servicenow_yml)
+		servicenow = sync_servicenow_authenticate(config)
+		if context != None:
+			context['servicenow_config'] = config
+			context['servicenow'] = servicenow
+
+	class_tables = sync_servicenow_class_tables_get(config, config['include_filters'], config['exclude_filters'])
+	relationship_types = sync_servicenow_relationship_types_get(config)
+
+	# Optionally count what is about to be fetched first, to size the fetch and stop oversized runs early
+	counts = None
+	if config.get('preflight') == True or config.get('max_records') != None:
+		counts = sync_servicenow_api_preflight(servicenow, config, class_tables, relationship_types, context)
+		if counts != None and preflight != None:
+			preflight.update(counts)
+
 	servicenow_devices = sync_servicenow_api_devices_import(servicenow, config['include_filters'],
-		config['exclude_filters'])
-	servicenow_locations = sync_servicenow_api_locations_import(servicenow)
+		config['exclude_filters'], context, relationship_types, class_tables, counts)
+	if config.get('resolve_locations') == True:
+		servicenow_locations = sync_servicenow_api_locations_resolve(servicenow, servicenow_devices, context)
+	else:
+		page_size = None
+		if counts != None:
+			page_size = counts['locations_page_size']
+		servicenow_locations = sync_servicenow_api_locations_import(servicenow, context, page_size)
 
 	return servicenow_devices, servicenow_locations
 
-def sync_servicenow_csv_import(devices_csv, locations_csv):
+def sync_servicenow_csv_cached_read(file_path, context=None, workers=None):
+
+	# Only read the file again if it has been modified since the last cycle
+	if context == None:
+		return dictionary_from_csv(file_path, workers)
+
+	try:
+		file_stat = os.stat(file_path)
+		signature = (file_stat.st_mtime_ns, file_stat.st_size)
+	except OSError:
+		signature = None
+
+	cached = context['csv'].get(file_path)
+	if cached != None and signature != None and cached['signature'] == signature:
+		logger.info(f"Using cached rows for unchanged file {file_path}")
+		return cached['rows']
+
+	rows = dictionary_from_csv(file_path, workers)
+	context['csv'][file_path] = {'signature':signature, 'rows':rows}
+
+	return rows
+
+def sync_servicenow_csv_import(devices_csv, locations_csv, context=None, workers=None):
 
 	# Read files and find required fields
-	servicenow_devices = dictionary_from_csv(devices_csv)
+	servicenow_devices = sync_servicenow_csv_cached_read(devices_csv, context, workers)
 	if servicenow_devices == None or len(servicenow_devices) == 0:
 		logger.debug("Device INPUT input did not include the expected fields. Please correct and re-run script.")
 		return None, None
 
-	servicenow_locations = dictionary_from_csv(locations_csv)
+	servicenow_locations = sync_servicenow_csv_cached_read(locations_csv, context, workers)
 	if servicenow_locations == None or len(servicenow_locations) == 0:
 		logger.debug("Locations INPUT input did not include the expected fields. Please correct and re-run script.")
 		return None, None
 
 	return servicenow_devices, servicenow_locations	
 
-def sync_servicenow_import(servicenow_yml=None, servicenow_devices_csv=None, servicenow_locations_csv=None):
+def sync_servicenow_import(servicenow_yml=None, servicenow_devices_csv=None, servicenow_locations_csv=None,
+	context=None, preflight=None, csv_workers=None):
 
 	if servicenow_yml != None:
 		# Option 1: Pull devices directly from ServiceNow
-		servicenow_devices, servicenow_locations = sync_servicenow_api_import(servicenow_yml)
+		servicenow_devices, servicenow_locations = sync_servicenow_api_import(servicenow_yml, context, preflight)
 
 	elif servicenow_devices_csv != None and servicenow_locations_csv != None:
 		# Option 2: Pull devices and locations from CSV
 		servicenow_devices, servicenow_locations = sync_servicenow_csv_import(servicenow_devices_csv,
-			servicenow_locations_csv)
+			servicenow_locations_csv, context, csv_workers)
 	else:
 		# Notify user that information is missing
 		logger.info("Provided input parameters do not specify complete ServiceNow parameters")
@@ -315,7 +1043,6 @@ def sync_servicenow_import(servicenow_yml=None, servicenow_devices_csv=None, ser
 	return servicenow_devices, servicenow_locations
 
 #----- ServiceNow report functions
-### FOR NOW, USE PRINT()
 
 # Constants to use for normalized input fields for devices and locations for both CSV and API
 SYNC_SERVICENOW_LOOKUP_DEVICES_NAME = 'Name'
@@ -336,154 +1063,326 @@ SYNC_SERVICENOW_LOOKUP_LOCATIONS_COUNTRY = 'Country'
 SYNC_SERVICENOW_LOOKUP_LOCATIONS_LATITUDE = 'Latitude'
 SYNC_SERVICENOW_LOOKUP_LOCATIONS_LONGITUDE = 'Longitude'
 
-def sync_servicenow_devices_multiple_addresses_report(devices_with_multiple_addresses, lookup_table, summary=True):
+# Constants to use for report and category names in report records
+SYNC_REPORT_FORMAT_TEXT = 'text'
+SYNC_REPORT_FORMAT_JSONL = 'jsonl'
+SYNC_REPORT_FORMAT_CSV = 'csv'
+SYNC_REPORT_SUMMARY_COUNT = 10
+
+SYNC_REPORT_ADDRESSES = 'servicenow_addresses'
+SYNC_REPORT_ADDRESSES_EMPTY = 'empty_address'
+SYNC_REPORT_ADDRESSES_INVALID = 'invalid_address'
+SYNC_REPORT_ADDRESSES_MULTIPLE = 'multiple_addresses'
+SYNC_REPORT_LOCATIONS = 'servicenow_locations'
+SYNC_REPORT_LOCATIONS_DUPLICATE = 'duplicate_location'
+SYNC_REPORT_DEVICES_COMPARISON = 'devices_comparison'
+SYNC_REPORT_SITES_COMPARISON = 'sites_comparison'
+SYNC_REPORT_LOCATION_VALIDATION = 'location_validation'
+SYNC_REPORT_ADDRESS_UPDATES = 'address_updates'
+SYNC_REPORT_AGING = 'aging'
+SYNC_REPORT_SNAPSHOT = 'snapshot'
+SYNC_REPORT_EVENTS = 'events'
+
+SYNC_REPORT_CSV_FIELDS = ['report', 'category', 'name', 'cmdb_ci', 'address', 'location', 'detail']
+
+class SyncReportSink():
+	"""Text report sink
+
+	Prints each report category with a heading, one record per line, limited to the first few records when a
+	summary is requested. Counters for every report category are kept separately from the records.
+	"""
+
+	def __init__(self, stream=None, summary=True):
+		# With no stream, print to whatever sys.stdout is at the time so that redirection still works
+		self.stream = stream
+		self.summary = summary
+		self.counters = {}
+		self.category_count = 0
+		self.category_written = 0
+
+	def begin(self, report, category, count, message):
+		self.counters[(report, category)] = self.counters.get((report, category), 0) + count
+		self.category_count = count
+		self.category_written = 0
+		print("", file=self.stream)
+		print(message, file=self.stream)
+		if count > SYNC_REPORT_SUMMARY_COUNT and self.summary == True:
+			print(f"Displaying the first {SYNC_REPORT_SUMMARY_COUNT}:", file=self.stream)
+
+	def record(self, report, category, record):
+		if self.summary == True and self.category_written >= SYNC_REPORT_SUMMARY_COUNT:
+			return
+		self.category_written += 1
+		print("  " + ", ".join(str(value) for value in record.values()), file=self.stream)
+
+	def end(self, report, category):
+		return
+
+	def flush(self):
+		if self.stream != None:
+			self.stream.flush()
+		else:
+			sys.stdout.flush()
+
+	def close(self):
+		if self.stream != None:
+			self.stream.flush()
+
+	def summary_report(self):
+		return
+
+class SyncReportJsonLinesSink(SyncReportSink):
+	"""JSON Lines report sink; writes one JSON object per record as it is reported"""
+
+	def begin(self, report, category, count, message):
+		self.counters[(report, category)] = self.counters.get((report, category), 0) + count
+
+	def record(self, report, category, record):
+		line = {'report':report, 'category':category}
+		line.update(record)
+		self.stream.write(json.dumps(line) + '\n')
+
+	def close(self):
+		self.stream.flush()
+		if self.stream not in [sys.stdout, sys.stderr]:
+			self.stream.close()
+
+	def summary_report(self):
+		# Keep the counters off the record stream so that consumers only see records there
+		print("", file=sys.stderr)
+		print("Report Summary", file=sys.stderr)
+		for (report, category), count in sorted(self.counters.items()):
+			print(f"  {report:<25} {category:<25} {count:>10}", file=sys.stderr)
+
+class SyncReportCsvSink(SyncReportJsonLinesSink):
+	"""CSV report sink; writes one row per record with a fixed set of columns"""
+
+	def __init__(self, stream=None, summary=True):
+		super().__init__(stream, summary)
+		self.writer = csv.DictWriter(self.stream, fieldnames=SYNC_REPORT_CSV_FIELDS, extrasaction='ignore')
+		self.writer.writeheader()
+
+	def record(self, report, category, record):
+		row = {'report':report, 'category':category}
+		row.update(record)
+		self.writer.writerow(row)
+
+def sync_report_sink_create(report_format=SYNC_REPORT_FORMAT_TEXT, report_output=None, summary=True):
+	if report_format == None or report_format == SYNC_REPORT_FORMAT_TEXT:
+		return SyncReportSink(summary=summary)
+
+	if report_output == None or report_output == '-':
+		stream = sys.stdout
+	else:
+		stream = open(report_output, 'w', newline='', encoding='utf-8')
+
+	if report_format == SYNC_REPORT_FORMAT_CSV:
+		return SyncReportCsvSink(stream, summary)
+	return SyncReportJsonLinesSink(stream, summary)
+
+def sync_report_category(sink, report, category, items, message, to_record):
+	sink.begin(report, category, len(items), message)
+	for item in items:
+		sink.record(report, category, to_record(item))
+	sink.end(report, category)
+	return
+
+def sync_report_name_record(name):
+	return {'name':name}
+
+def sync_servicenow_devices_multiple_addresses_report(devices_with_multiple_addresses, summary=True, sink=None):
+	if sink == None:
+		sink = SyncReportSink(summary=summary)
+
 	devices_with_multiple_addresses_count = len(devices_with_multiple_addresses)
 	if devices_with_multiple_addresses_count > 0:
-		print("")
-		print(f"There are {devices_with_multiple_addresses_count} devices that have multiple listed IP addresses.")
-		if devices_with_multiple_addresses_count > 10 and summary == True:
-			print("Displaying the first 10 devices with multiple IP addresses:")
-			print(devices_with_multiple_addresses[:10])
-		else:
-			print(f"The following device names have multiple addresses:")
-			print(devices_with_multiple_addresses)
-			
-		print("")
+		sync_report_category(sink, SYNC_REPORT_ADDRESSES, SYNC_REPORT_ADDRESSES_MULTIPLE, devices_with_multiple_addresses,
+			f"There are {devices_with_multiple_addresses_count} devices that have multiple listed IP addresses.",
+			sync_report_name_record)
 
 	return
 
+def sync_servicenow_locations_duplicate_report_records(duplicate_locations):
+	# One record per duplicate, the selected location first
+	for ranked_locations in duplicate_locations:
+		for location_index, location in enumerate(ranked_locations):
+			record = {}
+			record['name'] = location.name
+			if location.cmdb_ci != '':
+				record['cmdb_ci'] = location.cmdb_ci
+			record['location'] = ', '.join([location.city, location.region, location.country])
+			record['detail'] = "{}, {} ({})".format(location.latitude, location.longitude,
+				'selected' if location_index == 0 else 'ignored')
+			yield record
+
+def sync_servicenow_locations_duplicate_report(duplicate_locations, summary=True, sink=None):
+	if sink == None:
+		sink = SyncReportSink(summary=summary)
+
+	duplicate_locations_count = len(duplicate_locations)
+	if duplicate_locations_count > 0:
+		records = list(sync_servicenow_locations_duplicate_report_records(duplicate_locations))
+		sync_report_category(sink, SYNC_REPORT_LOCATIONS, SYNC_REPORT_LOCATIONS_DUPLICATE, records,
+			f"There are {duplicate_locations_count} location names used by devices that are listed more than once; " \
+			"the selected location is listed first, with its coordinates:", lambda record: record)
+
+	return
+
+def sync_servicenow_devices_addresses_report_records(devices_by_name):
+	# Yield one record per device instance, so the full list is never built
+	for device_name, device_instances in devices_by_name.items():
+		for device in device_instances:
+			record = {}
+			record['name'] = device_name
+			record['cmdb_ci'] = device.cmdb_ci
+			record['address'] = device.address
+			record['location'] = device.location
+			yield record
+
+def sync_servicenow_devices_addresses_report(devices_by_name, category, message, sink):
+	count = 0
+	for device_instances in devices_by_name.values():
+		count += len(device_instances)
+	sink.begin(SYNC_REPORT_ADDRESSES, category, count, message)
+	for record in sync_servicenow_devices_addresses_report_records(devices_by_name):
+		sink.record(SYNC_REPORT_ADDRESSES, category, record)
+	sink.end(SYNC_REPORT_ADDRESSES, category)
+	return
+
+def sync_servicenow_devices_empty_addresses_report(devices_with_empty_addresses, summary=True, sink=None):
+	if sink == None:
+		sink = SyncReportSink(summary=summary)
 
-def sync_servicenow_devices_empty_addresses_report(devices_with_empty_addresses, lookup_table, summary=True):
 	devices_with_empty_addresses_count = len(devices_with_empty_addresses)
 	if devices_with_empty_addresses_count > 0:
-		print("")
-		print(f"There are {devices_with_empty_addresses_count} devices without listed IP addresses.")
-		if devices_with_empty_addresses_count > 10 and summary == True:
-			print("Displaying the first 10 devices without IP addresses:")
-			print(list(devices_with_empty_addresses.keys())[:10])
-		else:
-			print(f"The following devices have empty addresses:")
-			for device_name, device_instances in devices_with_empty_addresses.items():
-				for device in device_instances:
-					cmdb_ci = clean(device[lookup_table[SYNC_SERVICENOW_LOOKUP_DEVICES_ID]])
-					address = clean(device[lookup_table[SYNC_SERVICENOW_LOOKUP_DEVICES_ADDRESS]])
-					location = clean(device[lookup_table[SYNC_SERVICENOW_LOOKUP_DEVICES_LOCATION]])
-					print(f"  {device_name}, {cmdb_ci}, {address}, {location}")
-		print("")
+		sync_servicenow_devices_addresses_report(devices_with_empty_addresses, SYNC_REPORT_ADDRESSES_EMPTY,
+			f"There are {devices_with_empty_addresses_count} devices without listed IP addresses.", sink)
 
 	return
 
+def sync_servicenow_devices_invalid_addresses_report(devices_with_invalid_addresses, summary=True, sink=None):
+	if sink == None:
+		sink = SyncReportSink(summary=summary)
 
-def sync_servicenow_devices_invalid_addresses_report(devices_with_invalid_addresses, lookup_table, summary=True):
 	devices_with_invalid_addresses_count = len(devices_with_invalid_addresses)
 	if devices_with_invalid_addresses_count > 0:
-		print("")
-		print(f"There are {devices_with_invalid_addresses_count} devices that have invalid IP addresses.")
-		if devices_with_invalid_addresses_count > 10 and summary == True:
-			print("Displaying the first 10 devices with invalid IP addresses:")
-			print(list(devices_with_invalid_addresses.keys())[:10])
-		else:
-			print(f"The following devices have invalid addresses:")
-			for device_name, device_instances in devices_with_invalid_addresses.items():
-				for device in device_instances:
-					cmdb_ci = clean(device[lookup_table[SYNC_SERVICENOW_LOOKUP_DEVICES_ID]])
-					address = clean(device[lookup_table[SYNC_SERVICENOW_LOOKUP_DEVICES_ADDRESS]])
-					location = clean(device[lookup_table[SYNC_SERVICENOW_LOOKUP_DEVICES_LOCATION]])
-					print(f"  {device_name}, {cmdb_ci}, {address}, {location}")
-		print("")
+		sync_servicenow_devices_addresses_report(devices_with_invalid_addresses, SYNC_REPORT_ADDRESSES_INVALID,
+			f"There are {devices_with_invalid_addresses_count} devices that have invalid IP addresses.", sink)
 
 	return
 
-def sync_servicenow_netim_devices_comparison_report(device_comparison, summary=True):
-	new_devices = device_comparison[SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_NEW]
+def sync_servicenow_netim_devices_fuzzy_record(fuzzy_match):
+	record = {}
+	record['name'] = fuzzy_match['name']
+	record['detail'] = ', '.join(f"{name} ({score:.2f})" for name, score in fuzzy_match['suggestions'])
+	return record
 
-	new_devices_count = len(new_devices)
-	print("")
-	print(f"There are {new_devices_count} devices with IP addresses that do not exist in NetIM.")
-	if new_devices_count > 10 and summary:
-		print("Displaying the first 10 devices:")
-		print(new_devices[:10])	
-	else:
-		print(new_devices)
+def sync_servicenow_netim_devices_comparison_report(device_comparison, summary=True, sink=None):
+	if sink == None:
+		sink = SyncReportSink(summary=summary)
+
+	new_devices = device_comparison[SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_NEW]
+	sync_report_category(sink, SYNC_REPORT_DEVICES_COMPARISON, SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_NEW, new_devices,
+		f"There are {len(new_devices)} devices with IP addresses that do not exist in NetIM.", sync_report_name_record)
 
 	different_addresses = device_comparison[SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_DIFFERENT]
-	different_addresses_count = len(different_addresses)
-	if different_addresses_count > 0:	
-		print("")
-		print(f"There are {different_addresses_count} device(s) that exist in NetIM, but have different access addresses.")
-		if different_addresses_count > 10 and summary:
-			print("Displaying the first 10 devices:")
-			print(different_addresses[:10])
-		else:
-			print(different_addresses)
-	
+	if len(different_addresses) > 0:
+		sync_report_category(sink, SYNC_REPORT_DEVICES_COMPARISON, SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_DIFFERENT,
+			different_addresses,
+			f"There are {len(different_addresses)} device(s) that exist in NetIM, but have different access addresses.",
+			sync_report_name_record)
+
+	fuzzy_matches = device_comparison.get(SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_FUZZY, [])
+	if len(fuzzy_matches) > 0:
+		sync_report_category(sink, SYNC_REPORT_DEVICES_COMPARISON, SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_FUZZY,
+			fuzzy_matches,
+			f"There are {len(fuzzy_matches)} device(s) not in NetIM by name that closely match NetIM devices; " \
+			"they are not created:", sync_servicenow_netim_devices_fuzzy_record)
+
 	devices_with_no_updates = device_comparison[SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_NO_UPDATES]
-	no_update_count = len(devices_with_no_updates)
-	if no_update_count > 0:
-		print("")
-		print(f"There are {no_update_count} device(s) that have matching names and access addresses in NetIM.")
-		if no_update_count > 10 and summary:
-			print("Displaying the first 10 devices:")
-			print(devices_with_no_updates[:10])
-		else:
-			print("The following ServiceNow devices have matching names and access IP addresses in NetIM:")
-			print(devices_with_no_updates)
-		print("")
+	if len(devices_with_no_updates) > 0:
+		sync_report_category(sink, SYNC_REPORT_DEVICES_COMPARISON, SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_NO_UPDATES,
+			devices_with_no_updates,
+			f"There are {len(devices_with_no_updates)} device(s) that have matching names and access addresses in NetIM.",
+			sync_report_name_record)
 
 	return
 
-def sync_servicenow_netim_sites_comparison_report(site_comparison, summary=True):
-	new_sites = site_comparison[SYNC_SERVICENOW_NETIM_COMPARISON_SITES_NEW]
-
-	new_sites_count = len(new_sites)
-	print(f"The following {new_sites_count} site(s) are associated with devices and are not defined in NetIM:")
-	if new_sites_count > 10 and args.summary:
-		print("Displaying first 10 sites:")
-		print(new_sites[:10])
+def sync_netim_devices_addresses_update_record(result):
+	record = {}
+	record['name'] = result['name']
+	record['address'] = result['address']
+	if result['error'] != None:
+		record['detail'] = result['error']
+	elif result['status'] == SYNC_NETIM_ADDRESS_UPDATE_UPDATED:
+		record['detail'] = f"{result['old_address']} -> {result['address']}"
 	else:
-		print(new_sites)
+		record['detail'] = ''
+	return record
+
+def sync_netim_devices_addresses_update_report(results, summary=True, sink=None):
+	if sink == None:
+		sink = SyncReportSink(summary=summary)
+
+	messages = []
+	messages.append((SYNC_NETIM_ADDRESS_UPDATE_UPDATED, "The access address of {} device(s) was updated in NetIM:"))
+	messages.append((SYNC_NETIM_ADDRESS_UPDATE_FAILED, "The access address of {} device(s) failed to update in NetIM:"))
+	messages.append((SYNC_NETIM_ADDRESS_UPDATE_NOT_FOUND, "There are {} device(s) to update that were not found in NetIM:"))
+	messages.append((SYNC_NETIM_ADDRESS_UPDATE_NO_ADDRESS, "There are {} device(s) to update with no usable address:"))
+
+	for status, message in messages:
+		status_results = [result for result in results if result['status'] == status]
+		if len(status_results) > 0:
+			sync_report_category(sink, SYNC_REPORT_ADDRESS_UPDATES, status, status_results,
+				message.format(len(status_results)), sync_netim_devices_addresses_update_record)
+
+	return
+
+def sync_servicenow_netim_sites_comparison_report(site_comparison, summary=True, sink=None):
+	if sink == None:
+		sink = SyncReportSink(summary=summary)
+
+	new_sites = site_comparison[SYNC_SERVICENOW_NETIM_COMPARISON_SITES_NEW]
+	sync_report_category(sink, SYNC_REPORT_SITES_COMPARISON, SYNC_SERVICENOW_NETIM_COMPARISON_SITES_NEW, new_sites,
+		f"The following {len(new_sites)} site(s) are associated with devices and are not defined in NetIM:",
+		sync_report_name_record)
 
 	existing_sites = site_comparison[SYNC_SERVICENOW_NETIM_COMPARISON_SITES_EXISTING]
-	print("")
-	existing_site_count = len(existing_sites)
-	if existing_site_count == 0:
-		print("No sites to be imported matched existing names in NetIM database.")
+	if len(existing_sites) == 0:
+		message = "No sites to be imported matched existing names in NetIM database."
 	else:
-		print(f"The following {existing_site_count} site(s) have already been defined in NetIM.")
-		if existing_site_count > 10 and args.summary:
-			print("Displaying the first 10 sites:")
-			print(existing_sites[:10])
-		else:
-			print(existing_sites)
+		message = f"The following {len(existing_sites)} site(s) have already been defined in NetIM."
+	sync_report_category(sink, SYNC_REPORT_SITES_COMPARISON, SYNC_SERVICENOW_NETIM_COMPARISON_SITES_EXISTING,
+		existing_sites, message, sync_report_name_record)
 
 	return
 
-def sync_servicenow_netim_location_validation_report(comparison_dict, summary=True):
-
-	if len(comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_MATCH]) > 0:
-		print("The following sites had country, region, city that were found in NetIM database:")
-		print(comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_MATCH])
-	if len(comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_CITY_NOT_FOUND]) > 0:
-		print("The following sites had country and region found in NetIM database, but the city is not in database:")
-		print(comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_CITY_NOT_FOUND])
-	if len(comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_CITY_EMPTY]) > 0:
-		print("The following sites had country and region found in NetIM database, but city field is empty in input:")
-		print(comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_CITY_EMPTY])
-	if len(comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_REGION_NOT_FOUND]) > 0:
-		print("The following sites had country found in NetIM database, but region is not in database:")
-		print(comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_REGION_NOT_FOUND])
-	if len(comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_REGION_EMPTY]) > 0:
-		print("The following sites had country found in NetIM database, but region field is empty in input:")
-		print(comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_REGION_EMPTY])
-	if len(comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_COUNTRY_NOT_FOUND]) > 0:
-		print("The following sites had a country that does not match an entry in the NetIM database:")
-		print(comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_COUNTRY_NOT_FOUND])
-	if len(comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_COUNTRY_EMPTY]) > 0:
-		print("The following sites had no country listed in input:")
-		print(comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_COUNTRY_EMPTY])
-	if len(comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_COORDINATES_MISSING]) > 0:
-		print("The following sites had missing coordinates (latitude, longitude):")
-		print(comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_COORDINATES_MISSING])
+def sync_servicenow_netim_location_validation_report(comparison_dict, summary=True, sink=None):
+	if sink == None:
+		sink = SyncReportSink(summary=summary)
+
+	messages = []
+	messages.append((SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_MATCH,
+		"The following sites had country, region, city that were found in NetIM database:"))
+	messages.append((SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_CITY_NOT_FOUND,
+		"The following sites had country and region found in NetIM database, but the city is not in database:"))
+	messages.append((SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_CITY_EMPTY,
+		"The following sites had country and region found in NetIM database, but city field is empty in input:"))
+	messages.append((SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_REGION_NOT_FOUND,
+		"The following sites had country found in NetIM database, but region is not in database:"))
+	messages.append((SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_REGION_EMPTY,
+		"The following sites had country found in NetIM database, but region field is empty in input:"))
+	messages.append((SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_COUNTRY_NOT_FOUND,
+		"The following sites had a country that does not match an entry in the NetIM database:"))
+	messages.append((SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_COUNTRY_EMPTY,
+		"The following sites had no country listed in input:"))
+	messages.append((SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_COORDINATES_MISSING,
+		"The following sites had missing coordinates (latitude, longitude):"))
+
+	for category, message in messages:
+		if len(comparison_dict[category]) > 0:
+			sync_report_category(sink, SYNC_REPORT_LOCATION_VALIDATION, category, comparison_dict[category], message,
+				sync_report_name_record)
 
 	return
 
@@ -571,6 +1470,60 @@ def sync_servicenow_input_globals(use_api=True):
 
 	return lookup_table
 
+# Canonical ServiceNow records; every field is a stripped string, and empty when not present in the input
+SyncServiceNowDevice = collections.namedtuple('SyncServiceNowDevice',
+	['name', 'device_class', 'location', 'address', 'cmdb_ci'])
+SyncServiceNowLocation = collections.namedtuple('SyncServiceNowLocation',
+	['name', 'city', 'region', 'country', 'latitude', 'longitude', 'cmdb_ci'])
+
+SYNC_SERVICENOW_CANONICAL_DEVICE_LOOKUPS = [SYNC_SERVICENOW_LOOKUP_DEVICES_NAME, SYNC_SERVICENOW_LOOKUP_DEVICES_CLASS,
+	SYNC_SERVICENOW_LOOKUP_DEVICES_LOCATION, SYNC_SERVICENOW_LOOKUP_DEVICES_ADDRESS, SYNC_SERVICENOW_LOOKUP_DEVICES_ID]
+SYNC_SERVICENOW_CANONICAL_LOCATION_LOOKUPS = [SYNC_SERVICENOW_LOOKUP_LOCATIONS_NAME,
+	SYNC_SERVICENOW_LOOKUP_LOCATIONS_CITY, SYNC_SERVICENOW_LOOKUP_LOCATIONS_REGION,
+	SYNC_SERVICENOW_LOOKUP_LOCATIONS_COUNTRY, SYNC_SERVICENOW_LOOKUP_LOCATIONS_LATITUDE,
+	SYNC_SERVICENOW_LOOKUP_LOCATIONS_LONGITUDE, None]
+
+def sync_servicenow_input_value(value):
+	# Spreadsheet cells are strings; API fields may also be a reference with a value and display value
+	if type(value) is str:
+		return value.strip()
+	if value == None:
+		return ''
+	return clean(value)
+
+def sync_servicenow_input_accessors(lookup_table, use_api=True):
+	# Resolve the input field names once, so each record is read with one pass over a fixed list of fields
+	device_fields = tuple(lookup_table[lookup_name] for lookup_name in SYNC_SERVICENOW_CANONICAL_DEVICE_LOOKUPS)
+	address_index = SYNC_SERVICENOW_CANONICAL_DEVICE_LOOKUPS.index(SYNC_SERVICENOW_LOOKUP_DEVICES_ADDRESS)
+	address_empty = lookup_table[SYNC_SERVICENOW_LOOKUP_DEVICES_ADDRESS_EMPTY]
+
+	# Only API locations have an ID
+	location_id_field = SYNC_SERVICENOW_INPUT_API_DEVICES_ID if use_api == True else None
+	location_fields = tuple(lookup_table[lookup_name] if lookup_name != None else location_id_field \
+		for lookup_name in SYNC_SERVICENOW_CANONICAL_LOCATION_LOOKUPS)
+
+	def device_canonicalize(record):
+		values = [sync_servicenow_input_value(record.get(field)) for field in device_fields]
+		if values[address_index] == address_empty:
+			values[address_index] = ''
+		return SyncServiceNowDevice._make(values)
+
+	def location_canonicalize(record):
+		return SyncServiceNowLocation._make([sync_servicenow_input_value(record.get(field)) if field != None else '' \
+			for field in location_fields])
+
+	return device_canonicalize, location_canonicalize
+
+def sync_servicenow_input_canonicalize(devices, locations, lookup_table, use_api=True):
+	# Convert the raw API or CSV rows into canonical records once; validation, conversion and the reports only
+	# use the canonical records
+	device_canonicalize, location_canonicalize = sync_servicenow_input_accessors(lookup_table, use_api)
+
+	canonical_devices = [device_canonicalize(device) for device in devices]
+	canonical_locations = [location_canonicalize(location) for location in locations]
+
+	return canonical_devices, canonical_locations
+
 def sync_servicenow_input_ipaddress_valid(device_address):
 
 	valid_ipv4_address = True
@@ -618,7 +1571,7 @@ def sync_servicenow_input_ipaddress_valid(device_address):
 
 	return valid_ipv4_address or valid_ipv6_address
 
-def sync_servicenow_input_validate(devices, locations, lookup_table, summary=True):
+def sync_servicenow_input_validate(devices, locations, summary=True, sink=None):
 
 	# Check for duplicate names and valid IP addresses
 	# In the process, build a dictionary to see which devices have multiple listed access addresses
@@ -628,12 +1581,12 @@ def sync_servicenow_input_validate(devices, locations, lookup_table, summary=Tru
 	multiple_addresses_set = set()
 
 	for device in devices:
-		device_name = clean(device[lookup_table[SYNC_SERVICENOW_LOOKUP_DEVICES_NAME]])
-		device_address = clean(device[lookup_table[SYNC_SERVICENOW_LOOKUP_DEVICES_ADDRESS]])
+		device_name = device.name
+		device_address = device.address
 
 		# If the device address is empty, NetIM cannot monitor the device, so track the list of devices that
 		# do not have an IP address assigned
-		if device_address == '' or device_address == lookup_table[SYNC_SERVICENOW_LOOKUP_DEVICES_ADDRESS_EMPTY]:
+		if device_address == '':
 			if device_name in devices_with_empty_addresses:
 				devices_with_empty_addresses[device_name].append(device)
 			else:
@@ -658,13 +1611,13 @@ def sync_servicenow_input_validate(devices, locations, lookup_table, summary=Tru
 
 	# Report on findings of devices with empty and invalid addresses
 	logger.info("There are {} devices in ServiceNow with no address".format(len(devices_with_empty_addresses)))
-	sync_servicenow_devices_empty_addresses_report(devices_with_empty_addresses, lookup_table, summary)
+	sync_servicenow_devices_empty_addresses_report(devices_with_empty_addresses, summary, sink)
 	logger.info("There are {} devices in ServiceNow with invalid addresses".format(len(devices_with_invalid_addresses)))
-	sync_servicenow_devices_invalid_addresses_report(devices_with_invalid_addresses, lookup_table, summary)
+	sync_servicenow_devices_invalid_addresses_report(devices_with_invalid_addresses, summary, sink)
 
 	# Report on findings of devices with multiple addresses
 	devices_with_multiple_addresses = list(multiple_addresses_set)
-	sync_servicenow_devices_multiple_addresses_report(devices_with_multiple_addresses, lookup_table, summary)
+	sync_servicenow_devices_multiple_addresses_report(devices_with_multiple_addresses, summary, sink)
 
 	# Without having other criteria, choose the first IP address for each device name as the primary access address
 	# Also create the data set that matches all available access addresses to a device name for future selection purposes
@@ -672,7 +1625,7 @@ def sync_servicenow_input_validate(devices, locations, lookup_table, summary=Tru
 	devices_with_access_addresses = {}
 	for device_name in devices_unique_by_name:
 		for device_instance in devices_unique_by_name[device_name]:
-			access_address = clean(device_instance[lookup_table[SYNC_SERVICENOW_LOOKUP_DEVICES_ADDRESS]])
+			access_address = device_instance.address
 			if device_name not in devices_with_access_addresses:
 				devices_to_import.append(device_instance)
 				devices_with_access_addresses[device_name] = [access_address]
@@ -680,35 +1633,60 @@ def sync_servicenow_input_validate(devices, locations, lookup_table, summary=Tru
 				devices_with_access_addresses[device_name].append(access_address)
 	logger.info("There are {} unique devices with IP addresses from the ServiceNow data".format(len(devices_to_import)))
 
-	# Get unique list of locations from the devices that may be imported
-	devlocation_set = set()
+	# Get unique set of location keys from the devices that may be imported
+	devlocation_keys = set()
 	for device in devices_to_import:
-		devlocation = clean(device[lookup_table[SYNC_SERVICENOW_LOOKUP_DEVICES_LOCATION]])
-		devlocation_set.update([devlocation])
-	devlocations = list(devlocation_set)
+		devlocation_keys.add(sync_servicenow_location_key(device.location))
+
+	# Hash join the locations in ServiceNow with the device locations on the normalized name, keeping every
+	# location with the same key so that duplicates can be resolved and reported
+	locations_by_key = {}
+	for location_index, location in enumerate(locations):
+		location_key = sync_servicenow_location_key(location.name)
+		if location_key not in devlocation_keys:
+			continue
+		if location_key not in locations_by_key:
+			locations_by_key[location_key] = []
+		locations_by_key[location_key].append((location_index, location))
 
-	# Loop through locations in ServiceNow and import those that are associated with devices
-	# Check for duplicate location names along the way
 	locations_to_import = []
-	location_tracker = {}
-	duplicate_location_names = []
+	location_names = {}
+	duplicate_locations = []
+	for location_key, key_locations in locations_by_key.items():
+		ranked_locations = sorted(key_locations,
+			key=lambda key_location: sync_servicenow_location_rank(key_location[1], key_location[0]))
+		locations_to_import.append(ranked_locations[0][1])
+		location_names[location_key] = ranked_locations[0][1].name
+		if len(ranked_locations) > 1:
+			duplicate_locations.append([location for location_index, location in ranked_locations])
+
+	# Devices are grouped by location name in NetIM, so use the spelling of the selected location for the devices
+	for device_index, device in enumerate(devices_to_import):
+		location_name = location_names.get(sync_servicenow_location_key(device.location))
+		if location_name != None and location_name != device.location:
+			devices_to_import[device_index] = device._replace(location=location_name)
 
-	for location in locations:
-		location_name = clean(location[lookup_table[SYNC_SERVICENOW_LOOKUP_LOCATIONS_NAME]])
+	# Report on duplicate location names
+	logger.info("There are {} duplicated location names used by devices".format(len(duplicate_locations)))
+	sync_servicenow_locations_duplicate_report(duplicate_locations, summary, sink)
 
-		if location_name in location_tracker:
-			location_tracker[location_name].append(location)
-			duplicate_location_names.append(location_name)
-			continue
-		else:
-			location_tracker[location_name] = [location]
+	return devices_to_import, locations_to_import, devices_with_access_addresses
 
-		if location_name in devlocations:
-			locations_to_import.append(location)
+def sync_servicenow_location_key(location_name):
+	# Locations are joined on their name without case or repeated whitespace
+	return ' '.join(location_name.split()).casefold()
 
-	# Report on duplicate location names
+def sync_servicenow_location_rank(location, location_index):
+	# Of locations with the same name, prefer one with coordinates, then the most complete, then the lowest
+	# sys_id (for the API) and finally the first listed, so the same input always selects the same location
+	has_coordinates = location.latitude != '' and location.longitude != ''
 
-	return devices_to_import, locations_to_import, devices_with_access_addresses
+	completeness = 0
+	for value in [location.city, location.region, location.country]:
+		if value != '':
+			completeness += 1
+
+	return (not has_coordinates, -completeness, location.cmdb_ci, location_index)
 
 #----- ServiceNow/NetIM conversion functions
 
@@ -720,6 +1698,7 @@ NETIM_DEVICE_ACCESSINFO = 'deviceAccessInfo'
 NETIM_DEVICE_ACCESSADDRESS = 'accessAddress'
 NETIM_DEVICE_GROUP = 'group'
 NETIM_DEVICE_CMDB_ID = 'cmdb_ci'
+NETIM_DEVICE_CLASS = 'class'
 
 # Constants to use for NetIM Site/Group fields
 NETIM_SITE_NAME = 'name'
@@ -730,43 +1709,39 @@ NETIM_SITE_LATITUDE = 'latitude'
 NETIM_SITE_LONGITUDE = 'longitude'
 NETIM_SITE_CMDB_ID = 'cmdb_ci'
 
-def sync_servicenow_to_netim_devices_convert(devices_to_import, lookup_table):
+def sync_servicenow_to_netim_devices_convert(devices_to_import):
 	converted_devices = []
 
 	for device in devices_to_import:
 		converted_device = {}
-		device_name = clean(device[lookup_table[SYNC_SERVICENOW_LOOKUP_DEVICES_NAME]])
-		converted_device[NETIM_DEVICE_NAME] = device_name
-		converted_device[NETIM_DEVICE_DEVICENAME] = device_name
-		converted_device[NETIM_DEVICE_DISPLAYNAME] = device_name
-		access_address = clean(device[lookup_table[SYNC_SERVICENOW_LOOKUP_DEVICES_ADDRESS]])
-		converted_device[NETIM_DEVICE_ACCESSADDRESS] = access_address
-
-		group = clean(device[lookup_table[SYNC_SERVICENOW_LOOKUP_DEVICES_LOCATION]])
-		converted_device[NETIM_DEVICE_GROUP] = group
-
-		converted_device[NETIM_DEVICE_CMDB_ID] = clean(device[lookup_table[SYNC_SERVICENOW_LOOKUP_DEVICES_ID]])
+		converted_device[NETIM_DEVICE_NAME] = device.name
+		converted_device[NETIM_DEVICE_DEVICENAME] = device.name
+		converted_device[NETIM_DEVICE_DISPLAYNAME] = device.name
+		converted_device[NETIM_DEVICE_ACCESSADDRESS] = device.address
+		converted_device[NETIM_DEVICE_GROUP] = device.location
+		converted_device[NETIM_DEVICE_CMDB_ID] = device.cmdb_ci
+		converted_device[NETIM_DEVICE_CLASS] = device.device_class
 		converted_devices.append(converted_device)
 		
 	return converted_devices
 
-def sync_servicenow_to_netim_locations_convert(locations_to_import, lookup_table):
+def sync_servicenow_to_netim_locations_convert(locations_to_import):
 	converted_sites = []
 
 	# Get the list of locations that are assigned to devices being imported into ServiceNow
 	# and use them to pull the required information from the locations table
 	for location in locations_to_import:
 		converted_site = {}
-		converted_site[NETIM_SITE_NAME] = clean(location[lookup_table[SYNC_SERVICENOW_LOOKUP_LOCATIONS_NAME]])
-		converted_site[NETIM_SITE_CITY] = clean(location[lookup_table[SYNC_SERVICENOW_LOOKUP_LOCATIONS_CITY]])
-		converted_site[NETIM_SITE_REGION] = clean(location[lookup_table[SYNC_SERVICENOW_LOOKUP_LOCATIONS_REGION]])
-		country = clean(location[lookup_table[SYNC_SERVICENOW_LOOKUP_LOCATIONS_COUNTRY]])
+		converted_site[NETIM_SITE_NAME] = location.name
+		converted_site[NETIM_SITE_CITY] = location.city
+		converted_site[NETIM_SITE_REGION] = location.region
+		country = location.country
 		# Handle abbreviation of USA
 		if country == 'USA':
 			country = 'United States of America'
 		converted_site[NETIM_SITE_COUNTRY] = country
-		converted_site[NETIM_SITE_LATITUDE] = clean(location[lookup_table[SYNC_SERVICENOW_LOOKUP_LOCATIONS_LATITUDE]])
-		converted_site[NETIM_SITE_LONGITUDE] = clean(location[lookup_table[SYNC_SERVICENOW_LOOKUP_LOCATIONS_LONGITUDE]])
+		converted_site[NETIM_SITE_LATITUDE] = location.latitude
+		converted_site[NETIM_SITE_LONGITUDE] = location.longitude
 		converted_sites.append(converted_site)
 	logger.info("Converted {} sites(s) from ServiceNow associated with polled devices".format(len(converted_sites)))
 
@@ -778,6 +1753,7 @@ def sync_servicenow_to_netim_locations_convert(locations_to_import, lookup_table
 SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_NEW = 'new_device'
 SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_DIFFERENT = 'different_address'
 SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_NO_UPDATES = 'no_updates'
+SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_FUZZY = 'fuzzy_match'
 
 SYNC_SERVICENOW_NETIM_COMPARISON_SITES_NEW = 'new_site'
 SYNC_SERVICENOW_NETIM_COMPARISON_SITES_EXISTING = 'existing_site'
@@ -825,64 +1801,84 @@ def sync_servicenow_netim_device_name_comparison(servicenow_device, netim_device
 	else:
 		return False
 
-def sync_servicenow_netim_devices_comparison(devices_to_import, netim, devices_with_access_addresses=None):
+def sync_servicenow_netim_device_name_key(device_name):
+	# Names are compared as lower case short hostnames, so FQDNs match their hostname
+	device_name = device_name.strip()
+	if '.' in device_name:
+		device_name = device_name.split('.')[0]
+	return device_name.lower()
+
+def sync_netim_devices_index(netim_devices):
+	# Index NetIM devices by each of their names; the first device in NetIM order wins, as with a linear search
+	netim_index = {}
+	for netim_device in netim_devices:
+		if NETIM_DEVICE_NAME not in netim_device:
+			logger.debug(f"Skipping device with no field {NETIM_DEVICE_NAME}")
+			continue
+		for name_field in [NETIM_DEVICE_NAME, NETIM_DEVICE_DISPLAYNAME, NETIM_DEVICE_DEVICENAME]:
+			name = netim_device.get(name_field)
+			if name == None:
+				continue
+			key = sync_servicenow_netim_device_name_key(name)
+			if key not in netim_index:
+				netim_index[key] = netim_device
+	return netim_index
+
+def sync_netim_device_address(netim_device):
+	netim_device_address = None
+	if NETIM_DEVICE_ACCESSADDRESS in netim_device and netim_device[NETIM_DEVICE_ACCESSADDRESS] != None:
+		netim_device_address = netim_device[NETIM_DEVICE_ACCESSADDRESS].strip()
+
+	# If address was not found in the first location, continue searching
+	if netim_device_address == None or netim_device_address == "":
+		if NETIM_DEVICE_ACCESSINFO in netim_device and \
+			NETIM_DEVICE_ACCESSADDRESS in netim_device[NETIM_DEVICE_ACCESSINFO]:
+			netim_device_address = netim_device[NETIM_DEVICE_ACCESSINFO][NETIM_DEVICE_ACCESSADDRESS].strip()
+
+	return netim_device_address
+
+def sync_servicenow_netim_devices_comparison(devices_to_import, netim, devices_with_access_addresses=None,
+	netim_index=None):
 
 	comparison_dict = {}	
 	comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_NEW] = []
 	comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_DIFFERENT] = []
 	comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_NO_UPDATES] = []
 
-	# Get devices from NetIM
-	netim_devices = sync_netim_devices_import(netim)
+	# Get devices from NetIM, unless an index has already been built
+	if netim_index == None:
+		netim_index = sync_netim_devices_index(sync_netim_devices_import(netim))
 
 	# Iterate over devices from ServiceNow, comparing name and address to what is already in NetIM
 	for device_under_consideration in devices_to_import:
 		found_device = False
 		found_address = False
 
-		for netim_device in netim_devices:
-			# Compare by device name
-			if NETIM_DEVICE_NAME not in netim_device:
-				logger.debug(f"Skipping device with no field {NETIM_DEVICE_NAME}")
-				continue
-			
-			if sync_servicenow_netim_device_name_comparison(device_under_consideration, netim_device) == True:
-				found_device = True
-
-				# Find address in the data from NetIM
-				netim_device_address = None
-				if NETIM_DEVICE_ACCESSADDRESS in netim_device:
-					netim_device_address = netim_device[NETIM_DEVICE_ACCESSADDRESS].strip()
-
-				# If address has not changed and was not found in the first location, continue searching
-				if netim_device_address == None or netim_device_address == "":
-					if NETIM_DEVICE_ACCESSINFO in netim_device and \
-						NETIM_DEVICE_ACCESSADDRESS in netim_device[NETIM_DEVICE_ACCESSINFO]:
-						netim_device_address = netim_device[NETIM_DEVICE_ACCESSINFO][NETIM_DEVICE_ACCESSADDRESS].strip()
-
-				# Compare ServiceNow address for device with NetIM's address
-				if devices_with_access_addresses == None:
-					if NETIM_DEVICE_ACCESSADDRESS in servicenow_device:
-						servicenow_device_address = servicenow_device[NETIM_DEVICE_ACCESSADDRESS]
-						if servicenow_address == netim_device_address:
-							found_address = True
-				# If available, use the original device address dictionary to get full list of available access addresses
-				else:
-					servicenow_device_name = device_under_consideration[NETIM_DEVICE_NAME]
-					servicenow_device_address_list = []
-					if servicenow_device_name in devices_with_access_addresses:
-						servicenow_device_address_list = devices_with_access_addresses[servicenow_device_name]
-				
-					for servicenow_device_address in servicenow_device_address_list:
-						if servicenow_device_address == netim_device_address:
-							found_address = True
-							break
-				break
-
 		if NETIM_DEVICE_NAME in device_under_consideration:
 			servicenow_device_name = device_under_consideration[NETIM_DEVICE_NAME]
+			netim_device = netim_index.get(sync_servicenow_netim_device_name_key(servicenow_device_name))
 		else:
+			logger.debug(f'Missing name in passed information from ServiceNow')
 			servicenow_device_name = 'Unknown'
+			netim_device = None
+
+		if netim_device != None:
+			found_device = True
+			netim_device_address = sync_netim_device_address(netim_device)
+
+			# Compare ServiceNow address for device with NetIM's address
+			if devices_with_access_addresses == None:
+				if NETIM_DEVICE_ACCESSADDRESS in device_under_consideration:
+					if device_under_consideration[NETIM_DEVICE_ACCESSADDRESS] == netim_device_address:
+						found_address = True
+			# If available, use the original device address dictionary to get full list of available access addresses
+			else:
+				servicenow_device_address_list = []
+				if servicenow_device_name in devices_with_access_addresses:
+					servicenow_device_address_list = devices_with_access_addresses[servicenow_device_name]
+				if netim_device_address in servicenow_device_address_list:
+					found_address = True
+
 		if found_device == True:
 			logger.info(f"Found device {servicenow_device_name}")
 			if found_address == True:
@@ -895,15 +1891,277 @@ def sync_servicenow_netim_devices_comparison(devices_to_import, netim, devices_w
 	
 	return comparison_dict
 
-def sync_servicenow_netim_sites_comparison(sites_to_import, netim, summary):
+# Out-of-core comparison: records are sorted in runs of this many records, and at most this many runs are merged at once
+SYNC_EXTERNAL_RUN_SIZE = 100000
+SYNC_EXTERNAL_MERGE_FANIN = 64
+
+def sync_external_run_write(sorted_records, directory):
+	run_handle, run_path = tempfile.mkstemp(suffix='.run', dir=directory)
+	with os.fdopen(run_handle, 'w', encoding='utf-8') as run_file:
+		for record in sorted_records:
+			run_file.write(json.dumps(record) + '\n')
+	return run_path
+
+def sync_external_run_read(run_path):
+	with open(run_path, encoding='utf-8') as run_file:
+		for line in run_file:
+			yield json.loads(line)
+
+def sync_external_runs_merge(run_paths):
+	# Merge sorted runs into one sorted stream, removing each run once it has been read
+	try:
+		yield from heapq.merge(*[sync_external_run_read(run_path) for run_path in run_paths])
+	finally:
+		for run_path in run_paths:
+			try:
+				os.remove(run_path)
+			except:
+				pass
+
+def sync_external_sort(records, directory, run_size=SYNC_EXTERNAL_RUN_SIZE, fanin=SYNC_EXTERNAL_MERGE_FANIN):
+	# Sort records (lists of JSON values, compared item by item) holding at most run_size of them in memory:
+	# sorted runs are written to files in directory and then merged, at most fanin files at a time
+	run_paths = []
+	buffer = []
+	for record in records:
+		buffer.append(record)
+		if len(buffer) >= run_size:
+			buffer.sort()
+			run_paths.append(sync_external_run_write(buffer, directory))
+			buffer = []
+	if len(buffer) > 0:
+		buffer.sort()
+		run_paths.append(sync_external_run_write(buffer, directory))
+		buffer = []
+
+	while len(run_paths) > fanin:
+		merged_run_paths = []
+		for run_index in range(0, len(run_paths), fanin):
+			merged_run_paths.append(sync_external_run_write(
+				sync_external_runs_merge(run_paths[run_index:run_index + fanin]), directory))
+		run_paths = merged_run_paths
+
+	yield from sync_external_runs_merge(run_paths)
+
+class SyncExternalResults():
+	"""Comparison results spilled to an unnamed temporary file
+
+	Counted and iterated like the lists of the in-memory comparison, so the reports and reconcile can take
+	either, but only one result is held in memory at a time.
+	"""
+
+	def __init__(self, directory=None):
+		self.file = tempfile.TemporaryFile(dir=directory)
+		self.count = 0
+
+	def append(self, value):
+		self.file.seek(0, os.SEEK_END)
+		self.file.write((json.dumps(value) + '\n').encode('utf-8'))
+		self.count += 1
+
+	def __len__(self):
+		return self.count
+
+	def __iter__(self):
+		# Keep a position of its own, so that reading does not get in the way of other readers or appends
+		position = 0
+		for index in range(self.count):
+			self.file.seek(position)
+			line = self.file.readline()
+			position = self.file.tell()
+			yield json.loads(line)
+
+	def close(self):
+		self.file.close()
+
+def sync_netim_devices_external_records(netim_devices):
+	# One (key, NetIM order, address) record per distinct name key of each device; sorting on NetIM order keeps
+	# the first device in NetIM order for a key, as sync_netim_devices_index() does
+	for sequence, netim_device in enumerate(netim_devices):
+		if NETIM_DEVICE_NAME not in netim_device:
+			logger.debug(f"Skipping device with no field {NETIM_DEVICE_NAME}")
+			continue
+		netim_device_address = sync_netim_device_address(netim_device)
+		keys = set()
+		for name_field in [NETIM_DEVICE_NAME, NETIM_DEVICE_DISPLAYNAME, NETIM_DEVICE_DEVICENAME]:
+			name = netim_device.get(name_field)
+			if name == None:
+				continue
+			key = sync_servicenow_netim_device_name_key(name)
+			if key not in keys:
+				keys.add(key)
+				yield [key, sequence, netim_device_address]
+
+def sync_servicenow_devices_external_records(devices_to_import, devices_with_access_addresses=None):
+	# One (key, ServiceNow order, name, addresses, named) record per device
+	for sequence, device in enumerate(devices_to_import):
+		if NETIM_DEVICE_NAME in device:
+			servicenow_device_name = device[NETIM_DEVICE_NAME]
+			key = sync_servicenow_netim_device_name_key(servicenow_device_name)
+			named = True
+		else:
+			logger.debug(f'Missing name in passed information from ServiceNow')
+			servicenow_device_name = 'Unknown'
+			key = ''
+			named = False
+
+		if devices_with_access_addresses == None:
+			addresses = []
+			if NETIM_DEVICE_ACCESSADDRESS in device:
+				addresses = [device[NETIM_DEVICE_ACCESSADDRESS]]
+		else:
+			addresses = devices_with_access_addresses.get(servicenow_device_name, [])
+
+		yield [key, sequence, servicenow_device_name, addresses, named]
+
+def sync_servicenow_netim_devices_external_comparison(devices_to_import, netim_devices,
+	devices_with_access_addresses=None, run_size=SYNC_EXTERNAL_RUN_SIZE, directory=None):
+	# Same classification as sync_servicenow_netim_devices_comparison(), but as a sort-merge join of both sides
+	# sorted by name key in temporary files, so no index of the NetIM devices is held in memory; devices are
+	# listed in name key order, and the results are written to temporary files as they are found
+	comparison_dict = {}
+	comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_NEW] = SyncExternalResults(directory)
+	comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_DIFFERENT] = SyncExternalResults(directory)
+	comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_NO_UPDATES] = SyncExternalResults(directory)
+
+	with tempfile.TemporaryDirectory(prefix='sync_comparison_', dir=directory) as temporary_directory:
+		servicenow_sorted = sync_external_sort(
+			sync_servicenow_devices_external_records(devices_to_import, devices_with_access_addresses),
+			temporary_directory, run_size)
+		netim_sorted = sync_external_sort(sync_netim_devices_external_records(netim_devices), temporary_directory,
+			run_size)
+		try:
+			netim_record = next(netim_sorted, None)
+			for key, sequence, servicenow_device_name, addresses, named in servicenow_sorted:
+				while netim_record != None and netim_record[0] < key:
+					netim_record = next(netim_sorted, None)
+
+				if named == True and netim_record != None and netim_record[0] == key:
+					logger.info(f"Found device {servicenow_device_name}")
+					if netim_record[2] in addresses:
+						comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_NO_UPDATES].append(servicenow_device_name)
+					else:
+						comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_DIFFERENT].append(servicenow_device_name)
+				else:
+					logger.info(f"Did not find device {servicenow_device_name}")
+					comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_NEW].append(servicenow_device_name)
+		finally:
+			servicenow_sorted.close()
+			netim_sorted.close()
+
+	return comparison_dict
+
+SYNC_FUZZY_SUFFIXES = ['-mgmt', '-mgt', '-oob', '-ilo', '-idrac', '-console']
+SYNC_FUZZY_SUGGESTIONS = 3
+# Trigrams shared by more names than this (e.g. a common 'rtr' prefix) are too common to narrow down candidates
+SYNC_FUZZY_MAX_POSTINGS = 500
+
+def sync_fuzzy_name_normalize(device_name):
+	# Short hostname without management suffixes and punctuation, so rtr-atl-01-mgmt and rtratl01 are equal
+	key = sync_servicenow_netim_device_name_key(device_name)
+	for suffix in SYNC_FUZZY_SUFFIXES:
+		if key.endswith(suffix) and len(key) > len(suffix):
+			key = key[:-len(suffix)]
+			break
+	return ''.join(character for character in key if character.isalnum())
+
+def sync_fuzzy_name_numbers(device_name):
+	# Numbers in the name, by value; devices in a numbered fleet (core-sw-nyc-0101, -0102) are never the same
+	return tuple(int(number) for number in re.findall(r'[0-9]+', sync_servicenow_netim_device_name_key(device_name)))
+
+def sync_fuzzy_trigrams(normalized_name):
+	padded = f"$${normalized_name}$"
+	return set(padded[index:index + 3] for index in range(len(padded) - 2))
+
+def sync_fuzzy_index(netim_index):
+	# Inverted index from trigram to the NetIM devices whose normalized names contain it
+	fuzzy_index = {}
+	fuzzy_index['names'] = []
+	fuzzy_index['trigrams'] = []
+	fuzzy_index['numbers'] = []
+	fuzzy_index['postings'] = {}
+	seen = set()
+	for netim_device in netim_index.values():
+		if id(netim_device) in seen:
+			continue
+		seen.add(id(netim_device))
+		normalized_names = set()
+		for name_field in [NETIM_DEVICE_NAME, NETIM_DEVICE_DISPLAYNAME, NETIM_DEVICE_DEVICENAME]:
+			name = netim_device.get(name_field)
+			if name != None:
+				normalized_names.add((sync_fuzzy_name_normalize(name), sync_fuzzy_name_numbers(name)))
+		for normalized_name, numbers in sorted(normalized_names):
+			if normalized_name == '':
+				continue
+			trigrams = sync_fuzzy_trigrams(normalized_name)
+			entry = len(fuzzy_index['names'])
+			fuzzy_index['names'].append(netim_device[NETIM_DEVICE_NAME])
+			fuzzy_index['trigrams'].append(trigrams)
+			fuzzy_index['numbers'].append(numbers)
+			for trigram in trigrams:
+				if trigram not in fuzzy_index['postings']:
+					fuzzy_index['postings'][trigram] = []
+				fuzzy_index['postings'][trigram].append(entry)
+	return fuzzy_index
+
+def sync_fuzzy_lookup(device_name, fuzzy_index, threshold):
+	trigrams = sync_fuzzy_trigrams(sync_fuzzy_name_normalize(device_name))
+	numbers = sync_fuzzy_name_numbers(device_name)
+	postings = fuzzy_index['postings']
+	rare_trigrams = [trigram for trigram in trigrams if len(postings.get(trigram, [])) <= SYNC_FUZZY_MAX_POSTINGS]
+	if len(rare_trigrams) == 0:
+		return []
+
+	# Count shared rare trigrams through the postings, touching only names that share at least one
+	shared_counts = {}
+	for trigram in rare_trigrams:
+		for entry in postings.get(trigram, []):
+			shared_counts[entry] = shared_counts.get(entry, 0) + 1
+
+	# Dice similarity 2|A&B|/(|A|+|B|) can only reach the threshold with enough shared trigrams, and at most
+	# the common trigrams can be shared without showing up in the counts
+	minimum_shared = max(threshold * len(trigrams) / 2 - (len(trigrams) - len(rare_trigrams)), 1)
+	best_scores = {}
+	for entry, shared_count in shared_counts.items():
+		if shared_count < minimum_shared or fuzzy_index['numbers'][entry] != numbers:
+			continue
+		entry_trigrams = fuzzy_index['trigrams'][entry]
+		score = 2 * len(trigrams & entry_trigrams) / (len(trigrams) + len(entry_trigrams))
+		if score < threshold:
+			continue
+		name = fuzzy_index['names'][entry]
+		if score > best_scores.get(name, 0):
+			best_scores[name] = score
+
+	suggestions = sorted(best_scores.items(), key=lambda item: (-item[1], item[0]))
+	return suggestions[:SYNC_FUZZY_SUGGESTIONS]
+
+def sync_servicenow_netim_devices_fuzzy_match(device_comparison, fuzzy_index, threshold):
+	# Devices that would be created but closely resemble an existing NetIM device are suggested as matches instead
+	new_devices = []
+	fuzzy_matches = []
+	for device_name in device_comparison[SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_NEW]:
+		suggestions = sync_fuzzy_lookup(device_name, fuzzy_index, threshold)
+		if len(suggestions) > 0:
+			fuzzy_matches.append({'name':device_name, 'suggestions':suggestions})
+		else:
+			new_devices.append(device_name)
+	logger.info("{} of {} new device(s) closely match existing NetIM devices".format(len(fuzzy_matches),
+		len(device_comparison[SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_NEW])))
+
+	device_comparison[SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_NEW] = new_devices
+	device_comparison[SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_FUZZY] = fuzzy_matches
+
+	return device_comparison
+
+def sync_servicenow_netim_sites_comparison(sites_to_import, netim, summary, groups=None):
 	comparison_dict = {}
 	comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_SITES_EXISTING] = []
 	comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_SITES_NEW] = []
 
-	groups_json = netim.get_all_groups()
-	groups = []
-	if 'items' in groups_json:
-		groups = groups_json['items']
+	# Get groups from NetIM, unless they are already known
+	if groups == None:
+		groups = sync_netim_groups_import(netim)
 	if len(groups) == 0:
 		logger.info('The list of groups/sites returned from NetIM was empty.')
 
@@ -926,7 +2184,7 @@ def sync_servicenow_netim_sites_comparison(sites_to_import, netim, summary):
 
 	return comparison_dict
 
-def sync_servicenow_netim_location_validation(sites_to_import, netim):
+def sync_servicenow_netim_location_validation(sites_to_import, netim, cache=None):
 
 	comparison_dict = {}
 	comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_MATCH] = []
@@ -938,13 +2196,24 @@ def sync_servicenow_netim_location_validation(sites_to_import, netim):
 	comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_CITY_NOT_FOUND] = []
 	comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_COORDINATES_MISSING] = []
 
-	region_cache = {}
-	city_cache = {}
-
-	countries_json = netim.get_all_countries()
-	countries = []
-	if 'items' in countries_json:
-		countries = countries_json['items']
+	# Countries, regions and cities are reference data, so a cache passed in can be kept across runs
+	if cache == None:
+		cache = {}
+	if 'regions' not in cache:
+		cache['regions'] = {}
+	if 'cities' not in cache:
+		cache['cities'] = {}
+	region_cache = cache['regions']
+	city_cache = cache['cities']
+
+	if 'countries' in cache:
+		countries = cache['countries']
+	else:
+		countries_json = netim.get_all_countries()
+		countries = []
+		if 'items' in countries_json:
+			countries = countries_json['items']
+			cache['countries'] = countries
 
 	for site in sites_to_import:
 		# Do a quick check in this loop to see if coordinates are missing
@@ -958,7 +2227,7 @@ def sync_servicenow_netim_location_validation(sites_to_import, netim):
 		# Case: Country is empty
 		site_country = site[NETIM_SITE_COUNTRY]
 		if site_country  == "":
-			country_empty = True
+			comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_COUNTRY_EMPTY].append(site_name)
 			continue
 
 		for country in countries:
@@ -990,14 +2259,16 @@ def sync_servicenow_netim_location_validation(sites_to_import, netim):
 							break
 						
 						# Use cache
+						# Region names repeat across countries, so key the city cache by region ID
 						cities = []
-						if region_name in city_cache:
-							cities = city_cache[region_name]
+						region_id = region[NETIM_REGION_ID]
+						if region_id in city_cache:
+							cities = city_cache[region_id]
 						else:
-							cities_json = netim.get_cities_by_region_id(region[NETIM_REGION_ID])
+							cities_json = netim.get_cities_by_region_id(region_id)
 							if cities_json != None and 'items' in cities_json:
 								cities = cities_json['items']
-								city_cache[region_name] = cities
+								city_cache[region_id] = cities
 
 						for city in cities:
 							city_name = city[NETIM_CITY_NAME]
@@ -1019,7 +2290,7 @@ def sync_servicenow_netim_location_validation(sites_to_import, netim):
 				elif city_empty == True:
 					comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_CITY_EMPTY].append(site_name)
 				else:
-					comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_CITY_NOT_FOUND] = []
+					comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_CITY_NOT_FOUND].append(site_name)
 			elif region_empty == True:
 				comparison_dict[SYNC_SERVICENOW_NETIM_COMPARISON_LOCATION_REGION_EMPTY].append(site_name)
 			else:
@@ -1035,6 +2306,9 @@ def sync_servicenow_netim_location_validation(sites_to_import, netim):
 
 NETIM_CUSTOM_ATTRIBUTE_LASTSYNCED = 'Timestamp Synchronized with CMDB'
 NETIM_CUSTOM_ATTRIBUTE_LASTSYNCED_DESCRIPTION = 'Human readable value of when device was created from ServiceNow sync'
+# UTC ISO 8601, so that values sort and compare as strings; values written before used the legacy local time format
+NETIM_CUSTOM_ATTRIBUTE_LASTSYNCED_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+NETIM_CUSTOM_ATTRIBUTE_LASTSYNCED_LEGACY_FORMAT = '%m/%d/%Y %H:%M:%S'
 NETIM_CUSTOM_ATTRIBUTE_CMDB_ID = 'CI ID'
 NETIM_CUSTOM_ATTRIBUTE_CMDB_ID_DESCRIPTION = 'ServiceNow CMDB Configuration Item (CI) Identifier'
 
@@ -1044,40 +2318,61 @@ NETIM_COUNTRY_ID = 'id'
 NETIM_REGION_NAME = 'name'
 NETIM_REGION_ID = 'id'
 NETIM_CITY_NAME = 'name'
+NETIM_CITY_ID = 'id'
 
-def sync_netim_custom_attribute_devices_cmdb_id(netim, device_names, devices):
-	# Add custom attribute to NetIM devices for CMDB CI
-	devices_to_update = [device for device in devices if device[NETIM_DEVICE_NAME] in device_names]
-	
+def sync_netim_custom_attribute_id(netim, attribute_name, attribute_description, inventory=None):
 	# Find if the attribute has already been added to NetIM
-	attribute_id = netim.get_custom_attribute_id_by_name(NETIM_CUSTOM_ATTRIBUTE_CMDB_ID)
+	if inventory != None:
+		attribute_id = inventory.attribute_id(netim, attribute_name)
+	else:
+		attribute_id = netim.get_custom_attribute_id_by_name(attribute_name)
+	if attribute_id != -1:
+		return attribute_id
 
 	# If the custom attribute has not been added to NetIM, add it and find its newly created attribute ID
-	response = None
-	if attribute_id == -1:
-		try:
-			response = netim.add_custom_attribute(NETIM_CUSTOM_ATTRIBUTE_CMDB_ID,
-				NETIM_CUSTOM_ATTRIBUTE_CMDB_ID_DESCRIPTION)
-			if response == None:
-				logger.info("Failed to create Custom Attribute '{}' in NetIM".format(NETIM_CUSTOM_ATTRIBUTE_CMDB_ID))
-				return
-		except:
-			logger.debug("Exception when adding Custom Attribute to NetIM.")
-			raise
+	try:
+		response = netim.add_custom_attribute(attribute_name, attribute_description)
+		if response == None:
+			logger.info("Failed to create Custom Attribute '{}' in NetIM".format(attribute_name))
+			return -1
+	except:
+		logger.debug("Exception when adding Custom Attribute to NetIM.")
+		raise
 
 	# Provide time for the attribute to be processed
 	time.sleep(2)
 
+	if inventory != None:
+		return inventory.attribute_id(netim, attribute_name)
+	return netim.get_custom_attribute_id_by_name(attribute_name)
+
+def sync_netim_custom_attribute_devices_cmdb_id(netim, device_names, devices, inventory=None, attribute_id=None):
+	# Add custom attribute to NetIM devices for CMDB CI
+	device_names = set(device_names)
+	devices_to_update = [device for device in devices if device[NETIM_DEVICE_NAME] in device_names]
+
+	# Callers running in parallel find or add the attribute once beforehand and pass its ID
+	if attribute_id == None:
+		attribute_id = sync_netim_custom_attribute_id(netim, NETIM_CUSTOM_ATTRIBUTE_CMDB_ID,
+			NETIM_CUSTOM_ATTRIBUTE_CMDB_ID_DESCRIPTION, inventory)
+	if attribute_id == -1:
+		return
+
 	# Now add Custom Attribute Value for each device
 	response = None
 	for device in devices_to_update:
 		try:
-			device_id = netim.get_device_id_by_device_name(device[NETIM_DEVICE_NAME])
+			if inventory != None:
+				device_id = inventory.device_id(netim, device[NETIM_DEVICE_NAME])
+			else:
+				device_id = netim.get_device_id_by_device_name(device[NETIM_DEVICE_NAME])
 			if device_id != -1:
 				response = netim.add_custom_attribute_values(NETIM_CUSTOM_ATTRIBUTE_CMDB_ID, 
 					device[NETIM_DEVICE_CMDB_ID], device_ids=[device_id])
 				if response == None:
 					logger.debug("Unable to add Custom Attribute Value for device")
+				elif inventory != None:
+					inventory.attribute_device_values_reset(NETIM_CUSTOM_ATTRIBUTE_CMDB_ID, device_id)
 
 		except NameError as e:
 			logger.debug(f"Name error: {e}")
@@ -1089,46 +2384,48 @@ def sync_netim_custom_attribute_devices_cmdb_id(netim, device_names, devices):
 
 	return 
 
-def sync_netim_custom_attribute_devices_timestamp(netim, devices):
+def sync_netim_custom_attribute_devices_timestamp(netim, devices, inventory=None, attribute_id=None):
 
 	# Add custom attribute to NetIM devices for synchronization time
-	attribute_id = netim.get_custom_attribute_id_by_name(NETIM_CUSTOM_ATTRIBUTE_LASTSYNCED)
-
-	# If the synchronization custom attribute has not been added to NetIM, add it and find its newly
-	# created attribute ID
-	response = None
+	if attribute_id == None:
+		attribute_id = sync_netim_custom_attribute_id(netim, NETIM_CUSTOM_ATTRIBUTE_LASTSYNCED,
+			NETIM_CUSTOM_ATTRIBUTE_LASTSYNCED_DESCRIPTION, inventory)
 	if attribute_id == -1:
-		response = netim.add_custom_attribute(NETIM_CUSTOM_ATTRIBUTE_LASTSYNCED,
-			NETIM_CUSTOM_ATTRIBUTE_LASTSYNCED_DESCRIPTION)
-		if response == None:
-			logger.debug("Failed to create Custom Attribute for synchronization time in NetIM")
-
-	# Provide time for the attribute to be processed
-	time.sleep(2)
+		logger.debug("Failed to create Custom Attribute for synchronization time in NetIM")
+		return
 
 	# Get time stamp value
-	current_time = datetime.datetime.now()
-	current_time_str = current_time.strftime('%m/%d/%Y %H:%M:%S')
+	current_time = datetime.datetime.now(datetime.timezone.utc)
+	current_time_str = current_time.strftime(NETIM_CUSTOM_ATTRIBUTE_LASTSYNCED_FORMAT)
 	logger.info(f"Setting synchronization timestamp in NetIM to {current_time_str}")
 
 	response = None
 	try:
 		# Loop over the devices, and if the device already has a value, update it
 		for device in devices:
-			device_id = netim.get_device_id_by_device_name(device[NETIM_DEVICE_NAME])
-			if device_id != -1:
-				values = netim.get_custom_attribute_values_for_device_by_attribute_name(device_id, NETIM_CUSTOM_ATTRIBUTE_LASTSYNCED)
+			if inventory != None:
+				device_id = inventory.device_id(netim, device[NETIM_DEVICE_NAME])
 			else:
+				device_id = netim.get_device_id_by_device_name(device[NETIM_DEVICE_NAME])
+			if device_id == -1:
 				continue
+			if inventory != None:
+				values = inventory.attribute_device_values(netim, NETIM_CUSTOM_ATTRIBUTE_LASTSYNCED, device_id)
+			else:
+				values = netim.get_custom_attribute_values_for_device_by_attribute_name(device_id, NETIM_CUSTOM_ATTRIBUTE_LASTSYNCED)
 
 			response = None
 			if len(values) == 0:
 				# Add time stamp value to NetIM
 				response = netim.add_custom_attribute_values(NETIM_CUSTOM_ATTRIBUTE_LASTSYNCED, current_time_str, device_ids=[device_id]) 
+				if response != None and inventory != None:
+					inventory.attribute_device_values_reset(NETIM_CUSTOM_ATTRIBUTE_LASTSYNCED, device_id)
 			elif len(values) > 0:
 				if 'id' in values[0]:
 					value_id = values[0]['id']
 					response = netim.update_custom_attribute_value_from_id(NETIM_CUSTOM_ATTRIBUTE_LASTSYNCED, value_id, current_time_str)
+					if response != None:
+						values[0]['value'] = current_time_str
 				if len(values) > 1:
 					logger.debug(f"More than one Custom Attribute Value found for {NETIM_CUSTOM_ATTRIBUTE_LASTSYNCED}")
 					logger.debug(f"Only one value is expected.")
@@ -1140,7 +2437,7 @@ def sync_netim_custom_attribute_devices_timestamp(netim, devices):
 
 	return
 
-def sync_netim_sites_create(netim, site_names, sites):
+def sync_netim_sites_create(netim, site_names, sites, inventory=None):
 
 	created_sites_ids = []
 	sites_to_add = [site for site in sites if site[NETIM_SITE_NAME] in site_names]
@@ -1151,13 +2448,18 @@ def sync_netim_sites_create(netim, site_names, sites):
 			time.sleep(2)
 			site_id = netim.get_group_id_by_group_name(site_to_add[NETIM_SITE_NAME])
 			created_sites_ids.append(site_id)
+			if inventory != None and site_id != -1:
+				inventory.group_added(site_to_add[NETIM_SITE_NAME], site_id)
 		except:
 			logger.info("Failed to add group {}".format(site_to_add[NETIM_SITE_NAME]))
 			logger.debug("Unexpected error {}".format(sys.exc_info()[0]))
 
 	return created_sites_ids
 
-def sync_netim_sites_devices_add(netim, devices_to_add):
+def sync_netim_sites_devices_add(netim, devices_to_add, inventory=None):
+
+	if inventory != None:
+		return sync_netim_sites_devices_add_grouped(netim, devices_to_add, inventory)
 
 	for device in devices_to_add:
 		try:
@@ -1174,18 +2476,50 @@ def sync_netim_sites_devices_add(netim, devices_to_add):
 			logger.debug("Unexpected error {}".format(sys.exc_info()[0]))
 	return
 
-def sync_netim_devices_create(netim, device_names, devices):
+def sync_netim_sites_devices_add_grouped(netim, devices_to_add, inventory):
+
+	# With device IDs and memberships from the inventory, add each group's new members in one request
+	group_devices = {}
+	for device in devices_to_add:
+		group_name = device[NETIM_DEVICE_GROUP]
+		if group_name == '':
+			continue
+		device_id = inventory.device_id(netim, device[NETIM_DEVICE_NAME])
+		if device_id == -1 or device_id in inventory.group_members(group_name):
+			continue
+		if group_name not in group_devices:
+			group_devices[group_name] = []
+		group_devices[group_name].append(device_id)
+
+	for group_name, device_ids in group_devices.items():
+		try:
+			netim.add_devices_to_group(group_name, device_ids)
+			inventory.devices_grouped(group_name, device_ids)
+			time.sleep(2)
+		except:
+			logger.info("Failed to add {} device(s) to group {}".format(len(device_ids), group_name))
+			logger.debug("Unexpected error {}".format(sys.exc_info()[0]))
+	return
+
+def sync_netim_devices_create(netim, device_names, devices, inventory=None):
 
 	created_devices_ids = []
+	device_names = set(device_names)
 	devices_to_add = [device for device in devices if device[NETIM_DEVICE_NAME] in device_names]
 
 	for device_to_add in devices_to_add:
+		# The inventory may already know a device created since the comparison, e.g. in an earlier cycle
+		if inventory != None and inventory.device(device_to_add[NETIM_DEVICE_NAME]) != None:
+			continue
 		try:
 			response = netim.add_device_without_detail(device_to_add[NETIM_DEVICE_NAME], 
 				device_to_add[NETIM_DEVICE_ACCESSADDRESS])
 			time.sleep(2)
 			device_id = netim.get_device_id_by_device_name(device_to_add[NETIM_DEVICE_NAME])
 			created_devices_ids.append(device_id)
+			if inventory != None and device_id != -1:
+				inventory.device_added(device_to_add[NETIM_DEVICE_NAME], device_to_add[NETIM_DEVICE_ACCESSADDRESS],
+					device_id)
 		except NameError as e:
 			logger.info("Failed to add device {}".format(device_to_add[NETIM_DEVICE_NAME]))
 			logger.debug(f"NameError: {e}")
@@ -1195,6 +2529,136 @@ def sync_netim_devices_create(netim, device_names, devices):
 
 	return created_devices_ids
 
+NETIM_DEVICE_ADDRESS_POLICY_FIRST = 'first'
+NETIM_DEVICE_ADDRESS_POLICY_LAST = 'last'
+NETIM_DEVICE_ADDRESS_POLICY_LOWEST = 'lowest'
+NETIM_DEVICE_PATH = '/api/netim/v1/devices/{}'
+NETIM_DEVICES_PATH = '/api/netim/v1/devices'
+NETIM_GROUP_DEVICES_PATH = '/api/netim/v1/groups/{}/devices'
+NETIM_CUSTOM_ATTRIBUTE_VALUES_PATH = '/api/netim/v1/custom-attribute-values'
+
+SYNC_NETIM_ADDRESS_UPDATE_WORKERS = 8
+SYNC_NETIM_ADDRESS_UPDATE_BATCH_SIZE = 100
+SYNC_NETIM_ADDRESS_UPDATE_UPDATED = 'updated'
+SYNC_NETIM_ADDRESS_UPDATE_FAILED = 'failed'
+SYNC_NETIM_ADDRESS_UPDATE_NOT_FOUND = 'not_found'
+SYNC_NETIM_ADDRESS_UPDATE_NO_ADDRESS = 'no_address'
+
+def sync_netim_device_address_select(candidates, policy=NETIM_DEVICE_ADDRESS_POLICY_FIRST):
+	# Choose which of a device's ServiceNow addresses NetIM should use; the first is the one used for new devices
+	candidates = [candidate for candidate in candidates if candidate not in [None, '']]
+	if len(candidates) == 0:
+		return None
+	if policy == NETIM_DEVICE_ADDRESS_POLICY_LAST:
+		return candidates[-1]
+	if policy == NETIM_DEVICE_ADDRESS_POLICY_LOWEST:
+		addresses = []
+		for candidate in candidates:
+			try:
+				address = ipaddress.ip_address(candidate)
+			except ValueError:
+				continue
+			addresses.append((address.version, int(address), candidate))
+		if len(addresses) > 0:
+			return min(addresses)[2]
+	return candidates[0]
+
+def sync_netim_device_address_update(netim, device_id, address):
+	# Use the client's call where it has one; otherwise patch the device resource directly
+	if hasattr(netim, 'update_device_access_address'):
+		return netim.update_device_access_address(device_id, address)
+	path = NETIM_DEVICE_PATH.format(device_id)
+	response = sync_netim_rest_request(netim, 'PATCH', path, {NETIM_DEVICE_ACCESSADDRESS:address})
+
+	# The patched device is normally returned; without it, read the device back rather than assume the write took
+	if type(response) is not dict or NETIM_DEVICE_ACCESSADDRESS not in response:
+		response = sync_netim_rest_request(netim, 'GET', path)
+	if type(response) is not dict or response.get(NETIM_DEVICE_ACCESSADDRESS) != address:
+		found = response.get(NETIM_DEVICE_ACCESSADDRESS) if type(response) is dict else str(response)[:200]
+		raise SyncNetIMResponseError(f"PATCH {path} did not take; the access address is {found}")
+	return response
+
+def sync_netim_devices_address_update_apply(netim, update):
+	result = dict(update)
+	try:
+		sync_netim_device_address_update(netim, update['device_id'], update['address'])
+		result['status'] = SYNC_NETIM_ADDRESS_UPDATE_UPDATED
+	except Exception as e:
+		result['status'] = SYNC_NETIM_ADDRESS_UPDATE_FAILED
+		result['error'] = str(e)
+	return result
+
+def sync_netim_devices_addresses_update(netim, device_names, devices, devices_with_access_addresses=None,
+	policy=NETIM_DEVICE_ADDRESS_POLICY_FIRST, inventory=None, workers=SYNC_NETIM_ADDRESS_UPDATE_WORKERS,
+	batch_size=SYNC_NETIM_ADDRESS_UPDATE_BATCH_SIZE, netim_index=None):
+	import concurrent.futures
+
+	# Shard workers have the shared index of the NetIM devices rather than the inventory
+	if inventory != None:
+		netim_index = inventory.index
+
+	# The names may be results spilled to a file (see --external_comparison), so read them once
+	device_names = list(device_names)
+	device_names_set = set(device_names)
+	devices_by_name = {}
+	for device in devices:
+		if device[NETIM_DEVICE_NAME] in device_names_set:
+			devices_by_name[device[NETIM_DEVICE_NAME]] = device
+
+	# Work out every device's new address and NetIM ID before writing anything
+	results = []
+	updates = []
+	for device_name in device_names:
+		candidates = []
+		if devices_with_access_addresses != None:
+			candidates = devices_with_access_addresses.get(device_name, [])
+		if len(candidates) == 0 and device_name in devices_by_name:
+			candidates = [devices_by_name[device_name].get(NETIM_DEVICE_ACCESSADDRESS)]
+
+		update = {'name':device_name, 'device_id':None, 'old_address':None, 'address':None, 'status':None,
+			'error':None}
+		update['address'] = sync_netim_device_address_select(candidates, policy)
+		netim_device = None
+		if netim_index != None:
+			netim_device = netim_index.get(sync_servicenow_netim_device_name_key(device_name))
+		if netim_device != None:
+			update['old_address'] = sync_netim_device_address(netim_device)
+		if netim_device != None and 'id' in netim_device:
+			update['device_id'] = netim_device['id']
+		else:
+			update['device_id'] = netim.get_device_id_by_device_name(device_name)
+
+		if update['device_id'] in [None, -1]:
+			update['status'] = SYNC_NETIM_ADDRESS_UPDATE_NOT_FOUND
+			results.append(update)
+		elif update['address'] == None:
+			update['status'] = SYNC_NETIM_ADDRESS_UPDATE_NO_ADDRESS
+			results.append(update)
+		else:
+			updates.append(update)
+
+	# Write in batches, with the updates in each batch running concurrently
+	with concurrent.futures.ThreadPoolExecutor(max_workers=max(min(workers, batch_size), 1)) as executor:
+		for index in range(0, len(updates), batch_size):
+			batch = updates[index:index + batch_size]
+			batch_results = list(executor.map(lambda update: sync_netim_devices_address_update_apply(netim, update),
+				batch))
+			for result in batch_results:
+				if result['status'] == SYNC_NETIM_ADDRESS_UPDATE_UPDATED and netim_index != None:
+					netim_device = netim_index.get(sync_servicenow_netim_device_name_key(result['name']))
+					if netim_device != None and inventory != None:
+						inventory.device_address_updated(netim_device, result['address'])
+					elif netim_device != None:
+						netim_device[NETIM_DEVICE_ACCESSADDRESS] = result['address']
+			results.extend(batch_results)
+			logger.info("Updated access addresses for {} of {} device(s)".format(index + len(batch), len(updates)))
+
+			# Provide time for the batch to be processed
+			if index + batch_size < len(updates):
+				time.sleep(2)
+
+	return results
+
 def sync_netim_devices_import(netim):
 	netim_devices_json = netim.get_all_devices()
 	netim_devices = []
@@ -1203,11 +2667,63 @@ def sync_netim_devices_import(netim):
 	logger.info("Retrieved {} device(s) from NetIM".format(len(netim_devices)))
 	return netim_devices
 
-def sync_netim_authenticate(netim_yml):
+SYNC_NETIM_DEVICES_PAGE_SIZE = 1000
+
+class SyncNetIMResponseError(Exception):
+	def __init__(self, message, status=None):
+		super().__init__(message)
+		self.status = status
+
+def sync_netim_rest_request(netim, method, path, body=None):
+	# A NetIM REST call that the client has no method for; a failed request raises with its HTTP status
+	from steelscript.common.exceptions import RvbdHTTPException
+	try:
+		if body == None:
+			return netim.conn.json_request(method, path)
+		return netim.conn.json_request(method, path, body=body)
+	except RvbdHTTPException as e:
+		status = getattr(e, 'status', None)
+		raise SyncNetIMResponseError(f"{method} {path} failed with HTTP status {status}: {e}", status)
+
+def sync_netim_items_paged(netim, path, page_size=SYNC_NETIM_DEVICES_PAGE_SIZE, params={}):
+	# The items of a NetIM list resource a page at a time; a response that is not a page of items raises rather
+	# than cut the list short, since records missing from it would look new or deleted
+	offset = 0
+	while True:
+		page_params = dict(params)
+		page_params['limit'] = page_size
+		page_params['offset'] = offset
+		response = netim.conn.json_request('GET', path, params=page_params)
+		if type(response) is not dict or type(response.get('items')) is not list:
+			raise SyncNetIMResponseError(f"Unexpected response to GET {path}: {str(response)[:200]}")
+		items = response['items']
+		yield from items
+		offset += len(items)
+		if len(items) < page_size:
+			break
+	logger.debug("Retrieved {} item(s) from {} in pages of {}".format(offset, path, page_size))
+	return
+
+def sync_netim_devices_paged(netim, page_size=SYNC_NETIM_DEVICES_PAGE_SIZE):
+	# The NetIM devices a page at a time, for callers that do not keep them
+	yield from sync_netim_items_paged(netim, NETIM_DEVICES_PATH, page_size)
+
+def sync_netim_password_get(netim_yml):
 	netim_hostname, netim_username, netim_password = credentials_get(netim_yml)
 	if netim_password == None or netim_password == "":
 		print(f"Please provide password for user {netim_username} on NetIM {netim_hostname}")
 		netim_password = getpass.getpass()
+	return netim_password
+
+def sync_netim_authenticate(netim_yml, netim_password=None):
+	netim_hostname, netim_username = credentials_get(netim_yml)[:2]
+	# Worker processes cannot prompt, so they are given the password their parent read or asked for
+	if netim_password == None:
+		netim_password = sync_netim_password_get(netim_yml)
+
+	from steelscript.common.service import UserAuth, Auth
+	from steelscript.common.exceptions import RvbdHTTPException
+	from steelscript.netim.core import NetIM
 
 	netim = None
 	# Authentication to NetIM
@@ -1227,19 +2743,846 @@ def sync_netim_authenticate(netim_yml):
 		logger.debug("Unexpected error {}".format(sys.exc_info()[0]))
 		raise	
 
-	return netim
+	return SyncNetIMSingleFlight(netim)
+
+# Lookups that concurrent workers repeat for the same group, attribute, device, country or region
+SYNC_NETIM_SINGLE_FLIGHT_METHODS = ['get_group_id_by_group_name', 'get_custom_attribute_id_by_name',
+	'get_device_id_by_device_name', 'get_regions_by_country_id', 'get_cities_by_region_id']
+
+class SyncNetIMSingleFlight():
+	"""NetIM client wrapper that coalesces concurrent identical lookups
+
+	While a call to one of SYNC_NETIM_SINGLE_FLIGHT_METHODS is in flight, other threads making the same call
+	wait for it and share its result (or exception) instead of sending their own request. Nothing is kept once
+	the call completes, so later calls still ask NetIM; everything else is passed through to the client.
+	"""
+
+	def __init__(self, netim):
+		self.netim = netim
+		self.lock = threading.Lock()
+		self.in_flight = {}
+		self.coalesced = 0
+
+	def __getattr__(self, name):
+		# Only called for attributes the wrapper does not have itself; before __init__ (unpickling) that is netim
+		if name == 'netim':
+			raise AttributeError(name)
+		attribute = getattr(self.netim, name)
+		if name in SYNC_NETIM_SINGLE_FLIGHT_METHODS:
+			return functools.partial(self.single_flight, name, attribute)
+		return attribute
+
+	def single_flight(self, name, method, *args, **kwargs):
+		key = (name, args, tuple(sorted(kwargs.items())))
+		with self.lock:
+			flight = self.in_flight.get(key)
+			leader = flight == None
+			if leader == True:
+				flight = {'done':threading.Event(), 'result':None, 'error':None}
+				self.in_flight[key] = flight
+			else:
+				self.coalesced += 1
 
-def main ():
+		if leader == False:
+			flight['done'].wait()
+			if flight['error'] != None:
+				raise flight['error']
+			return flight['result']
 
-	parser = argparse.ArgumentParser(description="Python utility to compare data from ServiceNow to \
-		data in NetIM")
-	parser.add_argument('--servicenow_yml', help='ServiceNow account credentials')
-	parser.add_argument('--netim_yml', help='NetIM account credentials')
-	parser.add_argument('--servicenow_devices_csv', help='Export of INPUT devices from ServiceNow')
-	parser.add_argument('--servicenow_locations_csv', help='Export of INPUT devices from ServiceNow')
-	parser.add_argument('--summary', type=bool, help='Print summary or full report detail')
-	parser.add_argument('--reconcile', type=bool, help='Create devices/groups in NetIM for missing objects')
-	args = parser.parse_args()
+		try:
+			flight['result'] = method(*args, **kwargs)
+		except BaseException as e:
+			flight['error'] = e
+			raise
+		finally:
+			with self.lock:
+				del self.in_flight[key]
+			flight['done'].set()
+
+		return flight['result']
+
+#----- NetIM inventory functions
+
+SYNC_NETIM_INVENTORY_MAX_AGE = 3600
+SYNC_NETIM_INVENTORY_VERSION = 3
+SYNC_NETIM_INVENTORY_WORKERS = 8
+# Custom attributes whose values are read for every device when the inventory is loaded
+SYNC_NETIM_INVENTORY_ATTRIBUTES = [NETIM_CUSTOM_ATTRIBUTE_LASTSYNCED]
+# Device digests are summed modulo this, so that the digest of the devices does not depend on their order
+SYNC_NETIM_DIGEST_MODULUS = 2 ** 256
+
+class SyncNetIMInventory():
+	"""Snapshot of NetIM devices, groups, group memberships and custom attribute values
+
+	Loaded once per run and updated in place as reconcile writes succeed, so that comparison and reconcile do
+	not ask NetIM again for what is already known. Group members are read per group and custom attribute values
+	per attribute when the inventory is loaded; where NetIM does not return them in a usable form, they are
+	read per device as before.
+	"""
+
+	def __init__(self):
+		self.version = SYNC_NETIM_INVENTORY_VERSION
+		self.devices = []
+		self.index = {}
+		self.devices_by_id = {}
+		self.devices_digest = 0
+		self.groups = {}
+		self.memberships = {}
+		self.attribute_ids = {}
+		self.attribute_values = {}
+		self.attribute_values_loaded = set()
+		self.fingerprint = None
+		self.loaded = None
+
+	def load(self, netim, groups, netim_devices=None, load_devices=True):
+		self.devices = []
+		if load_devices == True:
+			if netim_devices == None:
+				netim_devices = sync_netim_devices_import(netim)
+			self.devices = netim_devices
+		self.devices_index()
+		self.groups = {}
+		for group in groups:
+			self.groups[group[NETIM_SITE_NAME].strip()] = group
+		self.memberships = {}
+		self.attribute_ids = {}
+		self.attribute_values = {}
+		self.attribute_values_loaded = set()
+		if load_devices == True:
+			self.memberships = sync_netim_group_members_import(netim, self.groups)
+			for attribute_name in SYNC_NETIM_INVENTORY_ATTRIBUTES:
+				self.attribute_values_load(netim, attribute_name)
+		self.fingerprint = sync_netim_inventory_fingerprint(self.groups.values(), self.devices_digest)
+		self.loaded = time.time()
+		logger.info("Loaded NetIM inventory of {} device(s) and {} group(s)".format(len(self.devices),
+			len(self.groups)))
+		return
+
+	def devices_index(self):
+		self.index = sync_netim_devices_index(self.devices)
+		self.devices_by_id = {}
+		for device in self.devices:
+			if 'id' in device:
+				self.devices_by_id[device['id']] = device
+		self.devices_digest = sync_netim_devices_digest(self.devices)
+		return
+
+	def device(self, device_name):
+		return self.index.get(sync_servicenow_netim_device_name_key(device_name))
+
+	def device_id(self, netim, device_name):
+		device = self.device(device_name)
+		if device != None and 'id' in device:
+			return device['id']
+		return netim.get_device_id_by_device_name(device_name)
+
+	def device_added(self, device_name, address, device_id):
+		device = {'id':device_id, NETIM_DEVICE_NAME:device_name, NETIM_DEVICE_DISPLAYNAME:device_name,
+			NETIM_DEVICE_DEVICENAME:device_name, NETIM_DEVICE_ACCESSADDRESS:address}
+		self.devices.append(device)
+		self.devices_by_id[device_id] = device
+		key = sync_servicenow_netim_device_name_key(device_name)
+		if key not in self.index:
+			self.index[key] = device
+		# A new device has no custom attribute values yet
+		for attribute_name in self.attribute_values_loaded:
+			self.attribute_values[attribute_name][device_id] = []
+		self.devices_changed(device, 1)
+		return device
+
+	def device_address_updated(self, device, address):
+		self.devices_changed(device, -1)
+		device[NETIM_DEVICE_ACCESSADDRESS] = address
+		self.devices_changed(device, 1)
+		return
+
+	def devices_removed(self, device_ids):
+		# Remove a batch of devices in one pass over the devices and the index
+		device_ids = set(device_ids)
+		removed = set()
+		for device_id in device_ids:
+			device = self.devices_by_id.pop(device_id, None)
+			if device != None:
+				removed.add(id(device))
+				self.devices_changed(device, -1)
+		for values in self.attribute_values.values():
+			for device_id in device_ids:
+				values.pop(device_id, None)
+		for members in self.memberships.values():
+			members.difference_update(device_ids)
+		if len(removed) > 0:
+			self.devices = [netim_device for netim_device in self.devices if id(netim_device) not in removed]
+			self.index = {key:netim_device for key, netim_device in self.index.items() \
+				if id(netim_device) not in removed}
+		return
+
+	def devices_changed(self, device, sign):
+		# Keep the fingerprint in step with NetIM as this script adds, changes and removes devices
+		self.devices_digest = (self.devices_digest + sign * sync_netim_device_digest(device)) % SYNC_NETIM_DIGEST_MODULUS
+		self.fingerprint = sync_netim_inventory_fingerprint(self.groups.values(), self.devices_digest)
+		return
+
+	def group_added(self, group_name, group_id):
+		self.groups[group_name.strip()] = {'id':group_id, NETIM_SITE_NAME:group_name}
+		self.memberships[group_name.strip()] = set()
+		self.fingerprint = sync_netim_inventory_fingerprint(self.groups.values(), self.devices_digest)
+		return
+
+	def group_members(self, group_name):
+		return self.memberships.get(group_name, set())
+
+	def devices_grouped(self, group_name, device_ids):
+		if group_name not in self.memberships:
+			self.memberships[group_name] = set()
+		self.memberships[group_name].update(device_ids)
+		return
+
+	def attribute_id(self, netim, attribute_name):
+		attribute_id = self.attribute_ids.get(attribute_name)
+		if attribute_id == None:
+			attribute_id = netim.get_custom_attribute_id_by_name(attribute_name)
+			# Only remember attributes that exist, so a newly created one is looked up again
+			if attribute_id != -1:
+				self.attribute_ids[attribute_name] = attribute_id
+		return attribute_id
+
+	def attribute_values_load(self, netim, attribute_name):
+		# All values of an attribute in one listing; devices missing from it have no value
+		attribute_id = self.attribute_id(netim, attribute_name)
+		if attribute_id == -1:
+			values = {}
+		else:
+			values = sync_netim_custom_attribute_values_import(netim, attribute_name, attribute_id)
+			if values == None:
+				self.attribute_values[attribute_name] = {}
+				self.attribute_values_loaded.discard(attribute_name)
+				return False
+		self.attribute_values[attribute_name] = values
+		self.attribute_values_loaded.add(attribute_name)
+		return True
+
+	def attribute_device_values(self, netim, attribute_name, device_id):
+		values = self.attribute_values.setdefault(attribute_name, {})
+		device_values = values.get(device_id)
+		if device_values == None:
+			if attribute_name in self.attribute_values_loaded and device_id not in values:
+				device_values = []
+			else:
+				device_values = netim.get_custom_attribute_values_for_device_by_attribute_name(device_id,
+					attribute_name)
+			values[device_id] = device_values
+		return device_values
+
+	def attribute_device_values_reset(self, attribute_name, device_id):
+		# Values added without an ID in the response are read again when next needed
+		self.attribute_values.setdefault(attribute_name, {})[device_id] = None
+		return
+
+	def attribute_values_reset(self, attribute_name):
+		# Values written by other processes (see --shards) are read again in bulk when next needed
+		self.attribute_values.pop(attribute_name, None)
+		self.attribute_values_loaded.discard(attribute_name)
+		return
+
+	def attribute_values_loaded_check(self, netim, attribute_name):
+		# Read an attribute's values in bulk if the inventory was loaded without them
+		if attribute_name not in self.attribute_values_loaded:
+			self.attribute_values_load(netim, attribute_name)
+		return attribute_name in self.attribute_values_loaded
+
+	def to_json(self):
+		inventory_json = {}
+		inventory_json['version'] = self.version
+		inventory_json['devices'] = self.devices
+		inventory_json['groups'] = list(self.groups.values())
+		inventory_json['memberships'] = {group_name:sorted(members, key=str) \
+			for group_name, members in self.memberships.items()}
+		inventory_json['attribute_ids'] = self.attribute_ids
+		# Device IDs are not always strings, so values are kept as pairs rather than as JSON objects
+		inventory_json['attribute_values'] = {attribute_name:[[device_id, device_values] \
+			for device_id, device_values in values.items()] for attribute_name, values in self.attribute_values.items()}
+		inventory_json['attribute_values_loaded'] = sorted(self.attribute_values_loaded)
+		inventory_json['fingerprint'] = self.fingerprint
+		inventory_json['loaded'] = self.loaded
+		return inventory_json
+
+	@classmethod
+	def from_json(cls, inventory_json):
+		inventory = cls()
+		inventory.version = inventory_json['version']
+		inventory.devices = inventory_json['devices']
+		inventory.devices_index()
+		inventory.groups = {group[NETIM_SITE_NAME].strip():group for group in inventory_json['groups']}
+		inventory.memberships = {group_name:set(members) \
+			for group_name, members in inventory_json['memberships'].items()}
+		inventory.attribute_ids = inventory_json['attribute_ids']
+		inventory.attribute_values = {attribute_name:{device_id:device_values for device_id, device_values in pairs} \
+			for attribute_name, pairs in inventory_json['attribute_values'].items()}
+		inventory.attribute_values_loaded = set(inventory_json['attribute_values_loaded'])
+		inventory.fingerprint = inventory_json['fingerprint']
+		inventory.loaded = inventory_json['loaded']
+		return inventory
+
+def sync_netim_groups_import(netim):
+	groups_json = netim.get_all_groups()
+	groups = []
+	if groups_json != None and 'items' in groups_json:
+		groups = groups_json['items']
+	return groups
+
+def sync_netim_group_members_read(netim, group):
+	try:
+		return set(device['id'] for device in sync_netim_items_paged(netim, NETIM_GROUP_DEVICES_PATH.format(group['id'])) \
+			if 'id' in device)
+	except Exception as e:
+		logger.info(f"Unable to read the members of NetIM group {group.get(NETIM_SITE_NAME)}: {e}")
+		return None
+
+def sync_netim_group_members_import(netim, groups, workers=SYNC_NETIM_INVENTORY_WORKERS):
+	# The device IDs in each group, one paged listing per group; groups whose members could not be read start
+	# out with only the members this script adds
+	import concurrent.futures
+	groups = [group for group in groups.values() if group.get('id') != None]
+	memberships = {}
+	with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+		for group, members in zip(groups, executor.map(lambda group: sync_netim_group_members_read(netim, group),
+			groups)):
+			memberships[group[NETIM_SITE_NAME].strip()] = members if members != None else set()
+	logger.info("Read the members of {} NetIM group(s)".format(len(memberships)))
+	return memberships
+
+def sync_netim_custom_attribute_values_import(netim, attribute_name, attribute_id):
+	# Every value of an attribute, by device ID; a value lists the IDs of the devices it was added to (see
+	# add_custom_attribute_values). None if the values could not be read or do not list their devices.
+	values = {}
+	try:
+		for item in sync_netim_items_paged(netim, NETIM_CUSTOM_ATTRIBUTE_VALUES_PATH,
+			params={'attributeId':attribute_id}):
+			if item.get('attributeId', attribute_id) != attribute_id:
+				continue
+			device_ids = item.get('deviceIds')
+			if type(device_ids) is not list:
+				raise SyncNetIMResponseError(f"Custom attribute value without device IDs: {str(item)[:200]}")
+			for device_id in device_ids:
+				values.setdefault(device_id, []).append(item)
+	except Exception as e:
+		logger.info(f"Unable to read the values of custom attribute '{attribute_name}' in bulk: {e}")
+		return None
+	logger.info("Read values of custom attribute '{}' for {} NetIM device(s)".format(attribute_name, len(values)))
+	return values
+
+def sync_netim_device_digest(netim_device):
+	text = f"{netim_device.get('id')}\t{netim_device.get(NETIM_DEVICE_NAME)}\t{sync_netim_device_address(netim_device)}"
+	return int(hashlib.sha256(text.encode('utf-8')).hexdigest(), 16)
+
+def sync_netim_devices_digest(netim_devices):
+	# Sum of the digests of each device's ID, name and address; adding, changing or removing a device only adds
+	# or subtracts its own digest
+	digest = 0
+	for netim_device in netim_devices:
+		digest = (digest + sync_netim_device_digest(netim_device)) % SYNC_NETIM_DIGEST_MODULUS
+	return digest
+
+def sync_netim_inventory_fingerprint(groups, devices_digest):
+	# Changes with any group, and with any device added, deleted, renamed or re-addressed in NetIM
+	digest = hashlib.sha256()
+	digest.update(f"devices\t{devices_digest:064x}\n".encode('utf-8'))
+	for group_id, group_name in sorted((str(group.get('id')), group[NETIM_SITE_NAME].strip()) for group in groups):
+		digest.update(f"{group_id}\t{group_name}\n".encode('utf-8'))
+	return digest.hexdigest()
+
+def sync_netim_inventory_read(inventory_file):
+	try:
+		with open(inventory_file, encoding='utf-8') as inventory_fp:
+			inventory_json = json.load(inventory_fp)
+		if type(inventory_json) is not dict or inventory_json.get('version') != SYNC_NETIM_INVENTORY_VERSION:
+			return None
+		return SyncNetIMInventory.from_json(inventory_json)
+	except FileNotFoundError:
+		return None
+	except:
+		logger.info(f"Unable to read NetIM inventory from {inventory_file}")
+		logger.debug("Unexpected error {}".format(sys.exc_info()[0]))
+		return None
+
+def sync_netim_inventory_write(inventory, inventory_file):
+	temporary_file = inventory_file + '.tmp'
+	with open(temporary_file, 'w', encoding='utf-8') as inventory_fp:
+		json.dump(inventory.to_json(), inventory_fp)
+	os.replace(temporary_file, inventory_file)
+	logger.info(f"Saved NetIM inventory to {inventory_file}")
+	return
+
+def sync_netim_inventory_get(netim, context=None, inventory_file=None, max_age=SYNC_NETIM_INVENTORY_MAX_AGE,
+	load_devices=True):
+	# Reuse the snapshot kept by the daemon or saved by an earlier run while it is recent and NetIM's groups and
+	# devices are unchanged; otherwise index the devices and read the memberships and attribute values again
+	groups = sync_netim_groups_import(netim)
+
+	# Without the devices, the inventory is only of groups, and is neither kept nor saved; devices are looked up
+	# in NetIM as they are needed
+	if load_devices == False:
+		inventory = SyncNetIMInventory()
+		inventory.load(netim, groups, load_devices=False)
+		return inventory
+
+	netim_devices = sync_netim_devices_import(netim)
+	fingerprint = sync_netim_inventory_fingerprint(groups, sync_netim_devices_digest(netim_devices))
+
+	inventory = None
+	if context != None and context['full_refresh'] == False:
+		inventory = context.get('netim_inventory')
+	if inventory == None and inventory_file != None and (context == None or context['full_refresh'] == False):
+		inventory = sync_netim_inventory_read(inventory_file)
+
+	if inventory != None and inventory.fingerprint == fingerprint and time.time() - inventory.loaded < max_age:
+		logger.info("Using NetIM inventory snapshot of {} device(s)".format(len(inventory.devices)))
+	else:
+		inventory = SyncNetIMInventory()
+		inventory.load(netim, groups, netim_devices)
+
+	if context != None:
+		context['netim_inventory'] = inventory
+
+	return inventory
+
+def sync_netim_inventory_save(inventory, inventory_file):
+	if inventory_file == None or inventory == None:
+		return
+	try:
+		sync_netim_inventory_write(inventory, inventory_file)
+	except OSError as e:
+		logger.info(f"Unable to save NetIM inventory to {inventory_file}: {e}")
+	return
+
+#----- NetIM aging functions
+
+SYNC_AGING_ACTION_GROUP = 'group'
+SYNC_AGING_ACTION_RETIRE = 'retire'
+SYNC_AGING_GROUP = 'Aged out of CMDB'
+SYNC_AGING_BATCH_SIZE = 100
+SYNC_AGING_WORKERS = 8
+
+SYNC_AGING_CANDIDATE = 'aged_out'
+SYNC_AGING_GROUPED = 'grouped'
+SYNC_AGING_RETIRED = 'retired'
+SYNC_AGING_FAILED = 'failed'
+
+def sync_aging_timestamp_normalize(value):
+	# Sortable UTC form of a synchronization timestamp, converting values in the legacy local time format
+	if value == None:
+		return None
+	value = value.strip()
+	try:
+		datetime.datetime.strptime(value, NETIM_CUSTOM_ATTRIBUTE_LASTSYNCED_FORMAT)
+		return value
+	except ValueError:
+		pass
+	try:
+		legacy_time = datetime.datetime.strptime(value, NETIM_CUSTOM_ATTRIBUTE_LASTSYNCED_LEGACY_FORMAT)
+	except ValueError:
+		return None
+	return legacy_time.astimezone(datetime.timezone.utc).strftime(NETIM_CUSTOM_ATTRIBUTE_LASTSYNCED_FORMAT)
+
+def sync_aging_index(netim, inventory):
+	# Sorted list of (last synchronized, device ID) for every NetIM device with a synchronization timestamp, from
+	# the timestamp values the inventory read in one listing; values written by this run's timestamp stage are
+	# recent, so they are skipped rather than read again
+	if inventory.attribute_values_loaded_check(netim, NETIM_CUSTOM_ATTRIBUTE_LASTSYNCED) == True:
+		device_values = list(inventory.attribute_values[NETIM_CUSTOM_ATTRIBUTE_LASTSYNCED].items())
+	else:
+		logger.info("Reading synchronization timestamps from NetIM one device at a time")
+		device_ids = list(inventory.devices_by_id.keys())
+		if len(inventory.devices) == 0:
+			device_ids = [netim_device['id'] for netim_device in sync_netim_devices_paged(netim) if 'id' in netim_device]
+		device_values = ((device_id, inventory.attribute_device_values(netim, NETIM_CUSTOM_ATTRIBUTE_LASTSYNCED,
+			device_id)) for device_id in device_ids)
+
+	aging_index = []
+	for device_id, values in device_values:
+		if values == None or len(values) == 0:
+			continue
+		timestamp = sync_aging_timestamp_normalize(values[0].get('value'))
+		if timestamp != None:
+			aging_index.append((timestamp, device_id))
+	aging_index.sort()
+	return aging_index
+
+def sync_aging_candidates(aging_index, cutoff, inventory, cmdb_device_names, netim=None):
+	# Devices last synchronized before the cutoff form a prefix of the sorted index
+	aged_index = aging_index[:bisect.bisect_left(aging_index, (cutoff,))]
+	devices_by_id = inventory.devices_by_id
+	if len(inventory.devices) == 0 and len(aged_index) > 0 and netim != None:
+		# An inventory of groups only has no devices; pick the aged out ones from one pass over the device list
+		aged_ids = set(device_id for timestamp, device_id in aged_index)
+		devices_by_id = {netim_device['id']:netim_device for netim_device in sync_netim_devices_paged(netim) \
+			if netim_device.get('id') in aged_ids}
+
+	cmdb_keys = set(sync_servicenow_netim_device_name_key(device_name) for device_name in cmdb_device_names)
+	candidates = []
+	for timestamp, device_id in aged_index:
+		device = devices_by_id.get(device_id)
+		if device == None:
+			continue
+		device_keys = set(sync_servicenow_netim_device_name_key(device[name_field]) \
+			for name_field in [NETIM_DEVICE_NAME, NETIM_DEVICE_DISPLAYNAME, NETIM_DEVICE_DEVICENAME] \
+			if device.get(name_field) != None)
+		if len(device_keys & cmdb_keys) > 0:
+			continue
+		candidates.append({'name':device.get(NETIM_DEVICE_NAME), 'device_id':device_id,
+			'address':sync_netim_device_address(device), 'last_synchronized':timestamp, 'status':SYNC_AGING_CANDIDATE,
+			'error':None})
+	return candidates
+
+def sync_aging_device_delete(netim, device_id):
+	path = NETIM_DEVICE_PATH.format(device_id)
+	sync_netim_rest_request(netim, 'DELETE', path)
+
+	# Confirm that the device is gone rather than assume the delete took
+	try:
+		sync_netim_rest_request(netim, 'GET', path)
+	except SyncNetIMResponseError as e:
+		if e.status == 404:
+			return
+		raise
+	raise SyncNetIMResponseError(f"DELETE {path} did not take; the device is still in NetIM")
+
+def sync_aging_device_retire(netim, candidate):
+	result = dict(candidate)
+	try:
+		# Use the client's call where it has one; otherwise delete the device resource directly
+		if hasattr(netim, 'delete_device'):
+			netim.delete_device(candidate['device_id'])
+		else:
+			sync_aging_device_delete(netim, candidate['device_id'])
+		result['status'] = SYNC_AGING_RETIRED
+	except Exception as e:
+		result['status'] = SYNC_AGING_FAILED
+		result['error'] = str(e)
+	return result
+
+def sync_aging_apply(netim, candidates, action, inventory, batch_size=SYNC_AGING_BATCH_SIZE,
+	workers=SYNC_AGING_WORKERS):
+	import concurrent.futures
+
+	results = []
+	if action == SYNC_AGING_ACTION_GROUP:
+		# Devices grouped in an earlier run are already where they belong
+		grouped = inventory.group_members(SYNC_AGING_GROUP)
+		candidates = [candidate for candidate in candidates if candidate['device_id'] not in grouped]
+	if action == SYNC_AGING_ACTION_GROUP and len(candidates) > 0:
+		if netim.get_group_id_by_group_name(SYNC_AGING_GROUP) == -1:
+			netim.add_group(SYNC_AGING_GROUP)
+			time.sleep(2)
+			inventory.group_added(SYNC_AGING_GROUP, netim.get_group_id_by_group_name(SYNC_AGING_GROUP))
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=max(min(workers, batch_size), 1)) as executor:
+		for index in range(0, len(candidates), batch_size):
+			batch = candidates[index:index + batch_size]
+			if action == SYNC_AGING_ACTION_GROUP:
+				# One request adds the whole batch to the group
+				device_ids = [candidate['device_id'] for candidate in batch]
+				batch_results = [dict(candidate) for candidate in batch]
+				try:
+					netim.add_devices_to_group(SYNC_AGING_GROUP, device_ids)
+					inventory.devices_grouped(SYNC_AGING_GROUP, device_ids)
+					for result in batch_results:
+						result['status'] = SYNC_AGING_GROUPED
+				except Exception as e:
+					for result in batch_results:
+						result['status'] = SYNC_AGING_FAILED
+						result['error'] = str(e)
+			else:
+				batch_results = list(executor.map(lambda candidate: sync_aging_device_retire(netim, candidate), batch))
+				inventory.devices_removed([result['device_id'] for result in batch_results \
+					if result['status'] == SYNC_AGING_RETIRED])
+			results.extend(batch_results)
+			logger.info("Aged out {} of {} device(s)".format(index + len(batch), len(candidates)))
+
+			# Provide time for the batch to be processed
+			if index + batch_size < len(candidates):
+				time.sleep(2)
+
+	return results
+
+def sync_aging_record(result):
+	record = {}
+	record['name'] = result['name']
+	record['address'] = result['address']
+	if result['error'] != None:
+		record['detail'] = result['error']
+	else:
+		record['detail'] = f"last synchronized {result['last_synchronized']}"
+	return record
+
+def sync_aging_report(results, summary=True, sink=None):
+	if sink == None:
+		sink = SyncReportSink(summary=summary)
+
+	messages = []
+	messages.append((SYNC_AGING_CANDIDATE, "There are {} device(s) in NetIM that are no longer in the CMDB and have " \
+		"not been synchronized within the aging threshold:"))
+	messages.append((SYNC_AGING_GROUPED, f"{{}} aged out device(s) were added to group '{SYNC_AGING_GROUP}' in NetIM:"))
+	messages.append((SYNC_AGING_RETIRED, "{} aged out device(s) were removed from NetIM:"))
+	messages.append((SYNC_AGING_FAILED, "{} aged out device(s) could not be updated in NetIM:"))
+
+	for status, message in messages:
+		status_results = [result for result in results if result['status'] == status]
+		if len(status_results) > 0:
+			sync_report_category(sink, SYNC_REPORT_AGING, status, status_results, message.format(len(status_results)),
+				sync_aging_record)
+
+	return
+
+def sync_aging_run(netim, inventory, converted_devices, aging_days, action=SYNC_AGING_ACTION_GROUP, apply=False,
+	summary=True, sink=None):
+
+	cutoff_time = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=aging_days)
+	cutoff = cutoff_time.strftime(NETIM_CUSTOM_ATTRIBUTE_LASTSYNCED_FORMAT)
+
+	aging_index = sync_aging_index(netim, inventory)
+	candidates = sync_aging_candidates(aging_index, cutoff, inventory,
+		[device[NETIM_DEVICE_NAME] for device in converted_devices], netim)
+	logger.info("{} of {} synchronized device(s) were last synchronized before {} and are not in the CMDB".format(
+		len(candidates), len(aging_index), cutoff))
+
+	# Always report what would be aged out first; only act on it when asked to
+	sync_aging_report(candidates, summary, sink)
+	results = []
+	if apply == True:
+		results = sync_aging_apply(netim, candidates, action, inventory)
+		sync_aging_report(results, summary, sink)
+
+	stats = {}
+	stats['aged_out_devices'] = len(candidates)
+	stats['aged_out_applied'] = len([result for result in results if result['status'] != SYNC_AGING_FAILED])
+
+	return stats
+
+#----- Snapshot functions
+
+SYNC_SNAPSHOT_VERSION = 1
+
+SYNC_SNAPSHOT_DEVICE_REMOVED = 'removed_device'
+SYNC_SNAPSHOT_SITE_REMOVED = 'removed_site'
+
+def sync_snapshot_hash(value):
+	return hashlib.sha256(json.dumps(value, sort_keys=True).encode('utf-8')).hexdigest()
+
+def sync_snapshot_device_addresses(device, devices_with_access_addresses=None):
+	device_name = device[NETIM_DEVICE_NAME]
+	if devices_with_access_addresses != None and device_name in devices_with_access_addresses:
+		return devices_with_access_addresses[device_name]
+	return [device[NETIM_DEVICE_ACCESSADDRESS]]
+
+def sync_snapshot_netim_fingerprint(inventory):
+	# The inventory fingerprint covers the groups and the ID, name and address of every device, so that any
+	# change made to NetIM since the snapshot was saved forces a full run
+	return inventory.fingerprint
+
+def sync_snapshot_read(snapshot_file):
+	try:
+		with open(snapshot_file, encoding='utf-8') as snapshot_fp:
+			snapshot = json.load(snapshot_fp)
+	except FileNotFoundError:
+		return None
+	except:
+		logger.info(f"Ignoring unreadable snapshot {snapshot_file}")
+		return None
+
+	if type(snapshot) is not dict or snapshot.get('version') != SYNC_SNAPSHOT_VERSION:
+		logger.info(f"Ignoring snapshot {snapshot_file} from a different version")
+		return None
+	return snapshot
+
+def sync_snapshot_write(snapshot, snapshot_file):
+	temporary_file = snapshot_file + '.tmp'
+	with open(temporary_file, 'w', encoding='utf-8') as snapshot_fp:
+		json.dump(snapshot, snapshot_fp)
+	os.replace(temporary_file, snapshot_file)
+	logger.info(f"Saved snapshot of {len(snapshot['devices'])} device(s) and {len(snapshot['sites'])} site(s) " \
+		f"to {snapshot_file}")
+	return
+
+def sync_snapshot_delta(snapshot, inventory, converted_devices, converted_sites, devices_with_access_addresses=None,
+	full=False):
+	# Split the devices and sites into those that were added or changed since the snapshot, which go on to
+	# comparison and reconcile, and those that are unchanged; removed ones are listed for the report
+	delta = {}
+	delta['full'] = full or snapshot == None or snapshot.get('netim') != sync_snapshot_netim_fingerprint(inventory)
+	delta['device_hashes'] = {}
+	delta['site_hashes'] = {}
+	delta['devices'] = []
+	delta['sites'] = []
+	delta['unchanged_devices'] = {}
+	delta['unchanged_sites'] = {}
+
+	previous_devices = {}
+	previous_sites = {}
+	if delta['full'] == False:
+		previous_devices = snapshot['devices']
+		previous_sites = snapshot['sites']
+
+	for device in converted_devices:
+		device_name = device[NETIM_DEVICE_NAME]
+		device_hash = sync_snapshot_hash([device, sync_snapshot_device_addresses(device, devices_with_access_addresses)])
+		if previous_devices.get(device_name) == device_hash:
+			delta['unchanged_devices'][device_name] = device_hash
+		else:
+			delta['device_hashes'][device_name] = device_hash
+			delta['devices'].append(device)
+
+	for site in converted_sites:
+		site_name = site[NETIM_SITE_NAME].strip()
+		site_hash = sync_snapshot_hash(site)
+		if previous_sites.get(site_name) == site_hash:
+			delta['unchanged_sites'][site_name] = site_hash
+		else:
+			delta['site_hashes'][site_name] = site_hash
+			delta['sites'].append(site)
+
+	current_device_names = set(device[NETIM_DEVICE_NAME] for device in converted_devices)
+	current_site_names = set(site[NETIM_SITE_NAME].strip() for site in converted_sites)
+	delta['removed_devices'] = [device_name for device_name in previous_devices if device_name not in current_device_names]
+	delta['removed_sites'] = [site_name for site_name in previous_sites if site_name not in current_site_names]
+
+	return delta
+
+def sync_snapshot_report(delta, summary=True, sink=None):
+	if sink == None:
+		sink = SyncReportSink(summary=summary)
+
+	if delta['full'] == True:
+		print("Comparing all devices and sites, as there is no snapshot or NetIM has changed since it was saved")
+		return
+
+	print(f"Skipping {len(delta['unchanged_devices'])} device(s) and {len(delta['unchanged_sites'])} site(s) that " \
+		f"are unchanged since the last snapshot")
+	if len(delta['removed_devices']) > 0:
+		sync_report_category(sink, SYNC_REPORT_SNAPSHOT, SYNC_SNAPSHOT_DEVICE_REMOVED, delta['removed_devices'],
+			f"There are {len(delta['removed_devices'])} devices that were removed from ServiceNow since the last " \
+			"snapshot:", sync_report_name_record)
+	if len(delta['removed_sites']) > 0:
+		sync_report_category(sink, SYNC_REPORT_SNAPSHOT, SYNC_SNAPSHOT_SITE_REMOVED, delta['removed_sites'],
+			f"There are {len(delta['removed_sites'])} sites that were removed from ServiceNow since the last " \
+			"snapshot:", sync_report_name_record)
+
+	return
+
+def sync_snapshot_save(delta, inventory, snapshot_file, devices_with_access_addresses=None):
+	# Only devices and sites that NetIM now agrees with are kept, so that ones that were not created or updated
+	# (e.g. without --reconcile, or after a failure) are compared again on the next run
+	snapshot = {}
+	snapshot['version'] = SYNC_SNAPSHOT_VERSION
+	snapshot['netim'] = sync_snapshot_netim_fingerprint(inventory)
+	snapshot['devices'] = dict(delta['unchanged_devices'])
+	snapshot['sites'] = dict(delta['unchanged_sites'])
+
+	for device in delta['devices']:
+		netim_device = inventory.device(device[NETIM_DEVICE_NAME])
+		if netim_device != None and sync_netim_device_address(netim_device) in \
+			sync_snapshot_device_addresses(device, devices_with_access_addresses):
+			snapshot['devices'][device[NETIM_DEVICE_NAME]] = delta['device_hashes'][device[NETIM_DEVICE_NAME]]
+
+	for site in delta['sites']:
+		site_name = site[NETIM_SITE_NAME].strip()
+		if site_name in inventory.groups:
+			snapshot['sites'][site_name] = delta['site_hashes'][site_name]
+
+	sync_snapshot_write(snapshot, snapshot_file)
+	return
+
+
+#----- Synchronization run functions
+
+def sync_context_create():
+	# State kept warm between synchronization cycles
+	context = {}
+	context['servicenow'] = None
+	context['servicenow_config'] = None
+	context['netim'] = None
+	context['netim_password'] = None
+	context['full_refresh'] = True
+	context['servicenow_devices'] = {'records':{}, 'watermark':None}
+	context['servicenow_locations'] = {'records':{}, 'watermark':None}
+	context['servicenow_relationships'] = {'records':{}, 'watermark':None}
+	context['servicenow_class_tables'] = {}
+	context['csv'] = {}
+	context['netim_locations'] = {}
+	context['netim_inventory'] = None
+	return context
+
+def sync_reconcile(netim, device_comparison, converted_devices, site_comparison, converted_sites, instrumentation,
+	inventory=None, devices_with_access_addresses=None, address_policy=None, sink=None, synchronized_devices=None):
+
+	reconcile_stats = {}
+	# The synchronization timestamp is what aging goes by, so it is set on every device still in the CMDB even
+	# when only some of them were compared
+	if synchronized_devices == None:
+		synchronized_devices = converted_devices
+
+	print("")
+	print("ServiceNow to NetIM Reconciliation Report")
+	print("---------------------------------------------------------------------------------------------------")
+	print("")
+	print("Step 1 of 4: Reconciling devices in NetIM")
+	print("")
+	# Sync list of devices to NetIM
+	# existing_devices?
+	# different_devices?
+	new_devices = device_comparison[SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_NEW]
+	with sync_stage(instrumentation, 'reconcile_devices'):
+		new_device_ids = sync_netim_devices_create(netim, new_devices, converted_devices, inventory)
+	print("Created {} out of {} found new, valid devices in NetIM".format(len(new_device_ids), len(new_devices)))
+	reconcile_stats['created_devices'] = len(new_device_ids)
+
+	# Only update the addresses of existing devices when a policy for choosing the address has been given
+	different_devices = device_comparison[SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_DIFFERENT]
+	if address_policy != None and len(different_devices) > 0:
+		with sync_stage(instrumentation, 'reconcile_addresses'):
+			address_results = sync_netim_devices_addresses_update(netim, different_devices, converted_devices,
+				devices_with_access_addresses, address_policy, inventory)
+		updated_count = len([result for result in address_results \
+			if result['status'] == SYNC_NETIM_ADDRESS_UPDATE_UPDATED])
+		print("Updated the access address of {} out of {} devices with different addresses in NetIM".format(
+			updated_count, len(different_devices)))
+		sync_netim_devices_addresses_update_report(address_results, sink=sink)
+		reconcile_stats['updated_addresses'] = updated_count
+
+	print("")
+	print("Step 2 of 4: Reconciling sites in NetIM")
+	print("")
+	# Sync list of locations to NetIM
+	new_sites = site_comparison[SYNC_SERVICENOW_NETIM_COMPARISON_SITES_NEW]
+	with sync_stage(instrumentation, 'reconcile_sites'):
+		new_sites_ids = sync_netim_sites_create(netim, new_sites, converted_sites, inventory)
+	print("Created {} out of {} found new, valid sites in NetIM".format(len(new_sites_ids), len(new_sites)))
+	reconcile_stats['created_sites'] = len(new_sites_ids)
+
+	print("")
+	print("Step 3 of 4: Adding devices to sites in NetIM")
+	print("")
+	# Add devices to sites in NetIM
+	with sync_stage(instrumentation, 'reconcile_site_devices'):
+		sync_netim_sites_devices_add(netim, converted_devices, inventory)
+
+	print("")
+	print("Step 4 of 4: Adding custom attributes in NetIM")
+	print("")
+	# Set up a process to track when devices were last synchronized with the CMDB. This allows an
+	# automated way to determine if a device should be aged out because it is no longer tracked in
+	# the CMDB
+	with sync_stage(instrumentation, 'reconcile_custom_attributes'):
+		sync_netim_custom_attribute_devices_cmdb_id(netim, new_devices, converted_devices, inventory)
+		sync_netim_custom_attribute_devices_timestamp(netim, synchronized_devices, inventory)
+
+	print("")
+	print("End of Reconciliation Report")
+	print("---------------------------------------------------------------------------------------------------")
+
+	return reconcile_stats
+
+def sync_run_servicenow(args, instrumentation, context=None, sink=None):
 
 	print("")
 	print("ServiceNow and NetIM Comparison Report")
@@ -1255,103 +3598,344 @@ def main ():
 	print("")
 	print(f"Step 1 of 7: Getting device and location information from ServiceNow {text}")
 
-	servicenow_devices, servicenow_locations = sync_servicenow_import(args.servicenow_yml, 
-		args.servicenow_devices_csv, args.servicenow_locations_csv)
+	preflight = {}
+	with sync_stage(instrumentation, 'import'):
+		servicenow_devices, servicenow_locations = sync_servicenow_import(args.servicenow_yml, 
+			args.servicenow_devices_csv, args.servicenow_locations_csv, context, preflight, args.csv_workers)
+	if len(preflight) > 0:
+		print(f"  ServiceNow reported {preflight['devices']} configuration items in {len(preflight['classes'])} " \
+			f"classes before fetching")
 	logger.info("There are {} ServiceNow devices".format(len(servicenow_devices)))
 	logger.info("There are {} ServiceNow locations".format(len(servicenow_locations)))
 
 	print("Step 2 of 7: Validating input from ServiceNow")
 	lookup_table = sync_servicenow_input_globals(use_api)
-	devices_to_import, locations_to_import, devices_with_access_addresses = \
-		sync_servicenow_input_validate(servicenow_devices, servicenow_locations, lookup_table, args.summary)
+	with sync_stage(instrumentation, 'canonicalize'):
+		canonical_devices, canonical_locations = sync_servicenow_input_canonicalize(servicenow_devices,
+			servicenow_locations, lookup_table, use_api)
+	with sync_stage(instrumentation, 'validate'):
+		devices_to_import, locations_to_import, devices_with_access_addresses = \
+			sync_servicenow_input_validate(canonical_devices, canonical_locations, args.summary, sink)
 
 	logger.info("After validation, there are {} devices to import from ServiceNow".format(len(devices_to_import)))
 	logger.info("After validation, there are {} locations to import from ServiceNow".format(len(locations_to_import)))
 
 	print("Step 3 of 7: Converting input from ServiceNow into NetIM structures")
-	converted_devices = sync_servicenow_to_netim_devices_convert(devices_to_import, lookup_table)
-	converted_sites = sync_servicenow_to_netim_locations_convert(locations_to_import, lookup_table)
+	with sync_stage(instrumentation, 'convert'):
+		converted_devices = sync_servicenow_to_netim_devices_convert(devices_to_import)
+		converted_sites = sync_servicenow_to_netim_locations_convert(locations_to_import)
 	
 	logger.info("After conversion, there are {} devices for NetIM to compare".format(len(converted_devices)))
 	logger.info("After conversion, there are {} sites for NetIM to compare".format(len(converted_sites)))
 
-	#---- NetIM API -----
-
-	print(f"Step 4 of 7: Authenticating with NetIM")
-	netim = sync_netim_authenticate(args.netim_yml)
-
-	print("Step 5 of 7: Comparing devices in NetIM with the inputs from ServiceNow")
-	device_comparison = sync_servicenow_netim_devices_comparison(converted_devices, netim, devices_with_access_addresses)
-	sync_servicenow_netim_devices_comparison_report(device_comparison, args.summary)
-
-	#----- Code that compares existing groups/sites to those in file -----
-
-	print("")
-	print("Step 6 of 7: Comparing site and groups in NetIM with the inputs from ServiceNow")
-	print("")
-	site_comparison = sync_servicenow_netim_sites_comparison(converted_sites, netim, args.summary)
-	sync_servicenow_netim_sites_comparison_report(site_comparison, args.summary)
+	stats = {}
+	stats['servicenow_devices'] = len(servicenow_devices)
+	stats['servicenow_locations'] = len(servicenow_locations)
+	stats['devices_to_import'] = len(converted_devices)
+	stats['sites_to_import'] = len(converted_sites)
+	if len(preflight) > 0:
+		stats['preflight_devices'] = preflight['devices']
+		stats['preflight_shards'] = preflight['shards']
+
+	return converted_devices, converted_sites, devices_with_access_addresses, stats
+
+@contextlib.contextmanager
+def sync_context_netim_slot(context):
+	# When several runs share a NetIM instance, a semaphore in the context limits how many talk to it at once
+	semaphore = None
+	if context != None:
+		semaphore = context.get('netim_semaphore')
+	if semaphore == None:
+		yield
+		return
+
+	semaphore.acquire()
+	try:
+		yield
+	finally:
+		semaphore.release()
 
-	#----- Code to compare geographical information -----
+def sync_run_netim(args, instrumentation, converted_devices, converted_sites, devices_with_access_addresses, stats,
+	context=None, sink=None):
 
-	print("")
-	print("Step 7 of 7: Comparing location information in NetIM with the inputs from ServiceNow")
-	print("")
+	#---- NetIM API -----
 
-	location_validation = sync_servicenow_netim_location_validation(converted_sites, netim)
-	sync_servicenow_netim_location_validation_report(location_validation, args.summary)
+	print(f"Step 4 of 7: Authenticating with NetIM")
+	with sync_stage(instrumentation, 'authenticate'):
+		if context != None and context['netim'] != None:
+			netim = context['netim']
+		else:
+			netim = sync_netim_authenticate(args.netim_yml)
+			if context != None:
+				context['netim'] = netim
+
+	# The external comparison streams the NetIM devices into its sort a page at a time; main() refuses the
+	# options that need all of them in memory
+	stream_devices = args.external_comparison != None
+	inventory_file = args.netim_inventory
+	if stream_devices == True:
+		inventory_file = None
+	with sync_stage(instrumentation, 'inventory'):
+		inventory = sync_netim_inventory_get(netim, context, inventory_file, args.netim_inventory_max_age,
+			load_devices=not stream_devices)
+
+	# With a snapshot, only devices and sites added or changed since the last run are compared and reconciled;
+	# aging still sees every device
+	compared_devices = converted_devices
+	compared_sites = converted_sites
+	delta = None
+	if args.snapshot != None:
+		with sync_stage(instrumentation, 'snapshot'):
+			delta = sync_snapshot_delta(sync_snapshot_read(args.snapshot), inventory, converted_devices,
+				converted_sites, devices_with_access_addresses, context != None and context['full_refresh'] == True)
+		sync_snapshot_report(delta, args.summary, sink)
+		compared_devices = delta['devices']
+		compared_sites = delta['sites']
+		stats['snapshot_unchanged_devices'] = len(delta['unchanged_devices'])
+		stats['snapshot_removed_devices'] = len(delta['removed_devices'])
+
+	mirror = None
+	try:
+		if args.mirror != None:
+			with sync_stage(instrumentation, 'mirror'):
+				from sync_mirror import sync_mirror_open, sync_mirror_servicenow_refresh, sync_mirror_netim_refresh, \
+					sync_mirror_names, sync_mirror_devices_comparison, sync_mirror_sites_comparison, \
+					sync_mirror_location_validation
+				mirror = sync_mirror_open(args.mirror)
+				sync_mirror_servicenow_refresh(mirror, converted_devices, converted_sites, devices_with_access_addresses)
+				sync_mirror_netim_refresh(mirror, inventory)
+
+		print("Step 5 of 7: Comparing devices in NetIM with the inputs from ServiceNow")
+		with sync_stage(instrumentation, 'devices_comparison'):
+			if mirror != None:
+				device_comparison = sync_mirror_devices_comparison(mirror,
+					sync_mirror_names(compared_devices, converted_devices, NETIM_DEVICE_NAME))
+			elif args.external_comparison != None:
+				device_comparison = sync_servicenow_netim_devices_external_comparison(compared_devices,
+					sync_netim_devices_paged(netim), devices_with_access_addresses, args.external_comparison)
+			else:
+				device_comparison = sync_servicenow_netim_devices_comparison(compared_devices, netim,
+					devices_with_access_addresses, inventory.index)
+		if args.fuzzy_match != None:
+			with sync_stage(instrumentation, 'devices_fuzzy_match'):
+				sync_servicenow_netim_devices_fuzzy_match(device_comparison, sync_fuzzy_index(inventory.index),
+					args.fuzzy_match)
+		sync_servicenow_netim_devices_comparison_report(device_comparison, args.summary, sink)
 
-	#-----
-	print("")
-	print("End of Comparison Report")
-	print("---------------------------------------------------------------------------------------------------")
+		#----- Code that compares existing groups/sites to those in file -----
 
-	if args.reconcile == True:
-		print("")
-		print("ServiceNow to NetIM Reconciliation Report")
-		print("---------------------------------------------------------------------------------------------------")
 		print("")
-		print("Step 1 of 4: Reconciling devices in NetIM")
+		print("Step 6 of 7: Comparing site and groups in NetIM with the inputs from ServiceNow")
 		print("")
-		# Sync list of devices to NetIM
-		# existing_devices?
-		# different_devices?
-		new_devices = device_comparison[SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_NEW]
-		new_device_ids = sync_netim_devices_create(netim, new_devices, converted_devices)	
-		print("Created {} out of {} found new, valid devices in NetIM".format(len(new_device_ids), len(new_devices)))
-		### For now, don't update different devices
-		#updated_device_ids = sync_netim_devices_update(netim, \
-		#	device_comparison[SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_DIFFERENT])
+		with sync_stage(instrumentation, 'sites_comparison'):
+			if mirror != None:
+				site_comparison = sync_mirror_sites_comparison(mirror,
+					sync_mirror_names(compared_sites, converted_sites, NETIM_SITE_NAME))
+			else:
+				site_comparison = sync_servicenow_netim_sites_comparison(compared_sites, netim, args.summary,
+					list(inventory.groups.values()))
+		sync_servicenow_netim_sites_comparison_report(site_comparison, args.summary, sink)
 
-		print("")
-		print("Step 2 of 4: Reconciling sites in NetIM")
-		print("")
-		# Sync list of locations to NetIM
-		new_sites = site_comparison[SYNC_SERVICENOW_NETIM_COMPARISON_SITES_NEW]
-		new_sites_ids = sync_netim_sites_create(netim, new_sites, converted_sites)
-		print("Created {} out of {} found new, valid sites in NetIM".format(len(new_sites_ids), len(new_sites)))
+		#----- Code to compare geographical information -----
 
 		print("")
-		print("Step 3 of 4: Adding devices to sites in NetIM")
+		print("Step 7 of 7: Comparing location information in NetIM with the inputs from ServiceNow")
 		print("")
-		# Add devices to sites in NetIM
-		sync_netim_sites_devices_add(netim, converted_devices)
 
-		print("")
-		print("Step 4 of 4: Adding custom attributes in NetIM")
-		print("")
-		# Set up a process to track when devices were last synchronized with the CMDB. This allows an
-		# automated way to determine if a device should be aged out because it is no longer tracked in
-		# the CMDB
-		sync_netim_custom_attribute_devices_cmdb_id(netim, new_devices, converted_devices)
-		sync_netim_custom_attribute_devices_timestamp(netim, converted_devices)
-		
+		with sync_stage(instrumentation, 'location_validation'):
+			if mirror != None:
+				location_validation = sync_mirror_location_validation(mirror, netim,
+					sync_mirror_names(compared_sites, converted_sites, NETIM_SITE_NAME))
+			else:
+				location_cache = None
+				if context != None:
+					location_cache = context['netim_locations']
+				location_validation = sync_servicenow_netim_location_validation(compared_sites, netim, location_cache)
+		sync_servicenow_netim_location_validation_report(location_validation, args.summary, sink)
 
+		#-----
 		print("")
-		print("End of Reconciliation Report")
+		print("End of Comparison Report")
 		print("---------------------------------------------------------------------------------------------------")
 
+		for comparison_name, comparison_list in device_comparison.items():
+			stats[comparison_name] = len(comparison_list)
+		for comparison_name, comparison_list in site_comparison.items():
+			stats[comparison_name] = len(comparison_list)
+
+		if args.reconcile == True:
+			stats.update(sync_reconcile(netim, device_comparison, compared_devices, site_comparison, compared_sites,
+				instrumentation, inventory, devices_with_access_addresses, args.update_addresses, sink, converted_devices))
+
+		if args.aging_days != None:
+			print("")
+			print("Aging out devices that are no longer in the CMDB")
+			with sync_stage(instrumentation, 'aging'):
+				stats.update(sync_aging_run(netim, inventory, converted_devices, args.aging_days, args.aging_action,
+					args.aging_apply, args.summary, sink))
+		sync_netim_inventory_save(inventory, inventory_file)
+		if delta != None:
+			sync_snapshot_save(delta, inventory, args.snapshot, devices_with_access_addresses)
+	finally:
+		if mirror != None:
+			mirror.close()
+
+	return stats
+
+def sync_run(args, instrumentation, context=None, sink=None):
+
+	converted_devices, converted_sites, devices_with_access_addresses, stats = \
+		sync_run_servicenow(args, instrumentation, context, sink)
+
+	# A pre-flight count over max_records may ask for a sharded run
+	if stats.get('preflight_shards') != None and (args.shards == None or args.shards <= 1):
+		from sync_shards import SYNC_SHARDS_EXCLUSIVE_OPTIONS
+		options = [option for option in SYNC_SHARDS_EXCLUSIVE_OPTIONS if getattr(args, option) != None]
+		if len(options) > 0:
+			raise SyncPreflightRefused(f"ServiceNow reports {stats['preflight_devices']} configuration items, " \
+				f"more than max_records, but a sharded run cannot be used with --{options[0]}")
+		args = copy.copy(args)
+		args.shards = stats['preflight_shards']
+
+	with sync_context_netim_slot(context):
+		if args.shards != None and args.shards > 1:
+			from sync_shards import sync_run_netim_sharded
+			stats = sync_run_netim_sharded(args, instrumentation, converted_devices, converted_sites,
+				devices_with_access_addresses, stats, context, sink)
+		else:
+			stats = sync_run_netim(args, instrumentation, converted_devices, converted_sites,
+				devices_with_access_addresses, stats, context, sink)
+
+	return stats
+
+def main ():
+	from sync_daemon import SYNC_DAEMON_INTERVAL, SYNC_DAEMON_JITTER, SYNC_DAEMON_FULL_REFRESH_CYCLES, sync_daemon_run
+	from sync_events import SYNC_EVENTS_ADDRESS, SYNC_EVENTS_WINDOW, SYNC_EVENTS_BATCH_SIZE, sync_events_run
+	from sync_shards import SYNC_SHARDS_BY_LOCATION, SYNC_SHARDS_BY_CLASS, SYNC_SHARDS_EXCLUSIVE_OPTIONS
+
+	parser = argparse.ArgumentParser(description="Python utility to compare data from ServiceNow to \
+		data in NetIM")
+	parser.add_argument('--servicenow_yml', help='ServiceNow account credentials')
+	parser.add_argument('--netim_yml', help='NetIM account credentials')
+	parser.add_argument('--servicenow_devices_csv', help='Export of INPUT devices from ServiceNow')
+	parser.add_argument('--servicenow_locations_csv', help='Export of INPUT devices from ServiceNow')
+	parser.add_argument('--csv_workers', type=int,
+		help='Parse spreadsheets of 64 MB or more with this many processes')
+	parser.add_argument('--summary', type=bool, help='Print summary or full report detail')
+	parser.add_argument('--reconcile', type=bool, help='Create devices/groups in NetIM for missing objects')
+	parser.add_argument('--validate_only', type=bool,
+		help='Only import, validate and convert the ServiceNow input (steps 1-3); NetIM is not contacted')
+	parser.add_argument('--profile', help='Directory for per-stage CPU profiles (pstats, collapsed stacks, top functions)')
+	parser.add_argument('--profile_top', type=int, default=SYNC_PROFILE_TOP_COUNT,
+		help='Number of hot functions to list per profiled stage')
+	parser.add_argument('--memory_report', type=bool, help='Trace allocations and report memory use per stage')
+	parser.add_argument('--memory_top', type=int, default=SYNC_MEMORY_TOP_COUNT,
+		help='Number of allocation sites to list per stage in the memory report')
+	parser.add_argument('--memory_budget', type=int, help='Abort the run if resident memory exceeds this many MB')
+	parser.add_argument('--daemon', type=bool, help='Keep running and synchronize on a schedule with warm caches')
+	parser.add_argument('--daemon_interval', type=int, default=SYNC_DAEMON_INTERVAL,
+		help='Seconds between the start of synchronization cycles in daemon mode')
+	parser.add_argument('--daemon_jitter', type=int, default=SYNC_DAEMON_JITTER,
+		help='Maximum random seconds added to each daemon interval')
+	parser.add_argument('--daemon_full_refresh', type=int, default=SYNC_DAEMON_FULL_REFRESH_CYCLES,
+		help='Number of cycles between full ServiceNow refreshes, which also pick up deleted records')
+	parser.add_argument('--daemon_status_file', help='File to write daemon health and last cycle statistics to')
+	parser.add_argument('--daemon_status_port', type=int,
+		help='Local port to serve daemon health and last cycle statistics on')
+	parser.add_argument('--events_port', type=int,
+		help='Receive ServiceNow cmdb_ci/cmn_location events on this port and synchronize single records')
+	parser.add_argument('--events_address', default=SYNC_EVENTS_ADDRESS, help='Address to receive events on')
+	parser.add_argument('--events_token', help='Shared token that events must carry in the X-Sync-Token header')
+	parser.add_argument('--events_window', type=float, default=SYNC_EVENTS_WINDOW,
+		help='Seconds to collect and coalesce events before processing them as one batch')
+	parser.add_argument('--events_batch', type=int, default=SYNC_EVENTS_BATCH_SIZE,
+		help='Maximum number of records processed in one event batch')
+	parser.add_argument('--targets_yml', help='Synchronize every ServiceNow/NetIM pair listed in this file in parallel')
+	parser.add_argument('--report_format', default=SYNC_REPORT_FORMAT_TEXT,
+		choices=[SYNC_REPORT_FORMAT_TEXT, SYNC_REPORT_FORMAT_JSONL, SYNC_REPORT_FORMAT_CSV],
+		help='Print reports as text, or stream them as JSON Lines or CSV records')
+	parser.add_argument('--report_output', help='File for JSON Lines or CSV report records (default: stdout)')
+	parser.add_argument('--snapshot',
+		help='File to keep a hash of each device and site in between runs, so that only added and changed ones ' \
+		'are compared and reconciled')
+	parser.add_argument('--mirror',
+		help='SQLite file to mirror the ServiceNow and NetIM data into and run the comparisons against')
+	parser.add_argument('--external_comparison', type=int,
+		help='Compare devices with a sort-merge join through temporary files, sorting at most this many records ' \
+		'in memory at a time')
+	parser.add_argument('--fuzzy_match', type=float,
+		help='Report devices missing from NetIM whose names are at least this similar (0-1) to a NetIM device ' \
+		'as suggested matches instead of creating them')
+	parser.add_argument('--update_addresses', choices=[NETIM_DEVICE_ADDRESS_POLICY_FIRST,
+		NETIM_DEVICE_ADDRESS_POLICY_LAST, NETIM_DEVICE_ADDRESS_POLICY_LOWEST],
+		help='With --reconcile, update the NetIM access address of devices with a different address, choosing ' \
+		'the first, last or lowest of the ServiceNow addresses')
+	parser.add_argument('--aging_days', type=int,
+		help='Report NetIM devices no longer in the CMDB that were last synchronized more than this many days ago')
+	parser.add_argument('--aging_action', default=SYNC_AGING_ACTION_GROUP,
+		choices=[SYNC_AGING_ACTION_GROUP, SYNC_AGING_ACTION_RETIRE],
+		help=f"Add aged out devices to the group '{SYNC_AGING_GROUP}', or remove them from NetIM")
+	parser.add_argument('--aging_apply', type=bool,
+		help='Apply the aging action; otherwise aged out devices are only reported')
+	parser.add_argument('--netim_inventory',
+		help='File to keep a snapshot of the NetIM inventory in between runs')
+	parser.add_argument('--netim_inventory_max_age', type=int, default=SYNC_NETIM_INVENTORY_MAX_AGE,
+		help='Seconds an unchanged NetIM inventory snapshot is reused before it is downloaded again')
+	parser.add_argument('--shards', type=int, help='Compare and reconcile devices in this many worker processes')
+	parser.add_argument('--shard_by', default=SYNC_SHARDS_BY_LOCATION,
+		choices=[SYNC_SHARDS_BY_LOCATION, SYNC_SHARDS_BY_CLASS], help='Split devices into shards by location or class')
+	args = parser.parse_args()
+
+	if args.shards != None and args.shards > 1:
+		for option in SYNC_SHARDS_EXCLUSIVE_OPTIONS:
+			if getattr(args, option) != None:
+				parser.error(f"--{option} cannot be used with --shards")
+
+	# The external comparison never holds the NetIM devices in memory, which these options need
+	if args.external_comparison != None:
+		for option in ['fuzzy_match', 'mirror', 'aging_days', 'snapshot']:
+			if getattr(args, option) != None:
+				parser.error(f"--{option} cannot be used with --external_comparison")
+
+	instrumentation = {}
+	instrumentation[SYNC_INSTRUMENTATION_PROFILE] = sync_profile_create(args.profile, args.profile_top)
+	instrumentation[SYNC_INSTRUMENTATION_MEMORY] = sync_memory_create(args.memory_report, args.memory_budget,
+		args.memory_top)
+
+	if args.targets_yml != None:
+		from sync_targets import sync_targets_run
+		sync_targets_run(args)
+	else:
+		sink = sync_report_sink_create(args.report_format, args.report_output, args.summary)
+		# The memory watchdog flushes the records reported so far before it aborts the run
+		if instrumentation[SYNC_INSTRUMENTATION_MEMORY] != None:
+			instrumentation[SYNC_INSTRUMENTATION_MEMORY]['sink'] = sink
+		# When records are streamed to stdout, move the progress messages out of the way to stderr
+		progress = contextlib.nullcontext()
+		if args.report_format != SYNC_REPORT_FORMAT_TEXT and args.report_output in [None, '-']:
+			progress = contextlib.redirect_stdout(sys.stderr)
+		with progress:
+			if args.validate_only == True:
+				sync_run_servicenow(args, instrumentation, sink=sink)
+			elif args.events_port != None:
+				sync_events_run(args, instrumentation, sink)
+			elif args.daemon == True:
+				sync_daemon_run(args, instrumentation, sink)
+			else:
+				sync_run(args, instrumentation, sink=sink)
+		sink.summary_report()
+		sink.close()
+
+	sync_instrumentation_report(instrumentation)
+	sync_memory_stop(instrumentation[SYNC_INSTRUMENTATION_MEMORY])
+
 	return
 
 if __name__ == "__main__":
-	main ()
+	# The feature modules import from sync_servicenow, which is this script rather than a second copy of it
+	sys.modules['sync_servicenow'] = sys.modules[__name__]
+	try:
+		main ()
+	except SyncPreflightRefused as e:
+		print(f"Aborting: {e}")
+		sys.exit(1)
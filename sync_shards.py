@@ -0,0 +1,269 @@
+# Sharded runs for sync_servicenow.py: devices compared and reconciled in worker processes
+
+import contextlib
+import io
+import logging
+import zlib
+
+from sync_servicenow import sync_servicenow_netim_devices_comparison_report, \
+	sync_netim_devices_addresses_update_report, sync_servicenow_netim_sites_comparison_report, \
+	sync_servicenow_netim_location_validation_report, NETIM_DEVICE_NAME, NETIM_DEVICE_ACCESSADDRESS, \
+	NETIM_DEVICE_GROUP, NETIM_DEVICE_CLASS, SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_NEW, \
+	SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_DIFFERENT, SYNC_SERVICENOW_NETIM_COMPARISON_SITES_NEW, \
+	sync_servicenow_netim_devices_comparison, sync_fuzzy_index, sync_servicenow_netim_devices_fuzzy_match, \
+	sync_servicenow_netim_sites_comparison, sync_servicenow_netim_location_validation, \
+	NETIM_CUSTOM_ATTRIBUTE_LASTSYNCED, NETIM_CUSTOM_ATTRIBUTE_LASTSYNCED_DESCRIPTION, \
+	NETIM_CUSTOM_ATTRIBUTE_CMDB_ID, NETIM_CUSTOM_ATTRIBUTE_CMDB_ID_DESCRIPTION, sync_netim_custom_attribute_id, \
+	sync_netim_custom_attribute_devices_cmdb_id, sync_netim_custom_attribute_devices_timestamp, \
+	sync_netim_sites_create, sync_netim_sites_devices_add, sync_netim_devices_create, \
+	SYNC_NETIM_ADDRESS_UPDATE_UPDATED, sync_netim_devices_addresses_update, sync_netim_password_get, \
+	sync_netim_authenticate, SyncNetIMInventory, sync_netim_inventory_get, sync_netim_inventory_save, sync_aging_run
+from sync_instrumentation import sync_stage
+
+logger = logging.getLogger(__name__)
+
+
+#----- Sharded run functions
+
+SYNC_SHARDS_BY_LOCATION = 'location'
+SYNC_SHARDS_BY_CLASS = 'class'
+# Options that a sharded run does not support
+SYNC_SHARDS_EXCLUSIVE_OPTIONS = ['snapshot', 'mirror', 'external_comparison']
+
+# Read-only data shared with shard workers; set once per worker process by sync_shards_worker_init()
+sync_shards_shared = {}
+
+def sync_shards_split(converted_devices, shard_count, shard_by=SYNC_SHARDS_BY_LOCATION):
+	if shard_by == SYNC_SHARDS_BY_CLASS:
+		shard_field = NETIM_DEVICE_CLASS
+	else:
+		shard_field = NETIM_DEVICE_GROUP
+
+	# Use a stable hash so that a location or class lands in the same shard on every run
+	shards = [[] for shard_index in range(shard_count)]
+	for device in converted_devices:
+		shard_key = device.get(shard_field, '')
+		shards[zlib.crc32(shard_key.encode('utf-8')) % shard_count].append(device)
+
+	return [shard for shard in shards if len(shard) > 0]
+
+def sync_shards_worker_init(netim_index, fuzzy_index=None, memberships={}, attribute_values={},
+	attribute_values_loaded=set()):
+	# With the fork start method the indexes are inherited rather than pickled
+	sync_shards_shared['netim_index'] = netim_index
+	sync_shards_shared['fuzzy_index'] = fuzzy_index
+	sync_shards_shared['memberships'] = memberships
+	sync_shards_shared['attribute_values'] = attribute_values
+	sync_shards_shared['attribute_values_loaded'] = attribute_values_loaded
+	return
+
+def sync_shards_inventory(shard_devices):
+	# A worker's view of the inventory: the shared device index, attribute values and memberships of the shard's
+	# groups, with no devices of its own, so that what the worker adds can be sent back to the parent
+	inventory = SyncNetIMInventory()
+	inventory.index = sync_shards_shared['netim_index']
+	inventory.attribute_values = sync_shards_shared['attribute_values']
+	inventory.attribute_values_loaded = set(sync_shards_shared['attribute_values_loaded'])
+	for group_name in set(device.get(NETIM_DEVICE_GROUP, '') for device in shard_devices):
+		if group_name in sync_shards_shared['memberships']:
+			inventory.memberships[group_name] = set(sync_shards_shared['memberships'][group_name])
+	return inventory
+
+def sync_shards_worker(args, shard_index, shard_devices, devices_with_access_addresses, netim_password=None,
+	attribute_ids={}):
+
+	result = {}
+	result['shard'] = shard_index
+	result['devices'] = len(shard_devices)
+	result['stats'] = {}
+
+	output = io.StringIO()
+	with contextlib.redirect_stdout(output):
+		device_comparison = sync_servicenow_netim_devices_comparison(shard_devices, None,
+			devices_with_access_addresses, sync_shards_shared['netim_index'])
+		if sync_shards_shared['fuzzy_index'] != None:
+			sync_servicenow_netim_devices_fuzzy_match(device_comparison, sync_shards_shared['fuzzy_index'],
+				args.fuzzy_match)
+
+		if args.reconcile == True:
+			# Each worker needs its own NetIM connection for writes
+			netim = sync_netim_authenticate(args.netim_yml, netim_password)
+			inventory = sync_shards_inventory(shard_devices)
+			new_devices = device_comparison[SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_NEW]
+			new_device_ids = sync_netim_devices_create(netim, new_devices, shard_devices, inventory)
+			print("Shard {}: created {} out of {} found new, valid devices in NetIM".format(shard_index,
+				len(new_device_ids), len(new_devices)))
+			result['stats']['created_devices'] = len(new_device_ids)
+			if args.update_addresses != None:
+				different_devices = device_comparison[SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_DIFFERENT]
+				result['address_updates'] = sync_netim_devices_addresses_update(netim, different_devices,
+					shard_devices, devices_with_access_addresses, args.update_addresses, inventory)
+				result['stats']['updated_addresses'] = len([address_result \
+					for address_result in result['address_updates'] \
+					if address_result['status'] == SYNC_NETIM_ADDRESS_UPDATE_UPDATED])
+			sync_netim_sites_devices_add(netim, shard_devices, inventory)
+			sync_netim_custom_attribute_devices_cmdb_id(netim, new_devices, shard_devices, inventory,
+				attribute_id=attribute_ids.get(NETIM_CUSTOM_ATTRIBUTE_CMDB_ID))
+			sync_netim_custom_attribute_devices_timestamp(netim, shard_devices, inventory,
+				attribute_id=attribute_ids.get(NETIM_CUSTOM_ATTRIBUTE_LASTSYNCED))
+
+			# What the parent's inventory needs to stay in step with NetIM
+			result['created_devices'] = [(device[NETIM_DEVICE_NAME], device[NETIM_DEVICE_ACCESSADDRESS], device['id']) \
+				for device in inventory.devices]
+			result['grouped_devices'] = {group_name:sorted(members - sync_shards_shared['memberships'].get(group_name,
+				set()), key=str) for group_name, members in inventory.memberships.items()}
+
+	result['comparison'] = device_comparison
+	result['output'] = output.getvalue()
+
+	return result
+
+def sync_shards_inventory_merge(inventory, results):
+	# Apply the devices, addresses and group members that the workers wrote to NetIM to the parent's inventory
+	for result in results:
+		for device_name, address, device_id in result.get('created_devices', []):
+			inventory.device_added(device_name, address, device_id)
+		for address_result in result.get('address_updates', []):
+			netim_device = inventory.device(address_result['name'])
+			if address_result['status'] == SYNC_NETIM_ADDRESS_UPDATE_UPDATED and netim_device != None:
+				inventory.device_address_updated(netim_device, address_result['address'])
+		for group_name, device_ids in result.get('grouped_devices', {}).items():
+			inventory.devices_grouped(group_name, device_ids)
+	# Attribute values the workers added are read again when next needed
+	for attribute_name in [NETIM_CUSTOM_ATTRIBUTE_CMDB_ID, NETIM_CUSTOM_ATTRIBUTE_LASTSYNCED]:
+		inventory.attribute_values_reset(attribute_name)
+	return
+
+def sync_shards_comparison_merge(comparisons):
+	merged_comparison = {}
+	for comparison in comparisons:
+		for comparison_name, comparison_list in comparison.items():
+			if comparison_name not in merged_comparison:
+				merged_comparison[comparison_name] = []
+			merged_comparison[comparison_name].extend(comparison_list)
+	return merged_comparison
+
+def sync_run_netim_sharded(args, instrumentation, converted_devices, converted_sites, devices_with_access_addresses,
+	stats, context=None, sink=None):
+	import concurrent.futures
+
+	print(f"Step 4 of 7: Authenticating with NetIM")
+	with sync_stage(instrumentation, 'authenticate'):
+		# Shard workers write with their own connections and cannot prompt, so the password is read here
+		netim_password = None
+		if args.reconcile == True:
+			if context != None and context['netim_password'] != None:
+				netim_password = context['netim_password']
+			else:
+				netim_password = sync_netim_password_get(args.netim_yml)
+				if context != None:
+					context['netim_password'] = netim_password
+		if context != None and context['netim'] != None:
+			netim = context['netim']
+		else:
+			netim = sync_netim_authenticate(args.netim_yml, netim_password)
+			if context != None:
+				context['netim'] = netim
+
+	# Sites are shared between shards, so they are compared and created before the devices are split up
+	print("")
+	print("Step 5 of 7: Comparing site and groups in NetIM with the inputs from ServiceNow")
+	print("")
+	with sync_stage(instrumentation, 'inventory'):
+		inventory = sync_netim_inventory_get(netim, context, args.netim_inventory, args.netim_inventory_max_age)
+	with sync_stage(instrumentation, 'sites_comparison'):
+		site_comparison = sync_servicenow_netim_sites_comparison(converted_sites, netim, args.summary,
+			list(inventory.groups.values()))
+	sync_servicenow_netim_sites_comparison_report(site_comparison, args.summary, sink)
+
+	print("")
+	print("Step 6 of 7: Comparing location information in NetIM with the inputs from ServiceNow")
+	print("")
+	with sync_stage(instrumentation, 'location_validation'):
+		location_cache = None
+		if context != None:
+			location_cache = context['netim_locations']
+		location_validation = sync_servicenow_netim_location_validation(converted_sites, netim, location_cache)
+	sync_servicenow_netim_location_validation_report(location_validation, args.summary, sink)
+
+	for comparison_name, comparison_list in site_comparison.items():
+		stats[comparison_name] = len(comparison_list)
+
+	if args.reconcile == True:
+		print("")
+		print("Reconciling sites in NetIM")
+		new_sites = site_comparison[SYNC_SERVICENOW_NETIM_COMPARISON_SITES_NEW]
+		with sync_stage(instrumentation, 'reconcile_sites'):
+			new_sites_ids = sync_netim_sites_create(netim, new_sites, converted_sites, inventory)
+		print("Created {} out of {} found new, valid sites in NetIM".format(len(new_sites_ids), len(new_sites)))
+		stats['created_sites'] = len(new_sites_ids)
+
+	print("")
+	print("Step 7 of 7: Comparing devices in NetIM with the inputs from ServiceNow in {} shards by {}".format(
+		args.shards, args.shard_by))
+	with sync_stage(instrumentation, 'devices_index'):
+		netim_index = inventory.index
+		fuzzy_index = None
+		if args.fuzzy_match != None:
+			fuzzy_index = sync_fuzzy_index(netim_index)
+		shards = sync_shards_split(converted_devices, args.shards, args.shard_by)
+
+	# Add the custom attributes once, rather than have every worker find them missing and add its own
+	attribute_ids = {}
+	if args.reconcile == True:
+		with sync_stage(instrumentation, 'reconcile_custom_attributes'):
+			attribute_ids[NETIM_CUSTOM_ATTRIBUTE_CMDB_ID] = sync_netim_custom_attribute_id(netim,
+				NETIM_CUSTOM_ATTRIBUTE_CMDB_ID, NETIM_CUSTOM_ATTRIBUTE_CMDB_ID_DESCRIPTION, inventory)
+			attribute_ids[NETIM_CUSTOM_ATTRIBUTE_LASTSYNCED] = sync_netim_custom_attribute_id(netim,
+				NETIM_CUSTOM_ATTRIBUTE_LASTSYNCED, NETIM_CUSTOM_ATTRIBUTE_LASTSYNCED_DESCRIPTION, inventory)
+
+	results = []
+	with sync_stage(instrumentation, 'devices_shards'):
+		with concurrent.futures.ProcessPoolExecutor(max_workers=len(shards), initializer=sync_shards_worker_init,
+			initargs=(netim_index, fuzzy_index, inventory.memberships, inventory.attribute_values,
+			inventory.attribute_values_loaded)) as executor:
+			futures = []
+			for shard_index, shard_devices in enumerate(shards):
+				shard_addresses = {}
+				for device in shard_devices:
+					device_name = device[NETIM_DEVICE_NAME]
+					if device_name in devices_with_access_addresses:
+						shard_addresses[device_name] = devices_with_access_addresses[device_name]
+				futures.append(executor.submit(sync_shards_worker, args, shard_index, shard_devices, shard_addresses,
+					netim_password, attribute_ids))
+			for future in futures:
+				results.append(future.result())
+
+	if args.reconcile == True:
+		sync_shards_inventory_merge(inventory, results)
+	for result in results:
+		logger.info("Shard {} processed {} device(s)".format(result['shard'], result['devices']))
+		if result['output'] != '':
+			print(result['output'], end='')
+		for stat_name, stat_value in result['stats'].items():
+			stats[stat_name] = stats.get(stat_name, 0) + stat_value
+
+	device_comparison = sync_shards_comparison_merge([result['comparison'] for result in results])
+	sync_servicenow_netim_devices_comparison_report(device_comparison, args.summary, sink)
+	address_results = []
+	for result in results:
+		address_results.extend(result.get('address_updates', []))
+	if len(address_results) > 0:
+		sync_netim_devices_addresses_update_report(address_results, args.summary, sink)
+	for comparison_name, comparison_list in device_comparison.items():
+		stats[comparison_name] = len(comparison_list)
+
+	if args.aging_days != None:
+		print("")
+		print("Aging out devices that are no longer in the CMDB")
+		with sync_stage(instrumentation, 'aging'):
+			stats.update(sync_aging_run(netim, inventory, converted_devices, args.aging_days, args.aging_action,
+				args.aging_apply, args.summary, sink))
+
+	sync_netim_inventory_save(inventory, args.netim_inventory)
+
+	print("")
+	print("End of Comparison Report")
+	print("---------------------------------------------------------------------------------------------------")
+
+	return stats
@@ -0,0 +1,236 @@
+# Multiple targets for sync_servicenow.py: each ServiceNow/NetIM pair of a targets file synchronized in parallel
+
+import contextlib
+import copy
+import logging
+import os
+import re
+import time
+
+from sync_servicenow import yamlread, credentials_get, SYNC_REPORT_FORMAT_TEXT, sync_report_sink_create, \
+	SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_NEW, SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_DIFFERENT, \
+	SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_NO_UPDATES, SYNC_SERVICENOW_NETIM_COMPARISON_SITES_NEW, \
+	sync_context_create, sync_run
+
+logger = logging.getLogger(__name__)
+
+
+#----- Multiple target functions
+
+SYNC_TARGETS_MAX_WORKERS = 4
+SYNC_TARGETS_NETIM_CONCURRENCY = 1
+
+# Options that each target may set for itself; anything else comes from the command line
+SYNC_TARGETS_OPTIONS = ['servicenow_yml', 'servicenow_devices_csv', 'servicenow_locations_csv', 'netim_yml', 'summary',
+	'reconcile']
+
+SYNC_TARGETS_SUMMARY_COLUMNS = ['devices_to_import', SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_NEW,
+	SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_DIFFERENT, SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_NO_UPDATES,
+	SYNC_SERVICENOW_NETIM_COMPARISON_SITES_NEW, 'created_devices', 'created_sites']
+
+def sync_targets_file_name(target_name):
+	# Target names end up in report file names, so keep them to characters that can't leave the directory
+	file_name = re.sub(r'[^A-Za-z0-9_.-]', '_', str(target_name))
+	if file_name.strip('.') == '':
+		file_name = file_name.replace('.', '_')
+	return file_name
+
+def sync_targets_read(targets_yml):
+	# targets:
+	#   - name: <name>
+	#     servicenow_yml: <file> (or servicenow_devices_csv and servicenow_locations_csv)
+	#     netim_yml: <file>
+	#     reconcile: <true|false> (optional)
+	# max_workers: <processes> (optional)
+	# netim_concurrency: <runs per NetIM instance> (optional)
+	# netim_limits: {<NetIM hostname>: <runs>} (optional)
+	# output_directory: <directory for per-target reports> (optional)
+	config = yamlread(targets_yml)
+	if config == None or 'targets' not in config or type(config['targets']) is not list:
+		logger.info(f"No list of 'targets' found in {targets_yml}")
+		return None
+
+	valid_targets = []
+	names = set()
+	for index, target in enumerate(config['targets']):
+		if type(target) is not dict:
+			logger.info(f"Invalid target {target}.")
+			continue
+		if 'name' not in target or target['name'] in ['', None]:
+			target['name'] = f"target_{index + 1}"
+		target['file_name'] = sync_targets_file_name(target['name'])
+		if target['file_name'] in names:
+			logger.info(f"Invalid target {target}. Name '{target['name']}' is used more than once.")
+			continue
+		if 'netim_yml' not in target:
+			logger.info(f"Invalid target {target}. No 'netim_yml'.")
+			continue
+		if 'servicenow_yml' not in target and \
+			('servicenow_devices_csv' not in target or 'servicenow_locations_csv' not in target):
+			logger.info(f"Invalid target {target}. No 'servicenow_yml' or ServiceNow CSV files.")
+			continue
+		names.add(target['file_name'])
+		valid_targets.append(target)
+	config['targets'] = valid_targets
+
+	return config
+
+def sync_targets_netim_key(target):
+	# Targets that point at the same NetIM hostname share its concurrency limit and reference data
+	netim_hostname, netim_username, netim_password = credentials_get(target['netim_yml'])
+	if netim_hostname == None:
+		return target['netim_yml']
+	return netim_hostname
+
+def sync_targets_args(args, target):
+	target_args = copy.copy(args)
+	# A target defines its own ServiceNow input, so don't mix in input options from the command line
+	target_args.servicenow_yml = None
+	target_args.servicenow_devices_csv = None
+	target_args.servicenow_locations_csv = None
+	for option in SYNC_TARGETS_OPTIONS:
+		if option in target:
+			setattr(target_args, option, target[option])
+	return target_args
+
+def sync_targets_cache_merge(cache, update):
+	if 'countries' in update:
+		cache['countries'] = update['countries']
+	for key in ['regions', 'cities']:
+		if key in update:
+			merged = dict(cache.get(key, {}))
+			merged.update(update[key])
+			cache[key] = merged
+	return cache
+
+def sync_targets_worker(args, target, netim_key, semaphore, shared_caches, shared_lock, output_directory):
+
+	result = {}
+	result['name'] = target['name']
+	result['netim'] = netim_key
+	result['status'] = 'ok'
+	result['error'] = None
+	result['stats'] = {}
+
+	context = sync_context_create()
+	context['netim_semaphore'] = semaphore
+	with shared_lock:
+		context['netim_locations'] = sync_targets_cache_merge({}, shared_caches.get(netim_key, {}))
+
+	# Each target streams its report records to its own file
+	target_args = sync_targets_args(args, target)
+	report_output = target_args.report_output
+	if report_output != None and report_output != '-':
+		report_root, report_extension = os.path.splitext(report_output)
+		report_output = f"{report_root}_{target['file_name']}{report_extension}"
+
+	start = time.time()
+	try:
+		if output_directory != None:
+			with open(os.path.join(output_directory, f"{target['file_name']}.txt"), 'w') as file:
+				with contextlib.redirect_stdout(file):
+					sink = sync_report_sink_create(target_args.report_format, report_output, target_args.summary)
+					try:
+						result['stats'] = sync_run(target_args, {}, context, sink)
+					finally:
+						sink.close()
+		else:
+			sink = sync_report_sink_create(target_args.report_format, report_output, target_args.summary)
+			try:
+				result['stats'] = sync_run(target_args, {}, context, sink)
+			finally:
+				sink.close()
+	except Exception as e:
+		logger.info(f"Target {target['name']} failed: {e}")
+		result['status'] = 'failed'
+		result['error'] = repr(e)
+	result['duration'] = time.time() - start
+
+	# Publish the NetIM reference data this run looked up, for later runs against the same NetIM
+	with shared_lock:
+		shared_caches[netim_key] = sync_targets_cache_merge(shared_caches.get(netim_key, {}),
+			context['netim_locations'])
+
+	return result
+
+def sync_targets_summary_report(results):
+
+	print("")
+	print("Combined Target Summary")
+	print("---------------------------------------------------------------------------------------------------")
+	header = f"{'target':<20} {'netim':<20} {'status':<8} {'seconds':>8}"
+	for column in SYNC_TARGETS_SUMMARY_COLUMNS:
+		header += f" {column:>17}"
+	print(header)
+
+	totals = {}
+	for result in results:
+		line = f"{result['name']:<20} {result['netim']:<20} {result['status']:<8} {result['duration']:>8.1f}"
+		for column in SYNC_TARGETS_SUMMARY_COLUMNS:
+			value = result['stats'].get(column, 0)
+			totals[column] = totals.get(column, 0) + value
+			line += f" {value:>17}"
+		print(line)
+
+	line = f"{'total':<20} {'':<20} {'':<8} {'':>8}"
+	for column in SYNC_TARGETS_SUMMARY_COLUMNS:
+		line += f" {totals.get(column, 0):>17}"
+	print(line)
+
+	for result in results:
+		if result['error'] != None:
+			print(f"Target {result['name']} failed: {result['error']}")
+	print("")
+
+	return
+
+def sync_targets_run(args):
+	import concurrent.futures
+	import multiprocessing
+
+	config = sync_targets_read(args.targets_yml)
+	if config == None or len(config['targets']) == 0:
+		print(f"No valid targets found in {args.targets_yml}")
+		return None
+
+	# Records from several worker processes would interleave on stdout, so each target needs its own file
+	if len(config['targets']) > 1 and args.report_format not in [None, SYNC_REPORT_FORMAT_TEXT] and \
+		args.report_output in [None, '-']:
+		print(f"--report_output is required for --report_format {args.report_format} with more than one target")
+		return None
+
+	max_workers = config.get('max_workers', SYNC_TARGETS_MAX_WORKERS)
+	default_concurrency = config.get('netim_concurrency', SYNC_TARGETS_NETIM_CONCURRENCY)
+	netim_limits = config.get('netim_limits', {})
+	if netim_limits == None:
+		netim_limits = {}
+	output_directory = config.get('output_directory')
+	if output_directory != None:
+		os.makedirs(output_directory, exist_ok=True)
+
+	results = []
+	with multiprocessing.Manager() as manager:
+		shared_caches = manager.dict()
+		shared_lock = manager.Lock()
+		semaphores = {}
+		futures = []
+		with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+			for target in config['targets']:
+				netim_key = sync_targets_netim_key(target)
+				if netim_key not in semaphores:
+					semaphores[netim_key] = manager.Semaphore(netim_limits.get(netim_key, default_concurrency))
+				logger.info(f"Starting target {target['name']} against NetIM {netim_key}")
+				futures.append(executor.submit(sync_targets_worker, args, target, netim_key, semaphores[netim_key],
+					shared_caches, shared_lock, output_directory))
+
+			for future, target in zip(futures, config['targets']):
+				try:
+					results.append(future.result())
+				except Exception as e:
+					logger.info(f"Target {target['name']} failed: {e}")
+					results.append({'name':target['name'], 'netim':'', 'status':'failed', 'error':repr(e),
+						'stats':{}, 'duration':0.0})
+
+	sync_targets_summary_report(results)
+
+	return results
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The script and the ServiceNow client are run from the repository root rather than installed
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY)
+sys.path.insert(0, os.path.join(REPOSITORY, 'ServiceNowAPI'))
@@ -0,0 +1,93 @@
+import collections
+import random
+
+import sync_servicenow
+
+NEW = sync_servicenow.SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_NEW
+DIFFERENT = sync_servicenow.SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_DIFFERENT
+NO_UPDATES = sync_servicenow.SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_NO_UPDATES
+
+def fuzzy_index(device_names):
+	netim_devices = [{'name':device_name} for device_name in device_names]
+	return sync_servicenow.sync_fuzzy_index(sync_servicenow.sync_netim_devices_index(netim_devices))
+
+def test_fuzzy_matches_suffixes_and_punctuation():
+	index = fuzzy_index(['rtr-atl-01', 'sw-bos-core-02'])
+
+	assert [name for name, score in sync_servicenow.sync_fuzzy_lookup('rtr-atl-01-mgmt', index, 0.8)] == ['rtr-atl-01']
+	assert [name for name, score in sync_servicenow.sync_fuzzy_lookup('RTR_ATL_01', index, 0.8)] == ['rtr-atl-01']
+
+def test_fuzzy_number_guard():
+	# Members of a numbered fleet differ by a trigram or two, but are never suggested for each other
+	index = fuzzy_index(['core-sw-nyc-0101', 'core-sw-nyc-0102', 'core-sw-nyc-0110'])
+
+	suggestions = sync_servicenow.sync_fuzzy_lookup('core-sw-nyc-0101-oob', index, 0.5)
+	assert [name for name, score in suggestions] == ['core-sw-nyc-0101']
+	assert sync_servicenow.sync_fuzzy_lookup('core-sw-nyc-0103', index, 0.5) == []
+	# Numbers are compared by value, so leading zeros do not matter
+	assert [name for name, score in sync_servicenow.sync_fuzzy_lookup('coreswnyc101', index, 0.5)] == \
+		['core-sw-nyc-0101']
+
+def test_fuzzy_match_moves_new_devices():
+	index = fuzzy_index(['rtr-atl-01'])
+	comparison = {NEW:['rtr-atl-01-mgmt', 'rtr-atl-02']}
+
+	comparison = sync_servicenow.sync_servicenow_netim_devices_fuzzy_match(comparison, index, 0.8)
+	assert comparison[NEW] == ['rtr-atl-02']
+	assert [match['name'] for match in comparison[sync_servicenow.SYNC_SERVICENOW_NETIM_COMPARISON_DEVICES_FUZZY]] == \
+		['rtr-atl-01-mgmt']
+
+def test_external_sort(tmp_path):
+	records = [[random.choice('abcdef'), index] for index in range(100)]
+	random.Random(1).shuffle(records)
+
+	assert list(sync_servicenow.sync_external_sort(iter(records), str(tmp_path), run_size=3, fanin=2)) == \
+		sorted(records)
+	assert list(tmp_path.iterdir()) == []
+
+def devices_generate(seed):
+	# Overlapping names in both systems, with FQDNs, case differences, duplicate NetIM names and unnamed devices
+	generator = random.Random(seed)
+	netim_devices = []
+	for index in range(300):
+		number = generator.randrange(200)
+		netim_device = {'name':f'dev-{number}', 'accessAddress':f'10.0.0.{generator.randrange(4)}'}
+		if generator.random() < 0.3:
+			netim_device['displayName'] = f'DEV-{generator.randrange(200)}.example.com'
+		if generator.random() < 0.2:
+			netim_device = {'deviceAccessInfo':{'accessAddress':netim_device['accessAddress']},
+				'name':netim_device['name']}
+		if generator.random() < 0.05:
+			netim_device = {'displayName':f'dev-{number}'}
+		netim_devices.append(netim_device)
+
+	devices_to_import = []
+	devices_with_access_addresses = {}
+	for index in range(300):
+		number = generator.randrange(250)
+		device_name = generator.choice([f'dev-{number}', f'Dev-{number}.example.com'])
+		device = {'name':device_name, 'accessAddress':f'10.0.0.{generator.randrange(4)}'}
+		if generator.random() < 0.05:
+			device = {'accessAddress':'10.0.0.1'}
+		devices_to_import.append(device)
+		if 'name' in device:
+			devices_with_access_addresses[device_name] = [f'10.0.0.{generator.randrange(4)}' for count in range(2)]
+	return netim_devices, devices_to_import, devices_with_access_addresses
+
+def comparison_counts(comparison):
+	return {category:collections.Counter(comparison[category]) for category in [NEW, DIFFERENT, NO_UPDATES]}
+
+def test_external_comparison_matches_in_memory(tmp_path):
+	for seed in range(5):
+		netim_devices, devices_to_import, devices_with_access_addresses = devices_generate(seed)
+		for addresses in [None, devices_with_access_addresses]:
+			in_memory = sync_servicenow.sync_servicenow_netim_devices_comparison(devices_to_import, None,
+				addresses, netim_index=sync_servicenow.sync_netim_devices_index(netim_devices))
+			external = sync_servicenow.sync_servicenow_netim_devices_external_comparison(devices_to_import,
+				netim_devices, addresses, run_size=7, directory=str(tmp_path))
+
+			assert sum(len(external[category]) for category in [NEW, DIFFERENT, NO_UPDATES]) == \
+				len(devices_to_import)
+			assert comparison_counts(external) == comparison_counts(in_memory)
+			for category in [NEW, DIFFERENT, NO_UPDATES]:
+				external[category].close()
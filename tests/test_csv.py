@@ -0,0 +1,91 @@
+import csv
+
+import pytest
+
+import sync_servicenow
+
+FIELDS = ['name', 'address', 'notes']
+
+def rows_write(file_path, rows):
+	with open(file_path, 'w', encoding='utf-8', newline='') as file:
+		writer = csv.writer(file, quoting=csv.QUOTE_MINIMAL, lineterminator='\n')
+		writer.writerow(FIELDS)
+		writer.writerows(rows)
+
+def rows_quoted():
+	# Quoted fields with commas, doubled quotes and newlines, so that most byte offsets are inside a record
+	rows = []
+	for index in range(200):
+		notes = f'rack {index}'
+		if index % 3 == 0:
+			notes = f'line one\nline "two", {index}\n"three"'
+		elif index % 5 == 0:
+			notes = f'"{index}"'
+		rows.append([f'device-{index:03}', f'10.0.{index // 256}.{index % 256}', notes])
+	return rows
+
+@pytest.fixture
+def small_blocks(monkeypatch):
+	# Scan in blocks far smaller than a record, so quote parity has to be carried from block to block
+	monkeypatch.setattr(sync_servicenow, 'CSV_SCAN_BLOCK_SIZE', 7)
+
+@pytest.mark.parametrize('chunk_count', [1, 2, 3, 7, 16, 64])
+def test_chunk_boundaries_start_records(tmp_path, small_blocks, chunk_count):
+	file_path = str(tmp_path / 'devices.csv')
+	rows = rows_quoted()
+	rows_write(file_path, rows)
+
+	header_end, chunks = sync_servicenow.csv_chunk_boundaries(file_path, chunk_count)
+	with open(file_path, 'rb') as file:
+		content = file.read()
+
+	assert content[:header_end].decode('utf-8') == ','.join(FIELDS) + '\n'
+	assert chunks[0][0] == header_end
+	assert chunks[-1][1] == len(content)
+	parsed = []
+	for start, end in chunks:
+		chunk_rows = sync_servicenow.csv_chunk_rows_parse(content[start:end].decode('utf-8'), len(FIELDS))
+		assert chunk_rows != None
+		parsed.extend(chunk_rows)
+	assert parsed == rows
+
+def test_chunk_boundaries_header_only(tmp_path):
+	file_path = str(tmp_path / 'devices.csv')
+	with open(file_path, 'w', encoding='utf-8') as file:
+		file.write(','.join(FIELDS))
+
+	header_end, chunks = sync_servicenow.csv_chunk_boundaries(file_path, 4)
+	assert header_end == len(','.join(FIELDS))
+	assert chunks == []
+
+def test_chunk_rows_parse():
+	assert sync_servicenow.csv_chunk_rows_parse('a,b,"c\nd,e,f', 3) == None
+	assert sync_servicenow.csv_chunk_rows_parse('a,b,c\nd,e', 3) == None
+	assert sync_servicenow.csv_chunk_rows_parse('a,b,"c\nd"\ne,f,g\n', 3) == [['a', 'b', 'c\nd'], ['e', 'f', 'g']]
+
+def test_parallel_matches_serial(tmp_path, small_blocks):
+	file_path = str(tmp_path / 'devices.csv')
+	rows_write(file_path, rows_quoted())
+
+	serial = sync_servicenow.dictionary_from_csv(file_path)
+	assert len(serial) == 200
+	assert sync_servicenow.dictionary_from_csv_parallel(file_path, 2) == serial
+
+def test_parallel_falls_back_to_serial(tmp_path, small_blocks, caplog):
+	# A stray quote in an unquoted field breaks the parity of every later newline, and a short row does not
+	# have a value for each field; either way the file is read again in one process
+	file_path = str(tmp_path / 'devices.csv')
+	with open(file_path, 'w', encoding='utf-8') as file:
+		file.write(','.join(FIELDS) + '\n')
+		for index in range(100):
+			if index == 10:
+				file.write(f'device-{index},10.0.0.{index},6" rack\n')
+			elif index == 60:
+				file.write(f'device-{index},10.0.0.{index}\n')
+			else:
+				file.write(f'device-{index},10.0.0.{index},rack\n')
+
+	serial = sync_servicenow.dictionary_from_csv(file_path)
+	caplog.set_level('INFO', logger=sync_servicenow.logger.name)
+	assert sync_servicenow.dictionary_from_csv_parallel(file_path, 2) == serial
+	assert 'reading it in one process' in caplog.text
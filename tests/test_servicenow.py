@@ -0,0 +1,66 @@
+import json
+
+import pytest
+
+pytest.importorskip('requests')
+
+from servicenow import ServiceNow
+
+class Response():
+
+	def __init__(self, body, status_code=200, chunk_size=None):
+		self.body = body.encode('utf-8')
+		self.status_code = status_code
+		self.headers = {}
+		self.text = body
+		self.closed = False
+		self.chunk_size = chunk_size
+
+	def iter_content(self, chunk_size=1):
+		chunk_size = self.chunk_size or chunk_size
+		for index in range(0, len(self.body), chunk_size):
+			yield self.body[index:index + chunk_size]
+
+	def close(self):
+		self.closed = True
+
+class Session():
+
+	def __init__(self, response):
+		self.response = response
+
+	def get(self, url, headers=None, verify=False, stream=False):
+		assert stream == True
+		return self.response
+
+def records_iterate(body, chunk_size, status_code=200, canonicalize=None):
+	servicenow = ServiceNow('instance.service-now.com', 'user', 'password')
+	response = Response(body, status_code=status_code, chunk_size=chunk_size)
+	servicenow.session = Session(response)
+	servicenow.canonicalize = canonicalize
+	records = list(servicenow._iterate_from_url('https://instance.service-now.com/api/now/table/cmdb_ci', {}))
+	assert response.closed == True
+	return records
+
+RECORDS = [
+	{'sys_id':'1', 'name':'rtr-atl-01', 'location':{'display_value':'Atlanta, "GA"', 'value':'a'}},
+	{'sys_id':'2', 'name':'sw-[bos]-02', 'notes':'result: ] }, {'},
+	{'sys_id':'3', 'name':'café-röuter', 'ip_address':''},
+]
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 5, 16, 4096])
+def test_iterate_from_url_across_chunks(chunk_size):
+	# Records, strings with brackets and multibyte characters split anywhere between network chunks
+	body = json.dumps({'result':RECORDS}, indent=1, ensure_ascii=False)
+	assert records_iterate(body, chunk_size) == RECORDS
+
+def test_iterate_from_url_empty_and_missing_result():
+	assert records_iterate('{"result": []}', 3) == []
+	assert records_iterate('{"error": {"message": "No records"}}', 3) == []
+
+def test_iterate_from_url_error():
+	assert records_iterate('{"error": {"message": "User Not Authenticated"}}', 3, status_code=401) == [None]
+
+def test_iterate_from_url_canonicalize():
+	body = json.dumps({'result':RECORDS})
+	assert records_iterate(body, 7, canonicalize=lambda record: record['sys_id']) == ['1', '2', '3']
@@ -0,0 +1,77 @@
+import sync_servicenow
+
+def inventory_get(netim_devices, groups):
+	inventory = sync_servicenow.SyncNetIMInventory()
+	inventory.devices = netim_devices
+	inventory.devices_index()
+	inventory.groups = {group['name']:group for group in groups}
+	inventory.fingerprint = sync_servicenow.sync_netim_inventory_fingerprint(inventory.groups.values(),
+		inventory.devices_digest)
+	return inventory
+
+def converted_get():
+	devices = [{'name':f'dev-{index}', 'accessAddress':f'10.0.0.{index}'} for index in range(4)]
+	sites = [{'name':'Atlanta', 'city':'Atlanta'}, {'name':'Boston', 'city':'Boston'}]
+	return devices, sites
+
+def test_snapshot_delta(tmp_path):
+	snapshot_file = str(tmp_path / 'snapshot.json')
+	devices, sites = converted_get()
+	inventory = inventory_get([dict(device, id=index) for index, device in enumerate(devices)],
+		[dict(site) for site in sites])
+
+	# Without a snapshot everything is compared
+	delta = sync_servicenow.sync_snapshot_delta(sync_servicenow.sync_snapshot_read(snapshot_file), inventory,
+		devices, sites)
+	assert delta['full'] == True
+	assert delta['devices'] == devices
+	assert delta['sites'] == sites
+	sync_servicenow.sync_snapshot_save(delta, inventory, snapshot_file)
+
+	# Only added and changed devices and sites are compared; removed ones are listed
+	devices[1] = {'name':'dev-1', 'accessAddress':'10.0.1.1'}
+	devices.pop(3)
+	devices.append({'name':'dev-9', 'accessAddress':'10.0.0.9'})
+	sites[1] = {'name':'Boston', 'city':'Cambridge'}
+	delta = sync_servicenow.sync_snapshot_delta(sync_servicenow.sync_snapshot_read(snapshot_file), inventory,
+		devices, sites)
+	assert delta['full'] == False
+	assert [device['name'] for device in delta['devices']] == ['dev-1', 'dev-9']
+	assert sorted(delta['unchanged_devices']) == ['dev-0', 'dev-2']
+	assert [site['name'] for site in delta['sites']] == ['Boston']
+	assert delta['removed_devices'] == ['dev-3']
+	assert delta['removed_sites'] == []
+
+	# Another address listed for a device counts as a change
+	delta = sync_servicenow.sync_snapshot_delta(sync_servicenow.sync_snapshot_read(snapshot_file), inventory,
+		devices, sites, devices_with_access_addresses={'dev-0':['10.0.0.0', '10.0.2.0']})
+	assert 'dev-0' in delta['device_hashes']
+
+def test_snapshot_save_keeps_only_agreed_devices(tmp_path):
+	snapshot_file = str(tmp_path / 'snapshot.json')
+	devices, sites = converted_get()
+	# NetIM has dev-0 at another address, does not have dev-3 and does not have the Boston group
+	netim_devices = [dict(device, id=index) for index, device in enumerate(devices[:3])]
+	netim_devices[0]['accessAddress'] = '10.9.9.9'
+	inventory = inventory_get(netim_devices, [sites[0]])
+
+	delta = sync_servicenow.sync_snapshot_delta(None, inventory, devices, sites)
+	sync_servicenow.sync_snapshot_save(delta, inventory, snapshot_file)
+
+	snapshot = sync_servicenow.sync_snapshot_read(snapshot_file)
+	assert sorted(snapshot['devices']) == ['dev-1', 'dev-2']
+	assert sorted(snapshot['sites']) == ['Atlanta']
+
+def test_snapshot_ignored_when_netim_changed(tmp_path):
+	snapshot_file = str(tmp_path / 'snapshot.json')
+	devices, sites = converted_get()
+	netim_devices = [dict(device, id=index) for index, device in enumerate(devices)]
+	inventory = inventory_get(netim_devices, sites)
+	sync_servicenow.sync_snapshot_save(sync_servicenow.sync_snapshot_delta(None, inventory, devices, sites),
+		inventory, snapshot_file)
+
+	netim_devices[2]['accessAddress'] = '10.9.9.9'
+	delta = sync_servicenow.sync_snapshot_delta(sync_servicenow.sync_snapshot_read(snapshot_file),
+		inventory_get(netim_devices, sites), devices, sites)
+	assert delta['full'] == True
+	assert len(delta['devices']) == len(devices)